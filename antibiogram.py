@@ -0,0 +1,281 @@
+"""
+Antibiogrammes cumulés : pourcentages S / I / R par germe et par antibiotique.
+
+Pour une période (en général une année), seul le premier isolat de chaque germe par
+patient est compté (premier BacterioResult du patient pour ce germe, par date
+d'analyse, ayant au moins un résultat d'antibiogramme interprétable). Les comptes
+sont calculés par deux requêtes groupées (fonction de fenêtre pour le premier
+isolat, puis agrégation S / I / R) sans charger d'objets ORM.
+
+AntibiogramCache garde en mémoire, par période, les comptes et les premiers isolats,
+avec le dernier AntibioResult.id pris en compte et une signature des lignes déjà
+intégrées (nombre d'AntibioResult d'id <= ce dernier id, dernier updated_at des
+AntibioResult et BacterioResult). À chaque lecture, la signature est relue (une
+requête d'agrégats) : si elle a changé (ligne modifiée, supprimée, ou validée hors de
+l'ordre des id, y compris par un autre processus ou en Core), la période est
+recalculée ; sinon seuls les AntibioResult ajoutés depuis sont lus et intégrés. Un
+nouvel isolat antérieur au premier isolat connu (saisie tardive) provoque aussi un
+recalcul, de même qu'une période calculée depuis plus de max_age secondes (seul
+filet pour un changement de date d'analyse ou une écriture SQL brute). Les écritures
+ORM sur AntibioResult ou BacterioResult vident de plus le cache après commit
+(register_invalidation).
+
+Usage : python antibiogram.py 2024 [--min-isolats 30]
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import event, select, func, case, exists, and_
+from sqlalchemy.orm import Session, object_session
+from models import Analyse, AntibioResult, BacterioResult, Germe
+from refdata import shared_cache
+
+logger = logging.getLogger(__name__)
+
+SENSIBLE, INTERMEDIAIRE, RESISTANT = "S", "I", "R"
+INTERPRETATIONS = (SENSIBLE, INTERMEDIAIRE, RESISTANT)
+
+AntibiogramLine = namedtuple("AntibiogramLine", ["germe_id", "germe", "antibiotique_id", "antibiotique", "n",
+                                                 "s", "i", "r", "pct_s", "pct_i", "pct_r"])
+
+_PENDING_KEY = "antibiogrammes_modifies"
+
+
+def year_period(year):
+    return datetime(year, 1, 1), datetime(year + 1, 1, 1)
+
+
+def _interpretation():
+    """Interprétation normalisée de AntibioResult.resultat ('Sensible', 'S', 'résistant' ...) : S, I ou R."""
+    return func.upper(func.substr(func.trim(AntibioResult.__table__.c.resultat), 1, 1))
+
+
+def _in_period(debut, fin):
+    analyses = Analyse.__table__
+    return and_(analyses.c.analyse_date >= debut, analyses.c.analyse_date < fin)
+
+
+def first_isolates_query(debut, fin, max_id):
+    """
+    Premier isolat de chaque (patient, germe) de la période : (patient_id, germe_id,
+    analyse_date, bacterio_id), en ne considérant que les AntibioResult.id <= max_id.
+    """
+    analyses = Analyse.__table__
+    bacterio = BacterioResult.__table__
+    antibio = AntibioResult.__table__
+    rang = func.row_number().over(
+        partition_by=(analyses.c.patient_id, bacterio.c.germe_identifie),
+        order_by=(analyses.c.analyse_date, bacterio.c.id),
+    )
+    isolates = (
+        select(analyses.c.patient_id, bacterio.c.germe_identifie.label("germe_id"), analyses.c.analyse_date,
+               bacterio.c.id.label("bacterio_id"), rang.label("rang"))
+        .join(analyses, analyses.c.id == bacterio.c.analyse_id)
+        .where(bacterio.c.germe_identifie.isnot(None))
+        .where(_in_period(debut, fin))
+        .where(exists().where(antibio.c.bacterio_result_id == bacterio.c.id)
+               .where(antibio.c.id <= max_id)
+               .where(_interpretation().in_(INTERPRETATIONS)))
+        .subquery()
+    )
+    return select(isolates.c.patient_id, isolates.c.germe_id, isolates.c.analyse_date,
+                  isolates.c.bacterio_id).where(isolates.c.rang == 1)
+
+
+def counts_query(debut, fin, max_id):
+    """Comptes S / I / R par (germe, antibiotique) sur les premiers isolats de la période."""
+    antibio = AntibioResult.__table__
+    first = first_isolates_query(debut, fin, max_id).subquery()
+    interpretation = _interpretation()
+    return (
+        select(first.c.germe_id, antibio.c.antibiotique_id,
+               *(func.sum(case((interpretation == value, 1), else_=0)) for value in INTERPRETATIONS))
+        .join(first, first.c.bacterio_id == antibio.c.bacterio_result_id)
+        .where(antibio.c.id <= max_id)
+        .where(antibio.c.antibiotique_id.isnot(None))
+        .where(interpretation.in_(INTERPRETATIONS))
+        .group_by(first.c.germe_id, antibio.c.antibiotique_id)
+    )
+
+
+def signature_query(debut, fin, max_id):
+    """
+    Signature des AntibioResult de la période d'id <= max_id : (nombre, dernier
+    updated_at des AntibioResult, dernier updated_at de leurs BacterioResult).
+    """
+    analyses = Analyse.__table__
+    bacterio = BacterioResult.__table__
+    antibio = AntibioResult.__table__
+    return (
+        select(func.count(antibio.c.id), func.max(antibio.c.updated_at), func.max(bacterio.c.updated_at))
+        .join(bacterio, bacterio.c.id == antibio.c.bacterio_result_id)
+        .join(analyses, analyses.c.id == bacterio.c.analyse_id)
+        .where(antibio.c.id <= max_id)
+        .where(_in_period(debut, fin))
+    )
+
+
+def new_results_query(debut, fin, after_id, max_id):
+    """AntibioResult interprétables de la période ajoutés depuis after_id, avec leur isolat."""
+    analyses = Analyse.__table__
+    bacterio = BacterioResult.__table__
+    antibio = AntibioResult.__table__
+    interpretation = _interpretation()
+    return (
+        select(antibio.c.bacterio_result_id, antibio.c.antibiotique_id, interpretation.label("interpretation"),
+               analyses.c.patient_id, bacterio.c.germe_identifie, analyses.c.analyse_date)
+        .join(bacterio, bacterio.c.id == antibio.c.bacterio_result_id)
+        .join(analyses, analyses.c.id == bacterio.c.analyse_id)
+        .where(antibio.c.id > after_id)
+        .where(antibio.c.id <= max_id)
+        .where(bacterio.c.germe_identifie.isnot(None))
+        .where(_in_period(debut, fin))
+        .where(interpretation.in_(INTERPRETATIONS))
+        .order_by(antibio.c.id)
+    )
+
+
+class _PeriodStats:
+    """
+    Comptes d'une période : {(germe, antibiotique): [s, i, r]}, premiers isolats,
+    dernier id intégré, signature des lignes intégrées et date du calcul complet.
+    """
+
+    def __init__(self, max_id, signature):
+        self.max_id = max_id
+        self.signature = signature
+        self.computed_at = time.monotonic()
+        self.counts = {}
+        self.first_isolates = {}
+
+    def add(self, germe_id, antibiotique_id, s, i, r):
+        counts = self.counts.setdefault((germe_id, antibiotique_id), [0, 0, 0])
+        counts[0] += s
+        counts[1] += i
+        counts[2] += r
+
+
+class AntibiogramCache:
+    """Antibiogrammes cumulés par période, calculés en SQL et complétés au fil des nouveaux résultats."""
+
+    def __init__(self, engine, max_age=3600):
+        self.engine = engine
+        self.max_age = max_age
+        self._periods = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._periods.clear()
+
+    @staticmethod
+    def _signature(connection, debut, fin, max_id):
+        return tuple(connection.execute(signature_query(debut, fin, max_id)).one())
+
+    def _compute(self, connection, debut, fin, max_id):
+        start = time.perf_counter()
+        # Signature lue avant les comptes : une écriture concurrente la rendra différente au prochain appel
+        stats = _PeriodStats(max_id, self._signature(connection, debut, fin, max_id))
+        for patient_id, germe_id, analyse_date, bacterio_id in connection.execute(
+                first_isolates_query(debut, fin, max_id)):
+            stats.first_isolates[(patient_id, germe_id)] = (analyse_date, bacterio_id)
+        for germe_id, antibiotique_id, s, i, r in connection.execute(counts_query(debut, fin, max_id)):
+            stats.add(germe_id, antibiotique_id, s, i, r)
+        logger.info(f"Antibiogramme {debut:%Y-%m-%d} - {fin:%Y-%m-%d} calculé : {len(stats.first_isolates)} "
+                    f"isolats en {time.perf_counter() - start:.2f}s")
+        return stats
+
+    def _catch_up(self, connection, debut, fin, stats, max_id):
+        """Intègre les résultats ajoutés depuis stats.max_id. Retourne False si un recalcul est nécessaire."""
+        signature = self._signature(connection, debut, fin, max_id)
+        for bacterio_id, antibiotique_id, interpretation, patient_id, germe_id, analyse_date in connection.execute(
+                new_results_query(debut, fin, stats.max_id, max_id)):
+            isolate = (analyse_date, bacterio_id)
+            first = stats.first_isolates.setdefault((patient_id, germe_id), isolate)
+            if isolate < first:
+                return False
+            if isolate == first and antibiotique_id is not None:
+                stats.add(germe_id, antibiotique_id, *(int(interpretation == value) for value in INTERPRETATIONS))
+        stats.max_id = max_id
+        stats.signature = signature
+        return True
+
+    def counts(self, debut, fin):
+        """Comptes {(germe_id, antibiotique_id): (s, i, r)} de la période [debut, fin[."""
+        antibio = AntibioResult.__table__
+        with self.engine.connect() as connection:
+            max_id = connection.execute(select(func.coalesce(func.max(antibio.c.id), 0))).scalar()
+            with self._lock:
+                stats = self._periods.get((debut, fin))
+                if stats is not None and (time.monotonic() - stats.computed_at > self.max_age or
+                                          self._signature(connection, debut, fin, stats.max_id) != stats.signature):
+                    stats = None
+                if stats is not None and max_id > stats.max_id \
+                        and not self._catch_up(connection, debut, fin, stats, max_id):
+                    stats = None
+                if stats is None:
+                    stats = self._periods[(debut, fin)] = self._compute(connection, debut, fin, max_id)
+                return {key: tuple(values) for key, values in stats.counts.items()}
+
+    def report(self, debut, fin, min_isolates=0):
+        """Lignes de l'antibiogramme cumulé (pourcentages), triées par germe puis antibiotique."""
+        counts = self.counts(debut, fin)
+        germes = Germe.__table__
+        with self.engine.connect() as connection:
+            germe_names = dict(connection.execute(select(germes.c.id, germes.c.nom)).all())
+        antibiotiques = shared_cache(self.engine).covering(
+            antibiotiques={antibiotique_id for _, antibiotique_id in counts}).antibiotiques
+        lines = []
+        for (germe_id, antibiotique_id), (s, i, r) in counts.items():
+            n = s + i + r
+            if n and n >= min_isolates:
+                antibiotique = antibiotiques.get(antibiotique_id)
+                lines.append(AntibiogramLine(germe_id, germe_names.get(germe_id), antibiotique_id,
+                                             antibiotique.nom if antibiotique else None, n, s, i, r,
+                                             round(100.0 * s / n, 1), round(100.0 * i / n, 1),
+                                             round(100.0 * r / n, 1)))
+        return sorted(lines, key=lambda line: (line.germe or "", line.antibiotique or ""))
+
+
+def register_invalidation(antibiogram_cache):
+    """Vide le cache après le commit d'une modification ou suppression ORM d'AntibioResult / BacterioResult."""
+
+    def _track(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info[_PENDING_KEY] = True
+
+    def _after_commit(session):
+        if session.info.pop(_PENDING_KEY, None):
+            antibiogram_cache.invalidate()
+
+    def _after_rollback(session):
+        session.info.pop(_PENDING_KEY, None)
+
+    for model in (AntibioResult, BacterioResult):
+        event.listen(model, "after_update", _track)
+        event.listen(model, "after_delete", _track)
+    event.listen(Session, "after_commit", _after_commit)
+    event.listen(Session, "after_rollback", _after_rollback)
+    return antibiogram_cache
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from database import create_engine_from_env
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Antibiogramme cumulé (premier isolat par patient)")
+    parser.add_argument("annee", type=int)
+    parser.add_argument("--min-isolats", type=int, default=0)
+    args = parser.parse_args()
+
+    engine = create_engine_from_env(os.getenv("DATABASE_URL"))
+    debut, fin = year_period(args.annee)
+    for line in AntibiogramCache(engine).report(debut, fin, args.min_isolats):
+        print(f"{line.germe} / {line.antibiotique} : n={line.n} S={line.pct_s}% I={line.pct_i}% R={line.pct_r}%")
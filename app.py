@@ -1,7 +1,16 @@
-from flask import Flask, render_template
-from sqlalchemy.orm import sessionmaker, joinedload
-from models import Patient, Analyse, Resultat  # Importez vos modèles SQLAlchemy
-from sqlalchemy import create_engine
+from flask import Flask, render_template, request, make_response, jsonify
+from werkzeug.http import is_resource_modified
+from sqlalchemy.orm import sessionmaker
+from repository import CoreResultRepository
+from references import ReferenceIndex, register_refresh
+from refdata import shared_cache
+from cache import LRUCacheBackend, ResultPageCache, register_invalidation, on_results_committed
+from database import create_engine_from_env, create_router_from_env, render_pool_metrics, PoolMetrics
+from qc import QCEngine, register_validation
+from rollups import register_rollups
+from hematology import register_derivation
+from panels import PanelIndex, register_refresh as register_panel_refresh
+from antibiogram import AntibiogramCache, register_invalidation as register_antibiogram_invalidation
 from dotenv import load_dotenv
 import os
 import logging
@@ -21,9 +30,41 @@ application = app
 
 # Configuration de la base de données
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
+engine = create_engine_from_env(DATABASE_URL)
+pool_metrics = PoolMetrics().attach(engine)
 Session = sessionmaker(bind=engine)
 
+# Valeurs de référence en mémoire pour marquer les résultats anormaux
+reference_index = register_refresh(ReferenceIndex(engine))
+
+# Agrégats journaliers (revenus_journaliers) tenus à jour à chaque flush ORM
+register_rollups()
+
+# Indices dérivés (vgm, tcmh, ccmh, nlr, plr, mlr, ipr) calculés à chaque NFS écrite par l'ORM
+register_derivation()
+
+# Règles de Westgard appliquées à chaque résultat de contrôle inséré (état des séries en base)
+qc_engine = register_validation(QCEngine())
+
+# Panels d'antibiogramme par germe, reconstruits après toute écriture sur les antibiotiques et germes
+panel_index = register_panel_refresh(PanelIndex(engine))
+
+# Antibiogrammes cumulés, vidés après toute modification ORM des résultats de bactériologie
+antibiogram_cache = register_antibiogram_invalidation(AntibiogramCache(engine))
+
+# Paramètres, catégories, tubes, types de prélèvement : instantané partagé par le processus
+reference_data = shared_cache(engine)
+
+# Lectures patient sur les réplicas (DATABASE_REPLICA_URLS), écritures sur le primaire
+router = create_router_from_env(engine)
+on_results_committed(router.mark_written)
+
+# Cache des pages résultats (invalidé par les écritures sur les tables de résultats)
+results_cache = register_invalidation(ResultPageCache(LRUCacheBackend(
+    maxsize=int(os.getenv("RESULTS_CACHE_SIZE", "1024")),
+    ttl=int(os.getenv("RESULTS_CACHE_TTL", "300")),
+)))
+
 @app.route('/')
 def index():
     return "hello"
@@ -32,82 +73,103 @@ def index():
 def about():
     return "laboratoire d'analyses médicales"
 
-@app.route('/<patient_barcode>', methods=['GET'])
-def get_results(patient_barcode):
-    session = Session()
-    try:
-        # Rechercher le patient par son code-barres
-        patient = (session.query(Patient).options(joinedload(Patient.analyses)).filter_by(patient_barcode=patient_barcode).first())
-        if not patient:
+@app.route('/metrics')
+def metrics():
+    pools = [("primary", engine, pool_metrics)] + router.metric_pools()
+    return render_pool_metrics(pools), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+def _with_validators(response, version):
+    """Ajoute ETag / Last-Modified pour permettre les requêtes conditionnelles (304)."""
+    response.set_etag(version.etag)
+    if version.last_modified:
+        response.last_modified = version.last_modified
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+def _results_page(session, patient_barcode):
+    repository = CoreResultRepository(session, reference_data)
+    # Version du contenu de la page : une requête d'agrégats, sans charger les lignes
+    # (le contenu dépend aussi des valeurs et données de référence : leurs empreintes entrent dans la version)
+    data_stamp = reference_data.stamp
+    version = repository.report_version(patient_barcode, salt=reference_index.ensure_fresh().stamp + data_stamp)
+    if version is None:
+        logger.warning(f"Patient non trouvé : {patient_barcode}")
+        return "Patient non trouvé", 404
+
+    # Résultats écrits à l'instant : relire sur le primaire plutôt que sur un réplica en retard
+    router.check_read_your_writes(session, version.patient_id)
+
+    if not version.nb_analyses:
+        logger.info(f"Aucun résultat disponible pour le patient : {patient_barcode}")
+        return "Aucun résultat disponible pour ce patient.", 404
+
+    # Requête conditionnelle : rien n'a changé depuis la dernière visite du client
+    if not is_resource_modified(request.environ, etag=version.etag, last_modified=version.last_modified):
+        return _with_validators(make_response("", 304), version)
+
+    html = results_cache.get(version.patient_id, version.version)
+    if html is None:
+        generation = results_cache.generation(version.patient_id)
+        # Charger le patient, ses analyses et leurs résultats en une seule requête projetée
+        report = repository.load_patient_report(patient_barcode)
+        if report is None:
             logger.warning(f"Patient non trouvé : {patient_barcode}")
             return "Patient non trouvé", 404
 
-        # Récupérer toutes les analyses associées au patient
-        analyses = (
-            session.query(Analyse)
-            .filter_by(patient_id=patient.id)
-            .all()
-        )
-        if not analyses:
-            logger.info(f"Aucun résultat disponible pour le patient : {patient_barcode}")
-            return "Aucun résultat disponible pour ce patient.", 404
-       
-
-        # Formater les résultats pour chaque analyse
-        formatted_results = []
-        for analyse in analyses:
-            # Vérifier les types d'analyses basés sur les champs booléens
-            analysis_types = []
-            if analyse.is_nfs:
-                analysis_types.append("NFS")
-            if analyse.is_groupage:
-                analysis_types.append("Groupage Sanguin")
-            if analyse.is_frottis:
-                analysis_types.append("Frottis")
-            if analyse.is_spermo:
-                analysis_types.append("Spermogramme")
-            if analyse.is_bacterio:
-                analysis_types.append("Bactériologie")
-            if analyse.is_special:
-                analysis_types.append("Analyse Spéciale")
-            if analyse.is_autre_analyse:
-                analysis_types.append("Autre Analyse")
-            if analyse.is_soustraitance:
-                analysis_types.append("Soustraitance")
-
-            # Récupérer les résultats spécifiques pour cette analyse
-            resultats = (session.query(Resultat).options(joinedload(Resultat.parameter)).filter_by(analyse_id=analyse.id).all())
-            formatted_resultats = [
-                {
-                    "parameter": resultat.parameter.param,
-                    "valeur": resultat.valeur,
-                    "date": resultat.result_date.strftime("%Y-%m-%d %H:%M:%S") if resultat.result_date else None,
-                }
-                for resultat in resultats
-            ]
-
-            formatted_results.append({
-                "analyse_id": analyse.id,
-                "types_analyses": analysis_types,
-                "resultats": formatted_resultats,
-            })
-
         # Renvoyer les résultats sous forme de page HTML
-        return render_template(
-            "resultat.html",
-            nom=patient.name,
-            prenom=patient.prenom,
-            adresse=patient.adresse,
-            email=patient.email,
-            tel=patient.tel,
-            resultats=formatted_results
-        )
+        reference_index.flag_report(report)
+        html = render_template("resultat.html", **report)
+        # Données de référence rechargées pendant le chargement (paramètre manquant) : la page
+        # ne correspond plus à la version calculée, elle n'est pas mise en cache
+        if reference_data.stamp == data_stamp:
+            results_cache.set(version.patient_id, version.version, html, generation)
+    return _with_validators(make_response(html), version)
 
+@app.route('/<patient_barcode>', methods=['GET'])
+def get_results(patient_barcode):
+    try:
+        return router.read(lambda session: _results_page(session, patient_barcode))
     except Exception as e:
         logger.error(f"Erreur lors du traitement de la requête : {str(e)}")
         return f"Erreur : {str(e)}", 500
-    finally:
-        session.close()
+
+# Taille des pages de l'historique d'un paramètre
+TIMELINE_DEFAULT_LIMIT = 100
+TIMELINE_MAX_LIMIT = 1000
+
+def _timeline(session, patient_barcode, parameter_id, limit, cursor, descending):
+    repository = CoreResultRepository(session, reference_data)
+    header = repository.timeline_header(patient_barcode, parameter_id)
+    if header.patient_id is None:
+        return jsonify(erreur="Patient non trouvé"), 404
+    if header.param is None:
+        return jsonify(erreur="Paramètre non trouvé"), 404
+    router.check_read_your_writes(session, header.patient_id)
+    try:
+        resultats, next_cursor = repository.timeline_page(header.patient_id, parameter_id, limit, cursor, descending)
+    except ValueError as e:
+        return jsonify(erreur=str(e)), 400
+    return jsonify(
+        parametre={"id": parameter_id, "param": header.param, "unite": header.unite},
+        resultats=resultats,
+        suivant=next_cursor,
+    )
+
+@app.route('/<patient_barcode>/historique/<int:parameter_id>', methods=['GET'])
+def get_timeline(patient_barcode, parameter_id):
+    """
+    Historique JSON d'un paramètre pour un patient, trié par date (ordre=desc pour les
+    plus récents d'abord), paginé par clé : ?limite=100&curseur=<suivant de la page précédente>.
+    """
+    limit = max(1, min(request.args.get("limite", TIMELINE_DEFAULT_LIMIT, type=int), TIMELINE_MAX_LIMIT))
+    cursor = request.args.get("curseur")
+    descending = request.args.get("ordre", "asc") == "desc"
+    try:
+        return router.read(lambda session: _timeline(session, patient_barcode, parameter_id, limit, cursor,
+                                                     descending))
+    except Exception as e:
+        logger.error(f"Erreur lors du traitement de la requête : {str(e)}")
+        return jsonify(erreur=str(e)), 500
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,177 @@
+"""
+Variante asynchrone (ASGI) du service de résultats : mêmes routes que app.py
+('/', '/about', '/<patient_barcode>') et même template, avec l'engine asyncio de
+SQLAlchemy pour qu'un seul processus traite des centaines de requêtes en parallèle.
+
+Lancement : uvicorn asgi:application --host 0.0.0.0 --port 8001
+"""
+import os
+import logging
+from dotenv import load_dotenv
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from werkzeug.http import http_date, is_resource_modified, quote_etag
+from repository import report_query, version_query, build_report, build_version
+from references import ReferenceIndex, register_refresh, reference_query
+from refdata import reference_data_queries, shared_cache
+from cache import LRUCacheBackend, ResultPageCache, register_invalidation
+from database import pool_options_from_env
+from hematology import register_derivation
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Pilotes asynchrones correspondant aux URLs synchrones de DATABASE_URL
+ASYNC_DRIVERS = {
+    "postgresql://": "postgresql+asyncpg://",
+    "postgres://": "postgresql+asyncpg://",
+    "postgresql+psycopg2://": "postgresql+asyncpg://",
+    "sqlite://": "sqlite+aiosqlite://",
+}
+
+
+def async_database_url(database_url):
+    for prefix, async_prefix in ASYNC_DRIVERS.items():
+        if database_url.startswith(prefix):
+            return async_prefix + database_url[len(prefix):]
+    return database_url
+
+
+DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or async_database_url(os.getenv("DATABASE_URL"))
+engine = create_async_engine(DATABASE_URL, **pool_options_from_env(DATABASE_URL))
+AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+templates = Environment(
+    loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")),
+    autoescape=select_autoescape(["html"]),
+)
+
+# Indices dérivés des NFS calculés à chaque écriture ORM (les sessions asynchrones comprises)
+register_derivation()
+
+results_cache = register_invalidation(ResultPageCache(LRUCacheBackend(
+    maxsize=int(os.getenv("RESULTS_CACHE_SIZE", "1024")),
+    ttl=int(os.getenv("RESULTS_CACHE_TTL", "300")),
+)))
+
+
+# Index des valeurs de référence, rechargé via l'engine asynchrone (voir _fresh_reference_index)
+reference_index = register_refresh(ReferenceIndex(None))
+
+
+async def _fresh_reference_index():
+    if reference_index.needs_refresh():
+        async with engine.connect() as connection:
+            reference_index.build((await connection.execute(reference_query())).all())
+    return reference_index
+
+
+# Données de référence (libellés des paramètres), chargées de même via l'engine asynchrone
+reference_data = shared_cache()
+
+
+async def _fresh_reference_data(force=False):
+    if force or reference_data.needs_refresh():
+        async with engine.connect() as connection:
+            return reference_data.build({name: (await connection.execute(query)).all()
+                                         for name, query in reference_data_queries().items()})
+    return reference_data.get()
+
+
+def _validators(version):
+    headers = [("etag", quote_etag(version.etag)), ("cache-control", "private, no-cache")]
+    if version.last_modified:
+        headers.append(("last-modified", http_date(version.last_modified)))
+    return headers
+
+
+async def get_results(patient_barcode, request_headers):
+    async with AsyncSessionLocal() as session:
+        index = await _fresh_reference_index()
+        data = await _fresh_reference_data()
+        data_stamp = data.stamp
+        version = build_version((await session.execute(version_query(patient_barcode))).first(),
+                                index.stamp + data_stamp)
+        if version is None:
+            logger.warning(f"Patient non trouvé : {patient_barcode}")
+            return 404, [], "Patient non trouvé"
+
+        if not version.nb_analyses:
+            logger.info(f"Aucun résultat disponible pour le patient : {patient_barcode}")
+            return 404, [], "Aucun résultat disponible pour ce patient."
+
+        # Requête conditionnelle : rien n'a changé depuis la dernière visite du client
+        environ = {"REQUEST_METHOD": "GET"}
+        for name in ("if-none-match", "if-modified-since"):
+            if name in request_headers:
+                environ["HTTP_" + name.upper().replace("-", "_")] = request_headers[name]
+        if not is_resource_modified(environ, etag=version.etag, last_modified=version.last_modified):
+            return 304, _validators(version), ""
+
+        html = results_cache.get(version.patient_id, version.version)
+        if html is None:
+            generation = results_cache.generation(version.patient_id)
+            rows = (await session.execute(report_query(patient_barcode, with_labels=False))).all()
+            if reference_data.wants_reload(data, parameters={row.parameter_id for row in rows}):
+                # Paramètre créé par un autre processus : rechargement (limité) de l'instantané
+                data = await _fresh_reference_data(force=True)
+            report = build_report(rows, data)
+            if report is None:
+                logger.warning(f"Patient non trouvé : {patient_barcode}")
+                return 404, [], "Patient non trouvé"
+            index.flag_report(report)
+            html = templates.get_template("resultat.html").render(**report)
+            # Instantané rechargé entre-temps : la page ne correspond plus à la version calculée
+            if data.stamp == data_stamp:
+                results_cache.set(version.patient_id, version.version, html, generation)
+        return 200, _validators(version), html
+
+
+async def dispatch(method, path, request_headers):
+    if method not in ("GET", "HEAD"):
+        return 405, [], "Méthode non autorisée"
+    if path == "/":
+        return 200, [], "hello"
+    if path == "/about":
+        return 200, [], "laboratoire d'analyses médicales"
+    patient_barcode = path[1:]
+    if not patient_barcode or "/" in patient_barcode:
+        return 404, [], "Not Found"
+    try:
+        return await get_results(patient_barcode, request_headers)
+    except Exception as e:
+        logger.error(f"Erreur lors du traitement de la requête : {str(e)}")
+        return 500, [], f"Erreur : {str(e)}"
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await engine.dispose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    request_headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+    status, headers, body = await dispatch(scope["method"], scope["path"], request_headers)
+    body = body.encode("utf-8") if status != 304 else b""
+    headers = [("content-type", "text/html; charset=utf-8"), ("content-length", str(len(body)))] + headers
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    })
+    await send({"type": "http.response.body", "body": body if scope["method"] != "HEAD" else b""})
@@ -0,0 +1,45 @@
+"""
+Mesure le marquage vectorisé (bas / normal / haut) d'un million de résultats
+avec ReferenceIndex, sur des valeurs de référence générées en mémoire.
+
+Usage : python benchmarks/bench_reference_flags.py [--resultats 1000000 --parametres 300]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from references import ReferenceIndex, CATEGORIES_AGE, categories_age
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resultats", type=int, default=1000000)
+    parser.add_argument("--parametres", type=int, default=300)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    rows = [
+        (parametre_id, categorie, sexe, 10.0 + parametre_id % 7, 50.0 + parametre_id % 11)
+        for parametre_id in range(1, args.parametres + 1)
+        for categorie in CATEGORIES_AGE
+        for sexe in ("homme", "femme")
+    ]
+    index = ReferenceIndex(None).build(rows)
+
+    parameter_ids = rng.integers(1, args.parametres + 1, args.resultats)
+    valeurs = rng.uniform(0, 80, args.resultats)
+    ages = rng.uniform(0, 90, args.resultats)
+    sexes = rng.integers(0, 2, args.resultats)
+
+    start = time.perf_counter()
+    categories = categories_age(ages)
+    flags = index.flag(parameter_ids, valeurs, categories, sexes)
+    elapsed = time.perf_counter() - start
+
+    counts = np.bincount(flags, minlength=4)
+    print(f"{args.resultats} résultats marqués en {elapsed * 1000:.1f} ms "
+          f"(bas {counts[1]}, normal {counts[2]}, haut {counts[3]}, inconnus {counts[0]})")
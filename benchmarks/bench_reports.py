@@ -0,0 +1,91 @@
+"""
+Mesure la génération des comptes rendus PDF : pages par seconde et mémoire
+résidente maximale (processus principal et processus de génération).
+
+Usage : python benchmarks/bench_reports.py sqlite:///bench_reports.db [--patients 50 --analyses 20 --workers 2]
+"""
+import argparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+from sqlalchemy import create_engine, insert, update
+from models import Analyse, Laboratoire, NumerationFormuleSanguine, Personnel
+from seed import seed
+from reports import generate_chunk, generate_day, validated_analyses
+
+
+def _image(path, size, text):
+    image = Image.new("RGBA", size, (255, 255, 255, 0))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((4, 4, size[0] - 4, size[1] - 4), outline=(20, 60, 160, 255), width=6)
+    draw.text((size[0] // 4, size[1] // 2), text, fill=(20, 60, 160, 255))
+    image.save(path)
+    return path
+
+
+def prepare(engine, assets_dir, nb_patients, nb_analyses):
+    seed(engine, nb_patients, nb_analyses, 12)
+    now = datetime.now()
+    with engine.begin() as conn:
+        conn.execute(insert(Personnel.__table__).values(
+            id=1, matricule="M001", nom="Biologiste", prenom="Chef", role="medecin", mot_de_passe="x",
+            personal_griffe=_image(os.path.join(assets_dir, "griffe_personnel.png"), (600, 300), "Dr Chef")))
+        conn.execute(insert(Laboratoire.__table__).values(
+            nom="Laboratoire d'analyses médicales", docteur="Dr Chef", specialite="Biologie clinique",
+            adresse="1 rue de la Santé", telephone1="0000000000", email="labo@example.com",
+            logo_path=_image(os.path.join(assets_dir, "logo.png"), (800, 800), "LOGO"),
+            griffe_path=_image(os.path.join(assets_dir, "griffe_labo.png"), (600, 300), "Cachet")))
+        conn.execute(update(Analyse.__table__).values(validated_by=1, validation_date=now))
+        conn.execute(insert(NumerationFormuleSanguine.__table__), [
+            {"analyse_id": analyse_id, "hemoglobine": 13.5, "hematocrite": 41.0, "globules_rouges": 4.6,
+             "globules_blancs": 7.2, "plaquettes": 250.0, "neutrophiles": 60.0, "lymphocytes": 30.0,
+             "monocytes": 7.0, "conclusion": "Hémogramme sans particularité"}
+            for analyse_id in range(1, nb_patients * nb_analyses + 1, 3)
+        ])
+
+
+def peak_rss_mb(who):
+    # ru_maxrss est en kilo-octets sous Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database_url")
+    parser.add_argument("--patients", type=int, default=50)
+    parser.add_argument("--analyses", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_reports_")
+    try:
+        engine = create_engine(args.database_url)
+        prepare(engine, work_dir, args.patients, args.analyses)
+        with engine.connect() as conn:
+            analyse_ids = validated_analyses(conn, date.today())
+
+        output_dir = os.path.join(work_dir, "serie")
+        os.makedirs(output_dir)
+        start = time.perf_counter()
+        pages = sum(generate_chunk(engine, analyse_ids[i:i + 100], output_dir)
+                    for i in range(0, len(analyse_ids), 100))
+        elapsed = time.perf_counter() - start
+        print(f"1 processus : {len(analyse_ids)} comptes rendus, {pages} pages en {elapsed:.1f}s "
+              f"({pages / elapsed:.0f} pages/s), RSS max {peak_rss_mb(resource.RUSAGE_SELF):.0f} Mo")
+
+        start = time.perf_counter()
+        count, pages = generate_day(args.database_url, date.today(), os.path.join(work_dir, "parallele"),
+                                    workers=args.workers)
+        elapsed = time.perf_counter() - start
+        print(f"{args.workers} processus : {count} comptes rendus, {pages} pages en {elapsed:.1f}s "
+              f"({pages / elapsed:.0f} pages/s), RSS max par processus {peak_rss_mb(resource.RUSAGE_CHILDREN):.0f} Mo")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,55 @@
+"""
+Compare le chargement de la page résultats via l'ORM (ResultRepository)
+et via la requête Core projetée (CoreResultRepository).
+
+Usage : python benchmarks/bench_results_page.py [--patients 200 --analyses 30 --resultats 12 --iterations 500]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from repository import ResultRepository, CoreResultRepository
+from seed import seed
+
+
+def run(Session, repository_class, barcodes):
+    start = time.perf_counter()
+    for barcode in barcodes:
+        session = Session()
+        try:
+            repository_class(session).load_patient_report(barcode)
+        finally:
+            session.close()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", default="sqlite:///bench_results.db")
+    parser.add_argument("--patients", type=int, default=200)
+    parser.add_argument("--analyses", type=int, default=30)
+    parser.add_argument("--resultats", type=int, default=12)
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    seed(engine, args.patients, args.analyses, args.resultats)
+    Session = sessionmaker(bind=engine)
+
+    rnd = random.Random(0)
+    barcodes = [f"PAT{rnd.randrange(args.patients):05d}" for _ in range(args.iterations)]
+
+    # Les deux chemins doivent produire le même modèle de vue
+    assert ResultRepository(Session()).load_patient_report(barcodes[0]) == \
+        CoreResultRepository(Session()).load_patient_report(barcodes[0])
+
+    for name, repository_class in (("ORM ", ResultRepository), ("Core", CoreResultRepository)):
+        run(Session, repository_class, barcodes[:20])  # échauffement
+        elapsed = run(Session, repository_class, barcodes)
+        print(f"{name} : {args.iterations / elapsed:8.1f} pages/s  ({elapsed * 1000 / args.iterations:.2f} ms/page)")
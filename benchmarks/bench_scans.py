@@ -0,0 +1,71 @@
+"""
+Mesure la lecture des codes à barres à la réception : latence de résolution par
+BarcodeIndex et débit soutenu de ScanService (ScanLog écrits par lots) sur un cœur.
+
+Usage : python benchmarks/bench_scans.py sqlite:///bench_scans.db [--codes 100000 --duree 5]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, insert, select, func
+from models import Base, Barcode, ScanLog
+from scans import BarcodeIndex, ScanLogBuffer, ScanService
+
+
+def seed_barcodes(engine, nb_codes):
+    Base.metadata.drop_all(engine, tables=[Barcode.__table__, ScanLog.__table__])
+    Base.metadata.create_all(engine, tables=[Barcode.__table__, ScanLog.__table__])
+    with engine.begin() as conn:
+        conn.execute(insert(Barcode.__table__), [
+            {"barcode_value": f"ECH{i:09d}", "analyse_id": i // 3 + 1, "prelevement_type_id": i % 4 + 1,
+             "tube_id": i % 6 + 1}
+            for i in range(nb_codes)
+        ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database_url")
+    parser.add_argument("--codes", type=int, default=100000)
+    parser.add_argument("--duree", type=float, default=5.0)
+    parser.add_argument("--max-rows", type=int, default=500)
+    parser.add_argument("--max-delay", type=float, default=0.005)
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    seed_barcodes(engine, args.codes)
+    rnd = random.Random(0)
+    codes = [f"ECH{rnd.randrange(args.codes):09d}" for _ in range(100000)]
+
+    start = time.perf_counter()
+    index = BarcodeIndex(engine).load()
+    print(f"Chargement de l'index : {len(index)} codes en {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    latencies = []
+    for code in codes:
+        t = time.perf_counter()
+        index.lookup(code)
+        latencies.append(time.perf_counter() - t)
+    latencies.sort()
+    print(f"Résolution : p50 {latencies[len(latencies) // 2] * 1e6:.2f} µs, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.2f} µs")
+
+    buffer = ScanLogBuffer(engine, max_rows=args.max_rows, max_delay=args.max_delay)
+    service = ScanService(index, buffer)
+    nb_scans = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.duree:
+        service.scan(codes[nb_scans % len(codes)], operator_id=1)
+        nb_scans += 1
+    elapsed = time.perf_counter() - start
+    buffer.close()
+    total = time.perf_counter() - start
+    with engine.connect() as conn:
+        nb_logs = conn.execute(select(func.count()).select_from(ScanLog.__table__)).scalar()
+    print(f"{nb_scans} lectures en {elapsed:.1f}s ({nb_scans / elapsed:.0f} lectures/s), "
+          f"{nb_logs} ScanLog écrits en {buffer.nb_lots} lots ({nb_logs / total:.0f} lignes/s)")
@@ -0,0 +1,77 @@
+"""
+Test de charge comparant le service synchrone (app:application sous gunicorn)
+et le service asynchrone (asgi:application sous uvicorn) sur la même base.
+
+    python benchmarks/seed.py sqlite:///bench.db
+    DATABASE_URL=sqlite:///bench.db gunicorn -c gunicorn.conf.py -b 127.0.0.1:8000 app:application
+    DATABASE_URL=sqlite:///bench.db uvicorn asgi:application --port 8001
+    python benchmarks/load_test.py --target sync=http://127.0.0.1:8000 --target async=http://127.0.0.1:8001
+
+Le client n'utilise que la bibliothèque standard (asyncio) pour ne pas être le goulot.
+"""
+import argparse
+import asyncio
+import random
+import time
+from urllib.parse import urlsplit
+
+
+async def fetch(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode("ascii"))
+        await writer.drain()
+        data = await reader.read()
+    finally:
+        writer.close()
+    return int(data.split(b" ", 2)[1])
+
+
+async def run_target(url, paths, concurrency):
+    parts = urlsplit(url)
+    queue = asyncio.Queue()
+    for path in paths:
+        queue.put_nowait(path)
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            path = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                status = await fetch(parts.hostname, parts.port or 80, path)
+                if status >= 500:
+                    errors += 1
+            except OSError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "rps": len(paths) / elapsed,
+        "p50": latencies[len(latencies) // 2] * 1000,
+        "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "errors": errors,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", action="append", required=True, help="nom=http://hôte:port")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--patients", type=int, default=200, help="nombre de patients de la base seed.py")
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    paths = [f"/PAT{rnd.randrange(args.patients):05d}" for _ in range(args.requests)]
+    for target in args.target:
+        name, url = target.split("=", 1)
+        stats = asyncio.run(run_target(url, paths, args.concurrency))
+        print(f"{name:>8} : {stats['rps']:8.1f} req/s  p50 {stats['p50']:7.1f} ms  "
+              f"p99 {stats['p99']:7.1f} ms  erreurs {stats['errors']}")
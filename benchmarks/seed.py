@@ -0,0 +1,71 @@
+"""
+Création d'une base de données de démonstration pour les benchmarks.
+
+Usage : python benchmarks/seed.py sqlite:///bench.db --patients 200 --analyses 30 --resultats 12
+"""
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, insert
+from models import Base, Patient, Analyse, Resultat, Parameter
+
+
+def seed(engine, nb_patients=200, nb_analyses=30, nb_resultats=12, seed_value=42):
+    """Remplit la base avec des patients, analyses et résultats aléatoires (insertions en lot)."""
+    rnd = random.Random(seed_value)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    debut = datetime(2020, 1, 1)
+
+    with engine.begin() as conn:
+        conn.execute(insert(Parameter.__table__), [
+            {"parameter_id": i + 1, "param": f"Paramètre {i + 1}", "nom_param": f"P{i + 1}", "prix_u": 10.0}
+            for i in range(nb_resultats)
+        ])
+        conn.execute(insert(Patient.__table__), [
+            {
+                "id": f"P{p:05d}", "patient_barcode": f"PAT{p:05d}", "name": f"Nom{p}", "prenom": f"Prenom{p}",
+                "age": str(rnd.randint(1, 90)), "sexe": rnd.choice(("homme", "femme")),
+                "email": f"patient{p}@example.com", "tel": "0000000000", "adresse": "Adresse",
+            }
+            for p in range(nb_patients)
+        ])
+
+        analyses = []
+        resultats = []
+        analyse_id = 0
+        for p in range(nb_patients):
+            for a in range(nb_analyses):
+                analyse_id += 1
+                date_analyse = debut + timedelta(days=rnd.randint(0, 5 * 365))
+                analyses.append({
+                    "id": analyse_id, "patient_id": f"P{p:05d}", "dossier_barcode": f"DOS{analyse_id:08d}",
+                    "analyse_date": date_analyse, "facture": 100.0, "remise": 0.0, "fac_remise": 100.0,
+                    "prelevement": "Lab", "is_nfs": rnd.random() < 0.3, "is_groupage": rnd.random() < 0.1,
+                    "is_frottis": False, "is_spermo": False, "is_bacterio": rnd.random() < 0.2,
+                    "is_special": False, "is_autre_analyse": True, "is_soustraitance": False,
+                    "is_stamped": False, "is_convention": False,
+                })
+                for r in range(nb_resultats):
+                    resultats.append({
+                        "patient_id": f"P{p:05d}", "analyse_id": analyse_id, "parameter_id": r + 1,
+                        "valeur": round(rnd.uniform(0, 200), 2), "result_date": date_analyse + timedelta(hours=r),
+                    })
+        conn.execute(insert(Analyse.__table__), analyses)
+        conn.execute(insert(Resultat.__table__), resultats)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Crée une base de démonstration pour les benchmarks")
+    parser.add_argument("database_url")
+    parser.add_argument("--patients", type=int, default=200)
+    parser.add_argument("--analyses", type=int, default=30)
+    parser.add_argument("--resultats", type=int, default=12)
+    args = parser.parse_args()
+    seed(create_engine(args.database_url), args.patients, args.analyses, args.resultats)
+    print(f"Base créée : {args.database_url}")
@@ -0,0 +1,204 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+from models import (Analyse, Resultat, NumerationFormuleSanguine, GroupageSanguin, Frottis,
+                    SpermogrammeResult, BacterioResult)
+
+# Tables dont une écriture modifie la page résultats d'un patient
+RESULT_MODELS = (Resultat, Analyse, NumerationFormuleSanguine, GroupageSanguin, Frottis,
+                 SpermogrammeResult, BacterioResult)
+
+_PENDING_KEY = "resultats_patients_modifies"
+_PENDING_ANALYSES_KEY = "resultats_analyses_modifiees"
+_committed_callbacks = []
+
+
+class CacheBackend(ABC):
+    """Interface minimale d'un stockage de cache (mémoire, Redis, memcached...)."""
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def set(self, key, value):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+
+class LRUCacheBackend(CacheBackend):
+    """Cache en mémoire du processus avec éviction LRU et expiration (TTL en secondes)."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResultPageCache:
+    """
+    Cache des pages résultats, par patient et par version de contenu.
+
+    Avec LRUCacheBackend, le cache est propre à chaque worker et l'invalidation
+    (register_invalidation) ne voit que les commits ORM de ce processus. La
+    cohérence entre workers repose sur la version : une entrée n'est servie que si
+    sa version correspond à la version courante des résultats du patient (voir
+    CoreResultRepository.report_version, qui suit les comptes, identifiants et
+    updated_at). Une écriture SQL brute qui ne met pas updated_at à jour reste
+    visible au plus tard à l'expiration (TTL) de l'entrée.
+
+    Un numéro de séquence d'invalidation empêche de stocker une page calculée avant
+    une invalidation. Seules les max_invalidations dernières invalidations sont
+    gardées ; au-delà, une page calculée avant la plus récente invalidation oubliée
+    n'est simplement pas stockée.
+    """
+
+    def __init__(self, backend, max_invalidations=4096):
+        self.backend = backend
+        self.max_invalidations = max_invalidations
+        self._sequence = 0
+        self._invalidations = OrderedDict()  # patient_id -> séquence de la dernière invalidation
+        self._forgotten = 0  # plus haute séquence évincée de _invalidations
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(patient_id):
+        return f"resultats:{patient_id}"
+
+    def generation(self, patient_id):
+        """Jeton à prendre avant de calculer la page, puis à passer à set()."""
+        return self._sequence
+
+    def get(self, patient_id, version):
+        entry = self.backend.get(self.key(patient_id))
+        if entry is None or entry[0] != version:
+            return None
+        return entry[1]
+
+    def set(self, patient_id, version, value, generation):
+        with self._lock:
+            if generation < max(self._invalidations.get(patient_id, 0), self._forgotten):
+                return
+            self.backend.set(self.key(patient_id), (version, value))
+
+    def invalidate(self, patient_id):
+        with self._lock:
+            self._sequence += 1
+            self._invalidations[patient_id] = self._sequence
+            self._invalidations.move_to_end(patient_id)
+            while len(self._invalidations) > self.max_invalidations:
+                _, self._forgotten = self._invalidations.popitem(last=False)
+            self.backend.delete(self.key(patient_id))
+
+
+def _track_change(mapper, connection, target):
+    # Les lignes rattachées seulement à une analyse sont résolues en une requête à la fin du flush
+    session = object_session(target)
+    if session is None:
+        return
+    patient_id = getattr(target, "patient_id", None)
+    if patient_id is not None:
+        session.info.setdefault(_PENDING_KEY, set()).add(patient_id)
+    elif getattr(target, "analyse_id", None) is not None:
+        session.info.setdefault(_PENDING_ANALYSES_KEY, set()).add(target.analyse_id)
+
+
+def _resolve_analyses(session, flush_context):
+    analyse_ids = session.info.pop(_PENDING_ANALYSES_KEY, None)
+    if analyse_ids:
+        analyses = Analyse.__table__
+        session.info.setdefault(_PENDING_KEY, set()).update(session.connection().execute(
+            select(analyses.c.patient_id).where(analyses.c.id.in_(list(analyse_ids)))
+        ).scalars())
+
+
+def on_results_committed(callback):
+    """
+    Appelle callback(patient_ids) après chaque commit ayant modifié des résultats :
+    les patients touchés par un after_insert/after_update sur les tables de
+    résultats sont collectés pendant le flush (une requête IN par flush pour les
+    lignes rattachées seulement à une analyse), puis transmis une fois la
+    transaction validée (rien n'est transmis en cas de rollback).
+    """
+    if not _committed_callbacks:
+        for model in RESULT_MODELS:
+            event.listen(model, "after_insert", _track_change)
+            event.listen(model, "after_update", _track_change)
+        event.listen(Session, "after_flush", _resolve_analyses)
+        event.listen(Session, "after_commit", _after_commit)
+        event.listen(Session, "after_rollback", _after_rollback)
+    _committed_callbacks.append(callback)
+    return callback
+
+
+def mark_results_changed(session, patient_ids):
+    """
+    Signale des résultats modifiés hors des événements ORM (UPDATE en masse) : les
+    patients sont transmis aux callbacks avec les autres, après le commit de la session.
+    """
+    if _committed_callbacks:
+        session.info.setdefault(_PENDING_KEY, set()).update(patient_ids)
+
+
+def _after_commit(session):
+    patient_ids = session.info.pop(_PENDING_KEY, None)
+    if patient_ids:
+        for callback in _committed_callbacks:
+            callback(patient_ids)
+
+
+def _after_rollback(session):
+    session.info.pop(_PENDING_KEY, None)
+    session.info.pop(_PENDING_ANALYSES_KEY, None)
+
+
+def register_invalidation(page_cache):
+    """Invalide le cache des pages résultats des patients modifiés, après commit."""
+
+    def _invalidate(patient_ids):
+        for patient_id in patient_ids:
+            page_cache.invalidate(patient_id)
+
+    on_results_committed(_invalidate)
+    return page_cache
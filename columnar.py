@@ -0,0 +1,221 @@
+"""
+Export colonnaire des résultats pour l'analytique (épidémiologie, statistiques).
+
+Les NFS (une ligne large par analyse) et les Resultat (une ligne par paramètre)
+sont exportés en tableaux structurés NumPy (.npy), un fichier par table et par
+mois de résultat :
+
+    <export_dir>/nfs/2024-05.npy
+    <export_dir>/resultat/2024-05.npy
+
+Les lignes sont lues en flux par lots (stream_results), converties en colonnes et
+ajoutées au fichier du mois ; la mémoire ne dépend que de la taille des lots. Les
+ratios nlr, plr et mlr ne sont pas lus en base mais recalculés, vectorisés, à
+l'export. Les fichiers se relisent par projection mémoire (np.load(mmap_mode='r')),
+sans PostgreSQL. Un tableau structuré est stocké ligne par ligne : extraire une
+colonne lit quand même toutes les pages du mois, seule la copie en mémoire est
+limitée aux colonnes demandées (le partitionnement mensuel borne ce qui est lu).
+
+Chaque export réécrit les mois rencontrés et supprime, dans l'intervalle exporté
+(tout le répertoire sans bornes), les partitions des mois qui n'ont plus de lignes.
+
+Usage : python columnar.py export exports/ [--debut 2024-01-01 --fin 2024-07-01]
+        python columnar.py resume exports/
+"""
+import argparse
+import glob
+import logging
+import os
+import shutil
+import time
+from datetime import date, datetime
+import numpy as np
+from sqlalchemy import select, func
+from hematology import nfs_ratios
+from models import Analyse, NumerationFormuleSanguine, Patient, Resultat
+from references import age_in_years, normalize_sexe
+
+logger = logging.getLogger(__name__)
+
+TABLE_NFS = "nfs"
+TABLE_RESULTAT = "resultat"
+TABLES = (TABLE_NFS, TABLE_RESULTAT)
+
+# Codes sexe des colonnes exportées (mêmes que ReferenceIndex.SEXE_CODES)
+SEXE_CODES = {"homme": 0, "femme": 1}
+
+NFS_MEASURES = ("hemoglobine", "hematocrite", "globules_rouges", "globules_blancs", "plaquettes", "vgm", "tcmh",
+                "ccmh", "rdw", "reticulocytes", "ipr", "neutrophiles", "eosinophiles", "basophiles", "lymphocytes",
+                "monocytes", "vpm", "pdw", "ipf", "ret_he", "indice_hypochrome", "irf")
+NFS_RATIOS = ("nlr", "plr", "mlr")
+
+COMMON_FIELDS = [("id", "i8"), ("analyse_id", "i8"), ("patient_id", "U32"), ("date", "datetime64[s]"),
+                 ("sexe", "i1"), ("age", "f4")]
+DTYPES = {
+    TABLE_NFS: np.dtype(COMMON_FIELDS + [(name, "f8") for name in NFS_MEASURES + NFS_RATIOS]),
+    TABLE_RESULTAT: np.dtype(COMMON_FIELDS + [("parameter_id", "i4"), ("valeur", "f8")]),
+}
+
+
+def _export_query(table, debut=None, fin=None):
+    analyses = Analyse.__table__
+    patients = Patient.__table__
+    if table == TABLE_NFS:
+        source = NumerationFormuleSanguine.__table__
+        result_date = source.c.date_resultat
+        measures = [source.c[name] for name in NFS_MEASURES]
+    else:
+        source = Resultat.__table__
+        result_date = source.c.result_date
+        measures = [source.c.parameter_id, source.c.valeur]
+    # Date du résultat, à défaut celle de l'analyse : c'est elle qui fixe la partition
+    jour = func.coalesce(result_date, analyses.c.analyse_date)
+    query = (
+        select(source.c.id, source.c.analyse_id, analyses.c.patient_id, jour.label("date"),
+               patients.c.sexe, patients.c.age, patients.c.age_unit, *measures)
+        .join(analyses, analyses.c.id == source.c.analyse_id)
+        .join(patients, patients.c.id == analyses.c.patient_id)
+    )
+    if debut is not None:
+        query = query.where(jour >= debut)
+    if fin is not None:
+        query = query.where(jour < fin)
+    return query
+
+
+def to_columns(table, rows):
+    """Convertit un lot de lignes de _export_query en tableau structuré (ratios NFS calculés)."""
+    array = np.empty(len(rows), dtype=DTYPES[table])
+    columns = list(zip(*rows))
+    array["id"] = columns[0]
+    array["analyse_id"] = columns[1]
+    array["patient_id"] = columns[2]
+    array["date"] = np.array(columns[3], dtype="datetime64[s]")
+    array["sexe"] = [SEXE_CODES.get(normalize_sexe(sexe), -1) for sexe in columns[4]]
+    array["age"] = [age_in_years(age, unit) for age, unit in zip(columns[5], columns[6])]
+    if table == TABLE_NFS:
+        for name, values in zip(NFS_MEASURES, columns[7:]):
+            array[name] = np.array(values, dtype=np.float64)  # None -> NaN
+        array["nlr"], array["plr"], array["mlr"] = nfs_ratios(
+            array["neutrophiles"], array["lymphocytes"], array["monocytes"], array["plaquettes"],
+            array["globules_blancs"])
+    else:
+        array["parameter_id"] = columns[7]
+        array["valeur"] = np.array(columns[8], dtype=np.float64)
+    return array
+
+
+def partition_path(export_dir, table, month):
+    return os.path.join(export_dir, table, f"{month}.npy")
+
+
+def _finalize(export_dir, table, month, raw_path, count):
+    """Écrit l'en-tête .npy puis les données brutes du mois, et remplace le fichier de façon atomique."""
+    path = partition_path(export_dir, table, month)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as out, open(raw_path, "rb") as raw:
+        np.lib.format.write_array_header_1_0(out, {"descr": np.lib.format.dtype_to_descr(DTYPES[table]),
+                                                   "fortran_order": False, "shape": (count,)})
+        shutil.copyfileobj(raw, out, 1 << 20)
+    os.replace(temporary, path)
+    os.unlink(raw_path)
+
+
+def export_table(connection, table, export_dir, debut=None, fin=None, chunk_size=50000):
+    """
+    Exporte une table dans ses partitions mensuelles. Les mois rencontrés sont
+    réécrits en entier et les partitions de [debut, fin[ sans lignes sont supprimées :
+    avec debut / fin, donner des bornes de mois. Retourne {mois: nombre de lignes}.
+    """
+    start = time.perf_counter()
+    os.makedirs(os.path.join(export_dir, table), exist_ok=True)
+    # Restes d'un export interrompu
+    for raw_path in glob.glob(os.path.join(export_dir, table, "*.part")):
+        os.unlink(raw_path)
+    counts = {}
+    result = connection.execution_options(stream_results=True).execute(_export_query(table, debut, fin))
+    for rows in result.partitions(chunk_size):
+        array = to_columns(table, rows)
+        months = array["date"].astype("datetime64[M]")
+        for month in np.unique(months):
+            rows_of_month = array[months == month]
+            with open(partition_path(export_dir, table, str(month)) + ".part", "ab") as raw:
+                raw.write(rows_of_month.tobytes())
+            counts[str(month)] = counts.get(str(month), 0) + len(rows_of_month)
+    for month, count in counts.items():
+        _finalize(export_dir, table, month, partition_path(export_dir, table, month) + ".part", count)
+    # Mois qui n'ont plus de données (résultats supprimés ou redatés depuis le dernier export)
+    stale = [month for month in partitions(export_dir, table, debut, fin) if month not in counts]
+    for month in stale:
+        os.unlink(partition_path(export_dir, table, month))
+    if stale:
+        logger.info(f"{table} : {len(stale)} partitions sans données supprimées ({', '.join(stale)})")
+    logger.info(f"{table} : {sum(counts.values())} lignes exportées dans {len(counts)} partitions "
+                f"en {time.perf_counter() - start:.1f}s")
+    return counts
+
+
+def export(engine, export_dir, debut=None, fin=None, chunk_size=50000):
+    """Exporte NFS et Resultat. Retourne {table: {mois: nombre de lignes}}."""
+    with engine.connect() as connection:
+        return {table: export_table(connection, table, export_dir, debut, fin, chunk_size) for table in TABLES}
+
+
+# --- Lecture (sans base de données) ---
+
+def partitions(export_dir, table, debut=None, fin=None):
+    """Mois exportés pour la table, triés, limités à [debut, fin[ (dates ou 'AAAA-MM')."""
+    debut = str(np.datetime64(debut, "M")) if debut is not None else None
+    fin = str(np.datetime64(fin, "M")) if fin is not None else None
+    months = sorted(os.path.basename(path)[:-4] for path in glob.glob(os.path.join(export_dir, table, "*.npy")))
+    return [month for month in months if (debut is None or month >= debut) and (fin is None or month < fin)]
+
+
+def open_partition(export_dir, table, month):
+    """Tableau structuré d'un mois, projeté en mémoire (lecture seule)."""
+    return np.load(partition_path(export_dir, table, month), mmap_mode="r")
+
+
+def load(export_dir, table, debut=None, fin=None, columns=None):
+    """
+    Concatène les partitions de [debut, fin[ ; avec columns, seules ces colonnes
+    sont copiées en mémoire (les fichiers, stockés ligne par ligne, sont lus en entier).
+    """
+    arrays = []
+    for month in partitions(export_dir, table, debut, fin):
+        array = open_partition(export_dir, table, month)
+        if columns is not None:
+            array = np.rec.fromarrays([array[name] for name in columns], names=list(columns))
+        arrays.append(array)
+    if not arrays:
+        dtype = DTYPES[table] if columns is None else np.dtype([(name, DTYPES[table][name]) for name in columns])
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(arrays)
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from database import create_engine_from_env
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Export colonnaire (NumPy) des NFS et résultats")
+    parser.add_argument("command", choices=["export", "resume"])
+    parser.add_argument("export_dir")
+    parser.add_argument("--debut", type=date.fromisoformat, default=None)
+    parser.add_argument("--fin", type=date.fromisoformat, default=None)
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        engine = create_engine_from_env(os.getenv("DATABASE_URL"))
+        debut = datetime.combine(args.debut, datetime.min.time()) if args.debut else None
+        fin = datetime.combine(args.fin, datetime.min.time()) if args.fin else None
+        export(engine, args.export_dir, debut, fin, args.chunk_size)
+    for table in TABLES:
+        for month in partitions(args.export_dir, table, args.debut, args.fin):
+            array = open_partition(args.export_dir, table, month)
+            line = f"{table} {month} : {len(array)} lignes"
+            if table == TABLE_NFS and np.isfinite(array["nlr"]).any():
+                line += f", nlr médian {np.nanmedian(array['nlr']):.2f}"
+            print(line)
@@ -0,0 +1,207 @@
+"""
+Décompte des réactifs consommés et alertes de stock.
+
+Chaque AnalyseDetail avec un product_id consomme un test du réactif. Plutôt qu'une
+mise à jour de products par test (qui bloque la même ligne à chaque analyse), les
+détails non encore décomptés (consumed_at nul) sont traités par lots : agrégation du
+nombre de tests par produit, puis un seul UPDATE par produit et par lot, dans l'ordre
+des identifiants pour éviter les interblocages. Sur PostgreSQL, les lots sont pris
+avec SKIP LOCKED : plusieurs processus peuvent décompter en parallèle. Les détails sans
+produit sont marqués décomptés sans toucher au stock, pour sortir de la file.
+
+Product.quantity_remaining est exprimé en tests ; une alerte est levée quand il
+passe sous min_threshold, ou quand un lot arrive à péremption (index sur expiration).
+
+Migration : à l'ajout de la colonne consumed_at, tous les détails existants sont nuls et
+le premier décompte retirerait du stock tout l'historique du laboratoire. Avant de lancer
+`run` ou `drain` sur une base existante, marquer l'historique comme déjà décompté :
+`python consumption.py backfill [--avant AAAA-MM-JJ]` (par défaut, tous les détails actuels).
+La file est servie par l'index partiel idx_analyse_detail_consumed_at (consumed_at nul).
+
+Usage : python consumption.py run [--interval 30] | drain | backfill [--avant AAAA-MM-JJ] | alerts [--jours 30]
+"""
+import argparse
+import logging
+import math
+import os
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, bindparam, case
+from models import Analyse, AnalyseDetail, Product
+
+logger = logging.getLogger(__name__)
+
+ALERTE_STOCK_BAS, ALERTE_PEREMPTION, ALERTE_PERIME = "stock_bas", "peremption", "perime"
+
+StockAlert = namedtuple("StockAlert", ["product_id", "marque", "lot", "quantity_remaining", "min_threshold",
+                                       "flacons_restants", "expiration", "motif"])
+
+DEFAULT_EXPIRY_DAYS = 30
+
+
+def _alert(row, motif, quantity_remaining=None):
+    if quantity_remaining is None:
+        quantity_remaining = row.quantity_remaining
+    flacons = math.ceil(quantity_remaining / row.nb_test) if row.nb_test else None
+    return StockAlert(row.id, row.marque, row.lot, quantity_remaining, row.min_threshold, flacons,
+                      row.expiration, motif)
+
+
+def _product_columns(products):
+    return (products.c.id, products.c.marque, products.c.lot, products.c.quantity_remaining,
+            products.c.min_threshold, products.c.nb_test, products.c.expiration)
+
+
+def stock_alerts(connection, jours=DEFAULT_EXPIRY_DAYS, now=None):
+    """
+    Alertes courantes : lots périmés ou périmant dans `jours` jours (parcours de
+    l'index idx_product_expiration) et produits sous leur seuil minimum.
+    """
+    now = now or datetime.now()
+    products = Product.__table__
+    alerts = []
+    for row in connection.execute(
+            select(*_product_columns(products))
+            .where(products.c.expiration < now + timedelta(days=jours))
+            .where(products.c.quantity_remaining > 0)
+            .order_by(products.c.expiration)):
+        alerts.append(_alert(row, ALERTE_PERIME if row.expiration < now else ALERTE_PEREMPTION))
+    for row in connection.execute(
+            select(*_product_columns(products))
+            .where(products.c.quantity_remaining <= products.c.min_threshold)
+            .order_by(products.c.id)):
+        alerts.append(_alert(row, ALERTE_STOCK_BAS))
+    return alerts
+
+
+def backfill(connection, before=None, now=None):
+    """
+    Marque comme déjà décomptés les détails en attente (tous, ou ceux des analyses
+    antérieures à `before`) sans toucher au stock : à lancer une fois à la migration.
+    Retourne le nombre de détails marqués.
+    """
+    now = now or datetime.now()
+    details = AnalyseDetail.__table__
+    stmt = update(details).where(details.c.consumed_at.is_(None)).values(consumed_at=now)
+    if before is not None:
+        analyses = Analyse.__table__
+        stmt = stmt.where(details.c.analyse_id.in_(
+            select(analyses.c.id).where(analyses.c.analyse_date < before)))
+    count = connection.execute(stmt).rowcount
+    logger.info(f"{count} détails existants marqués comme décomptés")
+    return count
+
+
+class ConsumptionEngine:
+    """Décompte par lots les tests de AnalyseDetail dans Product.quantity_remaining."""
+
+    def __init__(self, engine, batch_size=5000):
+        self.engine = engine
+        self.batch_size = batch_size
+
+    def consume_batch(self, connection, now=None):
+        """
+        Décompte un lot de détails dans la transaction de la connexion ; les détails
+        sans produit sont marqués sans décompte. Retourne (nombre de détails traités,
+        alertes de stock bas levées par ce lot).
+        """
+        now = now or datetime.now()
+        details = AnalyseDetail.__table__
+        products = Product.__table__
+        rows = connection.execute(
+            select(details.c.id, details.c.product_id)
+            .where(details.c.consumed_at.is_(None))
+            .order_by(details.c.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if not rows:
+            return 0, []
+
+        usage = Counter(product_id for _, product_id in rows if product_id is not None)
+        # Verrouille les produits du lot dans l'ordre des identifiants (pas d'interblocage)
+        before = connection.execute(
+            select(*_product_columns(products))
+            .where(products.c.id.in_(list(usage)))
+            .order_by(products.c.id)
+            .with_for_update()
+        ).all()
+        if usage:
+            remaining = products.c.quantity_remaining - bindparam("b_tests")
+            connection.execute(
+                update(products)
+                .where(products.c.id == bindparam("b_id"))
+                .values(quantity_remaining=case((remaining > 0, remaining), else_=0)),
+                [{"b_id": product_id, "b_tests": tests} for product_id, tests in sorted(usage.items())],
+            )
+        connection.execute(
+            update(details)
+            .where(details.c.id.in_([detail_id for detail_id, _ in rows]))
+            .values(consumed_at=now)
+        )
+
+        # Produits de ce lot qui viennent de franchir leur seuil
+        alerts = []
+        for row in before:
+            after = max(0, row.quantity_remaining - usage[row.id])
+            if after <= row.min_threshold < row.quantity_remaining:
+                alerts.append(_alert(row, ALERTE_STOCK_BAS, after))
+        for alert in alerts:
+            logger.warning(f"Stock bas : {alert.marque} lot {alert.lot} ({alert.product_id}), "
+                           f"{alert.quantity_remaining} tests restants (seuil {alert.min_threshold})")
+        return len(rows), alerts
+
+    def drain(self):
+        """Décompte tous les détails en attente, un lot par transaction. Retourne le nombre décompté."""
+        total = 0
+        while True:
+            with self.engine.begin() as connection:
+                count, _ = self.consume_batch(connection)
+            total += count
+            if count < self.batch_size:
+                return total
+
+    def run(self, interval=30):
+        """Boucle de décompte : vide la file puis attend `interval` secondes."""
+        while True:
+            start = time.perf_counter()
+            try:
+                count = self.drain()
+                if count:
+                    logger.info(f"{count} tests décomptés en {time.perf_counter() - start:.2f}s")
+            except Exception as e:
+                logger.error(f"Erreur lors du décompte des réactifs : {str(e)}")
+            time.sleep(interval)
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from database import create_engine_from_env
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Décompte des réactifs et alertes de stock")
+    parser.add_argument("command", choices=["run", "drain", "backfill", "alerts"])
+    parser.add_argument("--interval", type=int, default=30)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--jours", type=int, default=DEFAULT_EXPIRY_DAYS)
+    parser.add_argument("--avant", type=datetime.fromisoformat, default=None,
+                        help="backfill : seulement les analyses antérieures à cette date")
+    args = parser.parse_args()
+
+    engine = create_engine_from_env(os.getenv("DATABASE_URL"))
+    consumption = ConsumptionEngine(engine, batch_size=args.batch_size)
+    if args.command == "run":
+        consumption.run(args.interval)
+    elif args.command == "drain":
+        print(f"{consumption.drain()} tests décomptés")
+    elif args.command == "backfill":
+        with engine.begin() as connection:
+            print(f"{backfill(connection, args.avant)} détails marqués comme décomptés")
+    else:
+        with engine.connect() as connection:
+            for alert in stock_alerts(connection, args.jours):
+                print(f"[{alert.motif}] {alert.marque} lot {alert.lot} : {alert.quantity_remaining} tests "
+                      f"({alert.flacons_restants} flacons), seuil {alert.min_threshold}, "
+                      f"péremption {alert.expiration:%d/%m/%Y}")
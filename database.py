@@ -0,0 +1,375 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+
+def env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def env_float(name, default):
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+
+def env_bool(name, default):
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "oui", "on")
+
+
+class PoolMetrics:
+    """
+    Métriques du pool de connexions : connexions empruntées, débordement
+    (overflow) et histogramme du temps d'attente pour obtenir une connexion.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checked_out = 0
+        self.checkouts = 0
+        self.connections_opened = 0
+        self.wait_counts = [0] * (len(self.BUCKETS) + 1)
+        self.wait_sum = 0.0
+        self.wait_count = 0
+
+    def observe_wait(self, seconds):
+        with self._lock:
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    self.wait_counts[i] += 1
+                    break
+            else:
+                self.wait_counts[-1] += 1
+            self.wait_sum += seconds
+            self.wait_count += 1
+
+    def attach(self, engine):
+        """Branche les compteurs sur les événements du pool de l'engine."""
+
+        @event.listens_for(engine, "connect")
+        def _connect(dbapi_connection, connection_record):
+            with self._lock:
+                self.connections_opened += 1
+
+        @event.listens_for(engine, "checkout")
+        def _checkout(dbapi_connection, connection_record, connection_proxy):
+            with self._lock:
+                self.checked_out += 1
+                self.checkouts += 1
+
+        @event.listens_for(engine, "checkin")
+        def _checkin(dbapi_connection, connection_record):
+            with self._lock:
+                self.checked_out = max(0, self.checked_out - 1)
+
+        pool = engine.pool
+        if isinstance(pool, InstrumentedQueuePool):
+            pool.metrics = self
+        return self
+
+    def snapshot(self, engine):
+        pool = engine.pool
+        with self._lock:
+            data = {
+                "checked_out": self.checked_out,
+                "checkouts_total": self.checkouts,
+                "connections_opened_total": self.connections_opened,
+                "wait_buckets": list(zip(self.BUCKETS + (float("inf"),), self.wait_counts)),
+                "wait_sum": self.wait_sum,
+                "wait_count": self.wait_count,
+            }
+        if isinstance(pool, QueuePool):
+            data["pool_size"] = pool.size()
+            data["overflow"] = max(0, pool.overflow())
+        return data
+
+    def render_prometheus(self, engine):
+        """Exporte les métriques au format texte Prometheus."""
+        return render_pool_metrics([(None, engine, self)])
+
+
+def render_pool_metrics(pools):
+    """
+    Exporte au format texte Prometheus les métriques de plusieurs pools,
+    pools = [(nom, engine, PoolMetrics)] ; le nom devient le label pool (aucun label si None).
+    """
+    snapshots = [(name, metrics.snapshot(engine)) for name, engine, metrics in pools]
+
+    def _labels(name, **extra):
+        labels = ({"pool": name} if name is not None else {})
+        labels.update(extra)
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}" if labels else ""
+
+    lines = []
+    for metric, kind, key in (("db_pool_checked_out", "gauge", "checked_out"),
+                              ("db_pool_checkouts_total", "counter", "checkouts_total"),
+                              ("db_pool_connections_opened_total", "counter", "connections_opened_total"),
+                              ("db_pool_size", "gauge", "pool_size"),
+                              ("db_pool_overflow", "gauge", "overflow")):
+        samples = [f"{metric}{_labels(name)} {data[key]}" for name, data in snapshots if key in data]
+        if samples:
+            lines.append(f"# TYPE {metric} {kind}")
+            lines += samples
+    lines.append("# TYPE db_pool_checkout_wait_seconds histogram")
+    for name, data in snapshots:
+        cumulative = 0
+        for bound, count in data["wait_buckets"]:
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else f"{bound}"
+            lines.append(f"db_pool_checkout_wait_seconds_bucket{_labels(name, le=le)} {cumulative}")
+        lines.append(f"db_pool_checkout_wait_seconds_sum{_labels(name)} {data['wait_sum']}")
+        lines.append(f"db_pool_checkout_wait_seconds_count{_labels(name)} {data['wait_count']}")
+    return "\n".join(lines) + "\n"
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool qui mesure le temps d'attente de chaque emprunt de connexion."""
+
+    metrics = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_wait(time.perf_counter() - start)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+def pool_options_from_env(database_url):
+    """
+    Options du pool réglables par variables d'environnement :
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING.
+    SQLite garde le pool par défaut de SQLAlchemy.
+    """
+    options = {"pool_pre_ping": env_bool("DB_POOL_PRE_PING", True)}
+    if not database_url.startswith("sqlite"):
+        options.update(
+            pool_size=env_int("DB_POOL_SIZE", 5),
+            max_overflow=env_int("DB_MAX_OVERFLOW", 10),
+            pool_timeout=env_int("DB_POOL_TIMEOUT", 30),
+            pool_recycle=env_int("DB_POOL_RECYCLE", 1800),
+        )
+    return options
+
+
+def create_engine_from_env(database_url, **kwargs):
+    """Crée l'engine avec le pool configuré par pool_options_from_env, instrumenté hors SQLite."""
+    options = pool_options_from_env(database_url)
+    if not database_url.startswith("sqlite"):
+        options["poolclass"] = InstrumentedQueuePool
+    options.update(kwargs)
+    return create_engine(database_url, **options)
+
+
+# Retard de rejeu d'un réplica, en secondes : 0 s'il a rejoué tout ce qu'il a reçu,
+# NULL s'il n'est pas en réplication en flux (serveur hors recovery, ou restauration
+# depuis l'archive sans WAL reçu) : réplica à considérer comme en retard. Seules des
+# fonctions accessibles à tout rôle sont utilisées (pg_stat_wal_receiver ne renvoie
+# rien sans pg_read_all_stats). Limite : un réplica déconnecté qui a rejoué tout ce
+# qu'il avait reçu est vu à jour ; la supervision de la réplication reste nécessaire.
+REPLICA_LAG_SQL = {
+    "postgresql": (
+        "SELECT CASE"
+        " WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() IS NULL THEN NULL"
+        " WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+        " ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+    ),
+}
+
+
+class PrimaryRequired(Exception):
+    """Levée pendant une lecture sur réplica lorsque seule la base primaire est à jour."""
+
+
+class ReplicaRouter:
+    """
+    Route les lectures vers les réplicas (tourniquet) et les écritures vers le primaire.
+
+    Un réplica en erreur est écarté pendant retry_interval secondes puis re-testé
+    (SELECT 1) avant d'être réutilisé ; sans réplica disponible, on lit sur le primaire.
+
+    Les résultats sont surtout écrits par d'autres processus (import, listener,
+    validation) : un réplica n'est donc utilisé que si son retard de réplication
+    (REPLICA_LAG_SQL, mesuré au plus toutes les lag_check_interval secondes) ne
+    dépasse pas max_lag secondes. Une page lue juste après une écriture externe a
+    ainsi au plus max_lag + lag_check_interval secondes de retard. Après une écriture
+    de résultats dans ce processus, les lectures du patient restent en plus sur le
+    primaire pendant read_your_writes secondes (voir mark_written et PrimaryRequired).
+    """
+
+    def __init__(self, primary, replicas=(), retry_interval=30, read_your_writes=5, max_lag=1.0,
+                 lag_check_interval=1.0):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.retry_interval = retry_interval
+        self.read_your_writes = read_your_writes
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.session_factory = sessionmaker()
+        # Métriques des pools des réplicas (voir create_router_from_env et metric_pools)
+        self.pool_metrics = {}
+        self._cycle = itertools.cycle(self.replicas) if self.replicas else None
+        self._down_until = {}
+        self._lags = {}
+        self._lag_unknown_warned = set()
+        self._written_at = {}
+        self._lock = threading.Lock()
+
+    @property
+    def engines(self):
+        """Primaire puis réplicas (ex. pour abandonner tous les pools après un fork)."""
+        return [self.primary] + self.replicas
+
+    def metric_pools(self):
+        """Pools des réplicas instrumentés, pour render_pool_metrics : [(nom, engine, PoolMetrics)]."""
+        return [(f"replica{i}", engine, self.pool_metrics[engine])
+                for i, engine in enumerate(self.replicas, 1) if engine in self.pool_metrics]
+
+    def mark_down(self, engine):
+        with self._lock:
+            self._down_until[engine] = time.monotonic() + self.retry_interval
+        logger.warning(f"Réplica indisponible, écarté pendant {self.retry_interval}s : {engine.url!r}")
+
+    def _is_healthy(self, engine):
+        down_until = self._down_until.get(engine)
+        if down_until is None:
+            return True
+        if time.monotonic() < down_until:
+            return False
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        except OperationalError:
+            self.mark_down(engine)
+            return False
+        with self._lock:
+            self._down_until.pop(engine, None)
+        logger.info(f"Réplica de nouveau disponible : {engine.url!r}")
+        return True
+
+    def _lag(self, engine):
+        """Retard de réplication du réplica en secondes (None si inconnu), mis en cache lag_check_interval s."""
+        now = time.monotonic()
+        checked = self._lags.get(engine)
+        if checked is not None and now - checked[0] < self.lag_check_interval:
+            return checked[1]
+        sql = REPLICA_LAG_SQL.get(engine.dialect.name)
+        if sql is None:
+            # Pas de mesure pour ce dialecte (ex. SQLite en développement) : réplica supposé à jour
+            lag = 0.0
+        else:
+            with engine.connect() as connection:
+                lag = connection.execute(text(sql)).scalar()
+            lag = float(lag) if lag is not None else None
+        if lag is None and engine not in self._lag_unknown_warned:
+            self._lag_unknown_warned.add(engine)
+            logger.warning(f"Retard de réplication inconnu (serveur hors recovery ou sans WAL reçu), "
+                           f"lectures sur le primaire : {engine.url!r}")
+        with self._lock:
+            self._lags[engine] = (now, lag)
+        return lag
+
+    def _is_fresh(self, engine):
+        try:
+            lag = self._lag(engine)
+        except OperationalError:
+            self.mark_down(engine)
+            return False
+        if lag is None or lag > self.max_lag:
+            retard = "inconnu" if lag is None else f"{lag:.1f}s"
+            logger.info(f"Réplica en retard ({retard}), lecture sur le primaire : {engine.url!r}")
+            return False
+        return True
+
+    def read_engine(self):
+        """Choisit le prochain réplica disponible et à jour, ou le primaire à défaut."""
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                engine = next(self._cycle)
+            if self._is_healthy(engine) and self._is_fresh(engine):
+                return engine
+        return self.primary
+
+    def mark_written(self, patient_ids):
+        now = time.monotonic()
+        with self._lock:
+            for patient_id in patient_ids:
+                self._written_at[patient_id] = now
+            # Purge des patients sortis de la fenêtre
+            if len(self._written_at) > 10000:
+                limit = now - self.read_your_writes
+                self._written_at = {key: at for key, at in self._written_at.items() if at >= limit}
+
+    def check_read_your_writes(self, session, patient_id):
+        """Lève PrimaryRequired si la session lit un réplica alors que le patient vient d'être modifié."""
+        if session.bind is self.primary or not self.read_your_writes:
+            return
+        written_at = self._written_at.get(patient_id)
+        if written_at is not None and time.monotonic() - written_at < self.read_your_writes:
+            raise PrimaryRequired(patient_id)
+
+    def write_session(self):
+        return self.session_factory(bind=self.primary)
+
+    def read(self, work):
+        """
+        Exécute work(session) en lecture sur un réplica et rejoue sur le primaire
+        si le réplica échoue ou si work lève PrimaryRequired.
+        """
+        engine = self.read_engine()
+        if engine is not self.primary:
+            session = self.session_factory(bind=engine)
+            try:
+                return work(session)
+            except PrimaryRequired:
+                pass
+            except OperationalError:
+                self.mark_down(engine)
+            finally:
+                session.close()
+
+        session = self.session_factory(bind=self.primary)
+        try:
+            return work(session)
+        finally:
+            session.close()
+
+
+def create_router_from_env(primary, **kwargs):
+    """
+    Construit le ReplicaRouter à partir de DATABASE_REPLICA_URLS (URLs séparées
+    par des virgules), DB_REPLICA_RETRY_SECONDS, DB_READ_YOUR_WRITES_SECONDS,
+    DB_REPLICA_MAX_LAG_SECONDS et DB_REPLICA_LAG_CHECK_SECONDS. Les pools des
+    réplicas sont instrumentés comme celui du primaire (PoolMetrics).
+    """
+    urls = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+    replicas = [create_engine_from_env(url, **kwargs) for url in urls]
+    router = ReplicaRouter(
+        primary,
+        replicas=replicas,
+        retry_interval=env_int("DB_REPLICA_RETRY_SECONDS", 30),
+        read_your_writes=env_int("DB_READ_YOUR_WRITES_SECONDS", 5),
+        max_lag=env_float("DB_REPLICA_MAX_LAG_SECONDS", 1.0),
+        lag_check_interval=env_float("DB_REPLICA_LAG_CHECK_SECONDS", 1.0),
+    )
+    router.pool_metrics = {engine: PoolMetrics().attach(engine) for engine in replicas}
+    return router
@@ -0,0 +1,17 @@
+# Configuration gunicorn : gunicorn -c gunicorn.conf.py app:application
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() in ("1", "true", "yes")
+
+
+def post_fork(server, worker):
+    """
+    Avec preload_app, le worker hérite des pools de connexions du processus maître
+    (primaire et réplicas) : on les abandonne sans fermer les connexions du parent
+    pour que chaque worker ouvre ses propres connexions.
+    """
+    import app
+    for engine in app.router.engines:
+        engine.dispose(close=False)
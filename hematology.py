@@ -0,0 +1,193 @@
+"""
+Indices dérivés de la numération formule sanguine (NFS).
+
+vgm, tcmh, ccmh, nlr, plr, mlr et ipr se calculent à partir des mesures primaires
+(hémoglobine, hématocrite, globules rouges et blancs, formule leucocytaire,
+plaquettes, réticulocytes). Les formules sont vectorisées (NumPy) et servent :
+
+- à l'écriture : register_derivation() calcule les indices de chaque NFS insérée ou
+  modifiée par l'ORM, juste avant le flush ;
+- au retraitement de l'historique (après correction d'une formule) : recompute()
+  parcourt la table par tranches d'identifiants, calcule une tranche entière en une
+  passe vectorisée et écrit les lignes changées en un seul UPDATE groupé par tranche.
+
+Un indice dont une mesure manque (ou un dénominateur nul) n'est pas calculé : la
+valeur saisie à la main, s'il y en a une, est conservée.
+
+Usage : python hematology.py recompute [--chunk-size 10000]
+"""
+import argparse
+import logging
+import os
+import time
+import numpy as np
+from sqlalchemy import bindparam, event, select, update
+from models import NumerationFormuleSanguine
+
+logger = logging.getLogger(__name__)
+
+PRIMARY_COLUMNS = ("hemoglobine", "hematocrite", "globules_rouges", "globules_blancs", "neutrophiles",
+                   "lymphocytes", "monocytes", "plaquettes", "reticulocytes")
+DERIVED_COLUMNS = ("vgm", "tcmh", "ccmh", "nlr", "plr", "mlr", "ipr")
+DECIMALES = 2
+
+# Hématocrite de référence et temps de maturation des réticulocytes (jours) selon l'hématocrite (%)
+HEMATOCRITE_NORMAL = 45.0
+MATURATION_SEUILS = (15.0, 25.0, 35.0, 40.0)
+MATURATION_JOURS = (3.0, 2.5, 2.0, 1.5, 1.0)
+
+_registered = False
+
+
+def _positive(values):
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(values > 0, values, np.nan)
+
+
+def nfs_ratios(neutrophiles, lymphocytes, monocytes, plaquettes, globules_blancs):
+    """
+    Ratios inflammatoires (NaN si une donnée manque ou si les lymphocytes sont nuls) :
+    nlr = neutrophiles / lymphocytes, mlr = monocytes / lymphocytes (formules en %),
+    plr = plaquettes / lymphocytes absolus (globules_blancs x lymphocytes %).
+    """
+    lymphocytes = _positive(lymphocytes)
+    lymphocytes_absolus = _positive(np.asarray(globules_blancs, dtype=np.float64) * lymphocytes / 100.0)
+    return (np.asarray(neutrophiles, dtype=np.float64) / lymphocytes,
+            np.asarray(plaquettes, dtype=np.float64) / lymphocytes_absolus,
+            np.asarray(monocytes, dtype=np.float64) / lymphocytes)
+
+
+def derived_indices(hemoglobine, hematocrite, globules_rouges, globules_blancs, neutrophiles, lymphocytes,
+                    monocytes, plaquettes, reticulocytes):
+    """
+    Indices dérivés d'un lot de NFS (tableaux de même longueur, NaN pour une mesure
+    absente). Unités du modèle : hémoglobine g/dL, hématocrite %, globules rouges
+    millions/mm³, réticulocytes ‰. Retourne {colonne: tableau}, arrondi à DECIMALES.
+    """
+    hemoglobine = np.asarray(hemoglobine, dtype=np.float64)
+    hematocrite = np.asarray(hematocrite, dtype=np.float64)
+    globules_rouges = _positive(globules_rouges)
+    nlr, plr, mlr = nfs_ratios(neutrophiles, lymphocytes, monocytes, plaquettes, globules_blancs)
+    # Indice de production réticulocytaire : réticulocytes (%) corrigés par l'hématocrite,
+    # divisés par leur temps de maturation
+    maturation = np.asarray(MATURATION_JOURS)[np.searchsorted(MATURATION_SEUILS, hematocrite, side="right")]
+    ipr = np.asarray(reticulocytes, dtype=np.float64) / 10.0 * hematocrite / HEMATOCRITE_NORMAL / maturation
+    indices = {
+        "vgm": hematocrite * 10.0 / globules_rouges,
+        "tcmh": hemoglobine * 10.0 / globules_rouges,
+        "ccmh": hemoglobine * 100.0 / _positive(hematocrite),
+        "nlr": nlr,
+        "plr": plr,
+        "mlr": mlr,
+        "ipr": ipr,
+    }
+    return {column: np.round(values, DECIMALES) for column, values in indices.items()}
+
+
+def _as_floats(values):
+    return np.array(values, dtype=np.float64)  # None -> NaN
+
+
+# --- À l'écriture (ORM) ---
+
+def derive(nfs):
+    """Calcule les indices d'un objet NumerationFormuleSanguine (les indices non calculables sont laissés)."""
+    indices = derived_indices(*(_as_floats([getattr(nfs, column)]) for column in PRIMARY_COLUMNS))
+    for column, values in indices.items():
+        if np.isfinite(values[0]):
+            setattr(nfs, column, float(values[0]))
+    return nfs
+
+
+def _derive(mapper, connection, target):
+    derive(target)
+
+
+def register_derivation():
+    """Calcule les indices de chaque NFS insérée ou modifiée par l'ORM (toutes les sessions du processus)."""
+    global _registered
+    if _registered:
+        return
+    event.listen(NumerationFormuleSanguine, "before_insert", _derive)
+    event.listen(NumerationFormuleSanguine, "before_update", _derive)
+    _registered = True
+
+
+# --- Retraitement en lot ---
+
+def recompute_chunk(connection, after_id=0, chunk_size=10000):
+    """
+    Recalcule les indices des chunk_size NFS suivant l'identifiant after_id, écrit
+    les lignes changées en un UPDATE groupé.
+    Retourne (dernier id lu ou None s'il n'en reste plus, lignes lues, lignes modifiées).
+    """
+    nfs = NumerationFormuleSanguine.__table__
+    rows = connection.execute(
+        select(nfs.c.id, *(nfs.c[column] for column in PRIMARY_COLUMNS + DERIVED_COLUMNS))
+        .where(nfs.c.id > after_id)
+        .order_by(nfs.c.id)
+        .limit(chunk_size)
+    ).all()
+    if not rows:
+        return None, 0, 0
+
+    columns = list(zip(*rows))
+    ids = np.asarray(columns[0], dtype=np.int64)
+    primary = [_as_floats(values) for values in columns[1:1 + len(PRIMARY_COLUMNS)]]
+    stored = dict(zip(DERIVED_COLUMNS, (_as_floats(values) for values in columns[1 + len(PRIMARY_COLUMNS):])))
+    computed = derived_indices(*primary)
+
+    new = {}
+    changed = np.zeros(len(ids), dtype=bool)
+    for column in DERIVED_COLUMNS:
+        new[column] = np.where(np.isfinite(computed[column]), computed[column], stored[column])
+        changed |= ~((new[column] == stored[column]) | (np.isnan(new[column]) & np.isnan(stored[column])))
+    if changed.any():
+        positions = np.flatnonzero(changed).tolist()
+        values = {column: new[column].tolist() for column in DERIVED_COLUMNS}
+        connection.execute(
+            update(nfs)
+            .where(nfs.c.id == bindparam("b_id"))
+            .values({column: bindparam(f"b_{column}") for column in DERIVED_COLUMNS}),
+            [
+                dict({"b_id": int(ids[i])},
+                     **{f"b_{column}": None if np.isnan(values[column][i]) else values[column][i]
+                        for column in DERIVED_COLUMNS})
+                for i in positions
+            ],
+        )
+    return int(ids[-1]), len(rows), int(changed.sum())
+
+
+def recompute(engine, chunk_size=10000, after_id=0):
+    """Recalcule les indices de toute la table, une transaction par tranche. Retourne (lues, modifiées)."""
+    start = time.perf_counter()
+    lues = modifiees = 0
+    while True:
+        with engine.begin() as connection:
+            last_id, count, changed = recompute_chunk(connection, after_id, chunk_size)
+        if last_id is None:
+            break
+        after_id = last_id
+        lues += count
+        modifiees += changed
+    logger.info(f"Indices NFS recalculés : {lues} lues, {modifiees} modifiées "
+                f"en {time.perf_counter() - start:.1f}s")
+    return lues, modifiees
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from database import create_engine_from_env
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Indices dérivés des NFS")
+    parser.add_argument("command", choices=["recompute"])
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--apres-id", type=int, default=0, help="Reprendre après cet identifiant")
+    args = parser.parse_args()
+
+    engine = create_engine_from_env(os.getenv("DATABASE_URL"))
+    lues, modifiees = recompute(engine, args.chunk_size, args.apres_id)
+    print(f"{modifiees} NFS modifiées sur {lues}")
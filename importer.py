@@ -0,0 +1,302 @@
+"""
+Import en masse des résultats d'automates (Cobas, ...) à partir de leurs fichiers d'export.
+
+Le fichier est lu par blocs ; les échantillons et paramètres sont résolus via des
+tables de correspondance en mémoire, les doublons (import_reference déjà importée)
+sont écartés, puis chaque bloc est écrit en une seule opération : COPY sur
+PostgreSQL, executemany ailleurs. Chaque fichier produit une ligne ImportLog.
+
+Pour un importeur de longue durée (listener.py), les tables de correspondance sont
+rechargées après max_age secondes, après toute écriture ORM sur Parameter, Barcode
+ou Analyse dans le processus (register_refresh), et une fois de plus (au plus toutes
+les min_reload_interval secondes) avant de rejeter un paramètre inconnu.
+
+Usage : python importer.py Cobas export_cobas.csv [--delimiter ";"] [--chunk-size 5000]
+"""
+import argparse
+import csv
+import io
+import itertools
+import logging
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import event, select, insert
+from models import Analyse, Barcode, Parameter, Resultat, ImportLog
+
+logger = logging.getLogger(__name__)
+
+# Colonnes attendues dans le fichier d'export (nom logique -> en-tête du fichier)
+DEFAULT_COLUMNS = {
+    "sample": "sample_id",       # Barcode.barcode_value ou Analyse.dossier_barcode
+    "parameter": "test_code",    # Parameter.nom_param (ou Parameter.param)
+    "value": "result",
+    "date": "result_date",
+    "reference": "result_id",    # Référence unique de l'automate -> Resultat.import_reference
+}
+
+RESULT_COLUMNS = ("patient_id", "analyse_id", "parameter_id", "valeur", "result_date",
+                  "import_source", "import_reference", "import_date")
+
+ImportStats = namedtuple("ImportStats", ["nb_lignes", "nb_importes", "nb_doublons", "nb_rejets", "duree", "erreurs"])
+
+MAX_LOGGED_ERRORS = 20
+MAX_CACHED_SAMPLES = 200000
+
+
+class ResultImporter:
+    """Importe des fichiers d'export d'automate dans la table resultat."""
+
+    def __init__(self, engine, source, columns=None, delimiter=";", chunk_size=5000,
+                 date_format="%Y-%m-%d %H:%M:%S", decimal_comma=True, max_age=300, min_reload_interval=5):
+        self.engine = engine
+        self.source = source
+        self.columns = dict(DEFAULT_COLUMNS, **(columns or {}))
+        self.delimiter = delimiter
+        self.chunk_size = chunk_size
+        self.date_format = date_format
+        self.decimal_comma = decimal_comma
+        self.max_age = max_age
+        self.min_reload_interval = min_reload_interval
+        self._samples = {}
+        self._samples_at = time.monotonic()
+        self._parameters = None
+        self._parameters_at = None
+
+    # --- Tables de correspondance ---
+
+    def invalidate_parameters(self):
+        self._parameters = None
+
+    def invalidate_samples(self):
+        self._samples = {}
+        self._samples_at = time.monotonic()
+
+    def _ensure_parameters(self, connection, unknown=()):
+        """
+        Charge la correspondance des paramètres si elle est absente ou expirée, ou si le
+        bloc contient des mnémoniques inconnus (au plus une fois par min_reload_interval).
+        """
+        now = time.monotonic()
+        age = None if self._parameters is None else now - self._parameters_at
+        if age is None or age > self.max_age or (unknown and age > self.min_reload_interval):
+            self._parameters = self._load_parameters(connection)
+            self._parameters_at = now
+
+    def _load_parameters(self, connection):
+        parameters = Parameter.__table__
+        lookup = {}
+        for parameter_id, param, nom_param in connection.execute(
+                select(parameters.c.parameter_id, parameters.c.param, parameters.c.nom_param)):
+            lookup.setdefault(param, parameter_id)
+            if nom_param:
+                lookup[nom_param] = parameter_id
+        return lookup
+
+    def _resolve_samples(self, connection, sample_ids):
+        """
+        Résout en une requête par table les échantillons encore inconnus du bloc.
+        Les échantillons introuvables ne sont pas mémorisés : le dossier peut être
+        enregistré après la réception du résultat.
+        """
+        if len(self._samples) > MAX_CACHED_SAMPLES or time.monotonic() - self._samples_at > self.max_age:
+            self.invalidate_samples()
+        missing = [sample_id for sample_id in sample_ids if sample_id not in self._samples]
+        if not missing:
+            return
+        analyses = Analyse.__table__
+        barcodes = Barcode.__table__
+        for sample_id, analyse_id, patient_id in connection.execute(
+                select(barcodes.c.barcode_value, analyses.c.id, analyses.c.patient_id)
+                .join(analyses, analyses.c.id == barcodes.c.analyse_id)
+                .where(barcodes.c.barcode_value.in_(missing))):
+            self._samples[sample_id] = (analyse_id, patient_id)
+        for sample_id, analyse_id, patient_id in connection.execute(
+                select(analyses.c.dossier_barcode, analyses.c.id, analyses.c.patient_id)
+                .where(analyses.c.dossier_barcode.in_(missing))):
+            self._samples.setdefault(sample_id, (analyse_id, patient_id))
+
+    def _existing_references(self, connection, references):
+        resultats = Resultat.__table__
+        if not references:
+            return set()
+        return set(connection.execute(
+            select(resultats.c.import_reference)
+            .where(resultats.c.import_source == self.source)
+            .where(resultats.c.import_reference.in_(references))
+        ).scalars())
+
+    # --- Lecture et conversion ---
+
+    def _parse_value(self, raw):
+        raw = (raw or "").strip()
+        if not raw:
+            return None
+        if self.decimal_comma:
+            raw = raw.replace(",", ".")
+        return float(raw)
+
+    def _parse_date(self, raw, default):
+        raw = (raw or "").strip()
+        return datetime.strptime(raw, self.date_format) if raw else default
+
+    def _convert_chunk(self, connection, records, stats, seen, now):
+        self._resolve_samples(connection, {(record.get("sample") or "").strip() for record in records.values()})
+        self._ensure_parameters(connection, {
+            code for code in ((record.get("parameter") or "").strip() for record in records.values())
+            if code not in self._parameters})
+        existing = self._existing_references(
+            connection, [record["reference"].strip() for record in records.values() if record.get("reference")])
+
+        rows = []
+        for number, record in records.items():
+            reference = (record.get("reference") or "").strip() or None
+            if reference is not None and (reference in existing or reference in seen):
+                stats["nb_doublons"] += 1
+                continue
+            sample = self._samples.get((record.get("sample") or "").strip())
+            parameter_id = self._parameters.get((record.get("parameter") or "").strip())
+            try:
+                if sample is None:
+                    raise ValueError(f"échantillon inconnu {record.get('sample')!r}")
+                if parameter_id is None:
+                    raise ValueError(f"paramètre inconnu {record.get('parameter')!r}")
+                valeur = self._parse_value(record.get("value"))
+                result_date = self._parse_date(record.get("date"), now)
+            except ValueError as e:
+                stats["nb_rejets"] += 1
+                if len(stats["erreurs"]) < MAX_LOGGED_ERRORS:
+                    stats["erreurs"].append(f"ligne {number} : {e}")
+                continue
+            if reference is not None:
+                seen.add(reference)
+            analyse_id, patient_id = sample
+            rows.append({
+                "patient_id": patient_id, "analyse_id": analyse_id, "parameter_id": parameter_id,
+                "valeur": valeur, "result_date": result_date, "import_source": self.source,
+                "import_reference": reference, "import_date": now,
+            })
+        return rows
+
+    def import_records(self, connection, records, stats, seen=None, now=None):
+        """
+        Résout, déduplique et écrit un bloc d'enregistrements {numéro: {"sample", "parameter",
+        "value", "date", "reference"}} (valeurs brutes) sur la connexion donnée.
+        Met à jour stats et retourne le nombre de résultats insérés.
+        """
+        self._ensure_parameters(connection)
+        rows = self._convert_chunk(connection, records, stats, set() if seen is None else seen,
+                                   now or datetime.now())
+        self._write_rows(connection, rows)
+        stats["nb_importes"] += len(rows)
+        return len(rows)
+
+    # --- Écriture ---
+
+    def _copy_rows(self, connection, rows):
+        """COPY ... FROM STDIN (PostgreSQL / psycopg2)."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(["" if row[name] is None else
+                             row[name].isoformat() if isinstance(row[name], datetime) else row[name]
+                             for name in RESULT_COLUMNS])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY {Resultat.__tablename__} ({', '.join(RESULT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                buffer)
+        finally:
+            cursor.close()
+
+    def _write_rows(self, connection, rows):
+        if not rows:
+            return
+        if connection.dialect.name == "postgresql" and connection.dialect.driver == "psycopg2":
+            self._copy_rows(connection, rows)
+        else:
+            connection.execute(insert(Resultat.__table__), rows)
+
+    def import_file(self, path):
+        """Importe un fichier dans une transaction et enregistre un ImportLog. Retourne un ImportStats."""
+        start = time.perf_counter()
+        stats = {"nb_lignes": 0, "nb_importes": 0, "nb_doublons": 0, "nb_rejets": 0, "erreurs": []}
+        status, error_message = "SUCCESS", None
+        now = datetime.now()
+        try:
+            with self.engine.begin() as connection, open(path, newline="", encoding="utf-8-sig") as handle:
+                self.invalidate_parameters()
+                self._ensure_parameters(connection)
+                reader = csv.DictReader(handle, delimiter=self.delimiter)
+                numbered = enumerate(reader, start=2)  # ligne 1 : en-tête
+                seen = set()
+                while True:
+                    records = {
+                        number: {key: line.get(header) for key, header in self.columns.items()}
+                        for number, line in itertools.islice(numbered, self.chunk_size)
+                    }
+                    if not records:
+                        break
+                    stats["nb_lignes"] += len(records)
+                    self.import_records(connection, records, stats, seen, now)
+            if stats["nb_rejets"]:
+                status = "PARTIAL"
+                error_message = "\n".join(stats["erreurs"])
+        except Exception as e:
+            logger.error(f"Erreur lors de l'import de {path} : {str(e)}")
+            status, error_message = "ERROR", str(e)
+            stats["nb_importes"] = 0
+        duree = time.perf_counter() - start
+
+        with self.engine.begin() as connection:
+            connection.execute(insert(ImportLog.__table__).values(
+                source=self.source, file_name=os.path.basename(path), import_date=now, status=status,
+                error_message=error_message, nb_lignes=stats["nb_lignes"], nb_importes=stats["nb_importes"],
+                nb_doublons=stats["nb_doublons"], nb_rejets=stats["nb_rejets"], duree_secondes=duree,
+            ))
+        logger.info(f"Import {self.source} {os.path.basename(path)} : {stats['nb_importes']} résultats, "
+                    f"{stats['nb_doublons']} doublons, {stats['nb_rejets']} rejets en {duree:.2f}s "
+                    f"({stats['nb_lignes'] / duree if duree else 0:.0f} lignes/s)")
+        return ImportStats(stats["nb_lignes"], stats["nb_importes"], stats["nb_doublons"],
+                           stats["nb_rejets"], duree, stats["erreurs"])
+
+
+def register_refresh(importer):
+    """
+    Recharge les correspondances de l'importeur au prochain bloc après toute écriture
+    ORM sur les paramètres (paramètres) ou sur les codes à barres et dossiers (échantillons).
+    """
+
+    def _parameters_changed(mapper, connection, target):
+        importer.invalidate_parameters()
+
+    def _samples_changed(mapper, connection, target):
+        importer.invalidate_samples()
+
+    for event_name in ("after_insert", "after_update", "after_delete"):
+        event.listen(Parameter, event_name, _parameters_changed)
+    for model in (Barcode, Analyse):
+        for event_name in ("after_update", "after_delete"):
+            event.listen(model, event_name, _samples_changed)
+    return importer
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from database import create_engine_from_env
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Import des résultats d'automates")
+    parser.add_argument("source", help="Nom de l'automate, ex. Cobas")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--delimiter", default=";")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    importer = ResultImporter(create_engine_from_env(os.getenv("DATABASE_URL")), args.source,
+                              delimiter=args.delimiter, chunk_size=args.chunk_size)
+    for path in args.files:
+        importer.import_file(path)
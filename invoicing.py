@@ -0,0 +1,203 @@
+"""
+Facturation en lot des conventions (hôpitaux, entreprises partenaires).
+
+Pour une convention et une période [debut, fin[, les montants de toutes les lignes
+sont calculés par une seule requête (Analyse.facture, montant enregistré à la saisie,
+moins Convention.remise : un changement de tarif ne modifie pas les périodes passées),
+puis insérés directement par INSERT ... SELECT avec l'en-tête FactureConvention,
+dans une seule transaction. Les analyses déjà facturées ou annulées sont exclues.
+Si la facture de la période existe déjà et que des analyses saisies en retard restent
+à facturer, InvoiceAlreadyIssued est levée avec le reliquat.
+
+La facturation d'un mois répartit les conventions entre plusieurs processus.
+
+Usage : python invoicing.py 2024 5 [--workers 4]
+"""
+import argparse
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from sqlalchemy import Float, Numeric, select, insert, update, func, literal, or_, exists, cast
+from models import Analyse, AnalyseFacture, AnalyseState, Convention, FactureConvention
+
+logger = logging.getLogger(__name__)
+
+InvoiceResult = namedtuple("InvoiceResult", ["convention_id", "facture_id", "reference_facture", "nb_lignes",
+                                             "montant_total", "duree"])
+
+
+class InvoiceAlreadyIssued(Exception):
+    """Levée quand la facture de la période existe déjà alors que des analyses restent à facturer."""
+
+    def __init__(self, reference, nb_lignes, montant):
+        super().__init__(f"facture {reference} déjà émise, {nb_lignes} analyses non facturées ({montant:.2f})")
+        self.reference = reference
+        self.nb_lignes = nb_lignes
+        self.montant = montant
+
+
+def reference_facture(numero, debut, fin):
+    return f"FC-{numero}-{debut:%Y%m%d}-{fin:%Y%m%d}"
+
+
+def invoice_lines_query(convention_id, remise, debut, fin):
+    """
+    Lignes à facturer (analyse_id, montant) sur la période [debut, fin[ : montant
+    enregistré de l'analyse, remise de la convention appliquée.
+    """
+    analyses = Analyse.__table__
+    analyses_factures = AnalyseFacture.__table__
+    # round(double precision, integer) n'existe pas sous PostgreSQL : arrondi en numeric
+    montant = func.round(cast(analyses.c.facture * (1 - literal(remise or 0.0) / 100.0), Numeric), 2, type_=Float)
+    return (
+        select(analyses.c.id.label("analyse_id"), montant.label("montant"))
+        .where(analyses.c.id_convention == convention_id)
+        .where(analyses.c.is_convention.is_(True))
+        .where(analyses.c.analyse_date >= debut)
+        .where(analyses.c.analyse_date < fin)
+        .where(or_(analyses.c.state.is_(None), analyses.c.state != AnalyseState.ANNULEE))
+        .where(~exists().where(analyses_factures.c.analyse_id == analyses.c.id))
+    )
+
+
+def invoice_convention(connection, convention_id, debut, fin, now=None):
+    """
+    Crée la facture d'une convention pour [debut, fin[ sur la connexion donnée
+    (à appeler dans une transaction). Retourne un InvoiceResult, ou None si rien
+    n'est à facturer. Lève InvoiceAlreadyIssued si la facture de cette période
+    existe déjà et que des analyses de la période ne sont toujours pas facturées.
+    """
+    start = time.perf_counter()
+    now = now or datetime.now()
+    conventions = Convention.__table__
+    factures = FactureConvention.__table__
+    analyses_factures = AnalyseFacture.__table__
+
+    # Verrou sur la convention : deux facturations simultanées ne peuvent pas facturer deux fois une analyse
+    convention = connection.execute(
+        select(conventions.c.id, conventions.c.numero, conventions.c.remise)
+        .where(conventions.c.id == convention_id)
+        .with_for_update()
+    ).one()
+    reference = reference_facture(convention.numero, debut, fin)
+    if connection.execute(select(factures.c.id).where(factures.c.reference_facture == reference)).first():
+        lines = invoice_lines_query(convention_id, convention.remise, debut, fin).subquery()
+        nb_lignes, montant = connection.execute(
+            select(func.count(), func.coalesce(func.sum(lines.c.montant), 0.0)).select_from(lines)).one()
+        if nb_lignes:
+            raise InvoiceAlreadyIssued(reference, nb_lignes, montant)
+        logger.info(f"Facture {reference} déjà émise")
+        return None
+
+    facture_id = connection.execute(
+        insert(factures).values(
+            convention_id=convention_id, reference_facture=reference, debut_facture=debut, fin_facture=fin,
+            montant_total=0.0, montant_paye=0.0, solde_restant=0.0, statut_paiement="en_attente",
+            created_at=now, updated_at=now,
+        )
+    ).inserted_primary_key[0]
+
+    lines = invoice_lines_query(convention_id, convention.remise, debut, fin).subquery()
+    nb_lignes = connection.execute(
+        insert(analyses_factures).from_select(
+            ["facture_id", "convention_id", "analyse_id", "montant", "statut_paiement", "created_at", "updated_at"],
+            select(literal(facture_id), literal(convention_id), lines.c.analyse_id, lines.c.montant,
+                   literal("en_attente"), literal(now), literal(now)),
+        )
+    ).rowcount
+    if not nb_lignes:
+        connection.execute(factures.delete().where(factures.c.id == facture_id))
+        return None
+
+    montant_total = connection.execute(
+        select(func.coalesce(func.sum(analyses_factures.c.montant), 0.0))
+        .where(analyses_factures.c.facture_id == facture_id)
+    ).scalar()
+    connection.execute(
+        update(factures).where(factures.c.id == facture_id)
+        .values(montant_total=montant_total, solde_restant=montant_total)
+    )
+    duree = time.perf_counter() - start
+    logger.info(f"Facture {reference} : {nb_lignes} analyses, {montant_total:.2f} en {duree:.2f}s")
+    return InvoiceResult(convention_id, facture_id, reference, nb_lignes, montant_total, duree)
+
+
+def month_period(year, month):
+    debut = datetime(year, month, 1)
+    fin = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return debut, fin
+
+
+def active_conventions(connection, debut):
+    conventions = Convention.__table__
+    return list(connection.execute(
+        select(conventions.c.id)
+        .where(or_(conventions.c.date_fin.is_(None), conventions.c.date_fin >= debut))
+        .order_by(conventions.c.id)
+    ).scalars())
+
+
+# --- Facturation mensuelle en parallèle ---
+
+_worker_engine = None
+
+
+def _init_worker(database_url):
+    global _worker_engine
+    from database import create_engine_from_env
+    _worker_engine = create_engine_from_env(database_url)
+
+
+def _invoice_in_worker(convention_id, debut, fin):
+    with _worker_engine.begin() as connection:
+        return invoice_convention(connection, convention_id, debut, fin)
+
+
+def invoice_month(database_url, year, month, workers=None):
+    """
+    Facture toutes les conventions actives du mois, une transaction par convention,
+    réparties entre `workers` processus (chacun avec son propre moteur et son pool).
+    Retourne la liste des InvoiceResult (les conventions en erreur sont journalisées).
+    """
+    from database import create_engine_from_env
+
+    debut, fin = month_period(year, month)
+    engine = create_engine_from_env(database_url)
+    with engine.connect() as connection:
+        convention_ids = active_conventions(connection, debut)
+    engine.dispose()
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker,
+                             initargs=(database_url,)) as executor:
+        futures = {executor.submit(_invoice_in_worker, convention_id, debut, fin): convention_id
+                   for convention_id in convention_ids}
+        for future, convention_id in futures.items():
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Erreur lors de la facturation de la convention {convention_id} : {str(e)}")
+                continue
+            if result is not None:
+                results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Facturation mensuelle des conventions")
+    parser.add_argument("year", type=int)
+    parser.add_argument("month", type=int)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    invoices = invoice_month(os.getenv("DATABASE_URL"), args.year, args.month, args.workers)
+    print(f"{len(invoices)} factures, {sum(invoice.nb_lignes for invoice in invoices)} analyses, "
+          f"{sum(invoice.montant_total for invoice in invoices):.2f} en {time.perf_counter() - start:.1f}s")
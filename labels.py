@@ -0,0 +1,248 @@
+"""
+Étiquettes QR code des dossiers (Analyse.dossier_barcode) et des tubes (Barcode).
+
+Les étiquettes d'un lot de dossiers sont lues en deux requêtes, rendues en PNG ou
+SVG par un pool de processus, et mémorisées sur disque sous un nom dérivé de leur
+contenu (valeur du code, textes, format, taille) : une étiquette déjà rendue n'est
+jamais recalculée. Une planche imprimable multi-pages (PDF) peut être produite en
+flux, une page à la fois.
+
+Usage : python labels.py DOS00000001 DOS00000002 [--format svg] [--planche etiquettes.pdf]
+"""
+import argparse
+import functools
+import hashlib
+import logging
+import os
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+from sqlalchemy import select
+from models import Analyse, Barcode, Patient
+from pdf import PdfStreamWriter
+from refdata import missing_label, shared_cache
+
+logger = logging.getLogger(__name__)
+
+Label = namedtuple("Label", ["barcode_value", "titre", "sous_titre"])
+
+FORMATS = ("png", "svg")
+LABELS_CACHE_DIR = os.getenv("LABELS_CACHE_DIR", "labels_cache")
+BOX_SIZE = 6
+BORDER = 2
+TEXT_HEIGHT = 34
+MASK_PATTERN = 0
+
+
+def labels_for_dossiers(connection, dossier_barcodes):
+    """
+    Étiquettes d'un lot de dossiers : une par dossier puis une par tube, en deux
+    requêtes (noms des tubes et des prélèvements pris dans le cache refdata ; un tube
+    absent du cache garde son étiquette, avec son identifiant).
+    """
+    analyses = Analyse.__table__
+    patients = Patient.__table__
+    barcodes = Barcode.__table__
+    dossier_barcodes = list(dossier_barcodes)
+
+    labels = {}
+    for dossier_barcode, nom, prenom, analyse_date in connection.execute(
+            select(analyses.c.dossier_barcode, patients.c.name, patients.c.prenom, analyses.c.analyse_date)
+            .join(patients, patients.c.id == analyses.c.patient_id)
+            .where(analyses.c.dossier_barcode.in_(dossier_barcodes))):
+        labels[dossier_barcode] = [Label(dossier_barcode, f"{nom} {prenom}", f"{analyse_date:%d/%m/%Y}")]
+    rows = connection.execute(
+        select(analyses.c.dossier_barcode, barcodes.c.barcode_value, patients.c.name, patients.c.prenom,
+               barcodes.c.tube_id, barcodes.c.prelevement_type_id)
+        .join(analyses, analyses.c.id == barcodes.c.analyse_id)
+        .join(patients, patients.c.id == analyses.c.patient_id)
+        .where(analyses.c.dossier_barcode.in_(dossier_barcodes))
+        .order_by(barcodes.c.id)).all()
+    data = shared_cache(connection.engine).covering(tubes={row.tube_id for row in rows},
+                                                    prelevement_types={row.prelevement_type_id for row in rows})
+    for dossier_barcode, barcode_value, nom, prenom, tube_id, prelevement_type_id in rows:
+        tube = data.tubes.get(tube_id)
+        prelevement = data.prelevement_types.get(prelevement_type_id)
+        tube_name = tube.name if tube else missing_label("Tube", tube_id)
+        prelevement_name = prelevement.name if prelevement else missing_label("Prélèvement", prelevement_type_id)
+        labels.setdefault(dossier_barcode, []).append(
+            Label(barcode_value, f"{nom} {prenom}", f"{tube_name} - {prelevement_name}"))
+    return [label for dossier_barcode in dossier_barcodes for label in labels.get(dossier_barcode, ())]
+
+
+# --- Rendu (exécuté dans les processus du pool) ---
+
+def _qr_matrix(value):
+    # Masque fixe : le choix du meilleur masque (8 essais) représente l'essentiel du temps de
+    # rendu, et tout masque est lisible pour des codes aussi courts
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, border=BORDER, mask_pattern=MASK_PATTERN)
+    qr.add_data(value)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+@functools.lru_cache(maxsize=None)
+def _font():
+    """Police des textes : LABELS_FONT, sinon une police système avec les accents, sinon celle de Pillow."""
+    for name in filter(None, (os.getenv("LABELS_FONT"), "arial.ttf", "DejaVuSans.ttf")):
+        try:
+            return ImageFont.truetype(name, 10)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+
+def render_png(label, box_size=BOX_SIZE):
+    matrix = _qr_matrix(label.barcode_value)
+    size = len(matrix) * box_size
+    modules = Image.new("1", (len(matrix), len(matrix)))
+    modules.putdata([0 if dark else 1 for row in matrix for dark in row])
+    image = Image.new("1", (size, size + TEXT_HEIGHT), 1)
+    image.paste(modules.resize((size, size), Image.NEAREST), (0, 0))
+    draw = ImageDraw.Draw(image)
+    font = _font()
+    for line, text in enumerate((label.barcode_value, label.titre, label.sous_titre)):
+        if text:
+            draw.text((box_size * BORDER, size - box_size + line * 11), text[:40], fill=0, font=font)
+    return image
+
+
+def render_svg(label, box_size=BOX_SIZE):
+    matrix = _qr_matrix(label.barcode_value)
+    size = len(matrix) * box_size
+    path = "".join(f"M{x * box_size},{y * box_size}h{box_size}v{box_size}h-{box_size}z"
+                   for y, row in enumerate(matrix) for x, dark in enumerate(row) if dark)
+    lines = "".join(
+        f'<text x="{box_size * BORDER}" y="{size - box_size + 10 + line * 11}">{escape(text)}</text>'
+        for line, text in enumerate((label.barcode_value, label.titre, label.sous_titre)) if text
+    )
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size + TEXT_HEIGHT}" '
+            f'viewBox="0 0 {size} {size + TEXT_HEIGHT}"><rect width="100%" height="100%" fill="#fff"/>'
+            f'<path d="{path}" fill="#000"/><g font-family="sans-serif" font-size="10">{lines}</g></svg>')
+
+
+def cache_path(cache_dir, label, fmt, box_size=BOX_SIZE):
+    """Chemin du fichier en cache : empreinte du contenu de l'étiquette, répartie en sous-dossiers."""
+    digest = hashlib.sha1("\x1f".join((fmt, str(box_size)) + tuple(label)).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, digest[:2], f"{digest}.{fmt}")
+
+
+def render_label(label, fmt="png", cache_dir=LABELS_CACHE_DIR, box_size=BOX_SIZE):
+    """Rend une étiquette dans le cache disque si elle n'y est pas déjà. Retourne son chemin."""
+    path = cache_path(cache_dir, label, fmt, box_size)
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Écriture atomique : plusieurs processus peuvent rendre la même étiquette
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as out:
+            if fmt == "svg":
+                out.write(render_svg(label, box_size).encode("utf-8"))
+            else:
+                render_png(label, box_size).save(out, "PNG")
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return path
+
+
+def _render_chunk(labels, fmt, cache_dir, box_size):
+    return [render_label(Label(*label), fmt, cache_dir, box_size) for label in labels]
+
+
+class LabelService:
+    """Rend des lots d'étiquettes dans le cache disque, en parallèle sur un pool de processus réutilisé."""
+
+    def __init__(self, cache_dir=LABELS_CACHE_DIR, workers=None, box_size=BOX_SIZE, chunk_size=50):
+        self.cache_dir = cache_dir
+        self.workers = workers or os.cpu_count()
+        self.box_size = box_size
+        self.chunk_size = chunk_size
+        self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def render_batch(self, labels, fmt="png"):
+        """Retourne les chemins des étiquettes, dans l'ordre ; seules les absentes du cache sont rendues."""
+        if fmt not in FORMATS:
+            raise ValueError(f"format inconnu : {fmt}")
+        paths = [cache_path(self.cache_dir, label, fmt, self.box_size) for label in labels]
+        missing = [label for label, path in zip(labels, paths) if not os.path.exists(path)]
+        if not missing:
+            return paths
+        chunks = [missing[i:i + self.chunk_size] for i in range(0, len(missing), self.chunk_size)]
+        if len(chunks) == 1 or self.workers == 1:
+            for chunk in chunks:
+                _render_chunk(chunk, fmt, self.cache_dir, self.box_size)
+        else:
+            futures = [self._pool().submit(_render_chunk, [tuple(label) for label in chunk], fmt, self.cache_dir,
+                                           self.box_size) for chunk in chunks]
+            for future in futures:
+                future.result()
+        logger.info(f"{len(missing)} étiquettes rendues, {len(labels) - len(missing)} lues dans le cache")
+        return paths
+
+    def write_sheet(self, labels, out, columns=4, rows=10, dpi=200):
+        """
+        Écrit en flux dans out (binaire) une planche PDF A4 de columns x rows étiquettes
+        par page ; une seule page est en mémoire à la fois. Retourne le nombre de pages.
+        """
+        paths = self.render_batch(labels, "png")
+        writer = PdfStreamWriter(out)
+        width, height = (round(side / 72 * dpi) for side in writer.page_size)
+        margin = round(dpi * 0.25)
+        cell_width = (width - 2 * margin) // columns
+        cell_height = (height - 2 * margin) // rows
+        per_page = columns * rows
+        for start in range(0, len(paths), per_page):
+            page = Image.new("1", (width, height), 1)
+            for position, path in enumerate(paths[start:start + per_page]):
+                with Image.open(path) as label_image:
+                    label_image.thumbnail((cell_width - 4, cell_height - 4))
+                    x = margin + (position % columns) * cell_width
+                    y = margin + (position // columns) * cell_height
+                    page.paste(label_image.convert("1"), (x, y))
+            writer.add_image_page(page)
+        writer.close()
+        return writer.page_count
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from database import create_engine_from_env
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Étiquettes QR code des dossiers et des tubes")
+    parser.add_argument("dossiers", nargs="+", help="Analyse.dossier_barcode")
+    parser.add_argument("--format", choices=FORMATS, default="png")
+    parser.add_argument("--planche", help="Fichier PDF de la planche à imprimer")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    engine = create_engine_from_env(os.getenv("DATABASE_URL"))
+    with engine.connect() as connection:
+        labels = labels_for_dossiers(connection, args.dossiers)
+    service = LabelService(workers=args.workers)
+    try:
+        if args.planche:
+            with open(args.planche, "wb") as out:
+                print(f"{service.write_sheet(labels, out)} pages écrites dans {args.planche}")
+        else:
+            for path in service.render_batch(labels, args.format):
+                print(path)
+    finally:
+        service.close()
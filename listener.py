@@ -0,0 +1,497 @@
+"""
+Réception en continu des résultats poussés par les automates sur TCP.
+
+Protocoles : ASTM E1381/E1394 (ENQ / trames STX...ETX + checksum / EOT) et
+HL7 v2 ORU^R01 sur MLLP. Les résultats décodés passent par une file bornée et
+sont écrits en micro-lots via ResultImporter. Quand la file est pleine, la
+lecture du socket et l'acquittement (ACK) sont suspendus : l'automate attend,
+aucune trame n'est perdue, même si la base ralentit.
+
+Un lot en échec n'est réessayé que pour les erreurs transitoires (connexion,
+OperationalError), au plus max_retries fois. Ensuite, ou pour toute autre erreur
+(contrainte, valeur invalide), le lot est coupé en deux jusqu'à isoler les résultats
+fautifs, qui sont écrits dans import_logs (statut ERROR, source de l'importeur,
+fichier « listener ») : la file continue d'avancer.
+
+Les métriques d'ingestion (retard, taille des lots, file) et celles du pool de
+connexions sont servies au format Prometheus sur GET /metrics (--metrics-port,
+0 pour désactiver) et résumées dans les logs chaque minute.
+
+    python listener.py serve --astm-port 5001 --hl7-port 5002 --source Cobas
+    python listener.py replay astm capture_astm.txt --port 5001
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError, OperationalError
+from database import render_pool_metrics
+from importer import ResultImporter
+from models import ImportLog
+
+logger = logging.getLogger(__name__)
+
+ENQ, ACK, NAK, EOT = b"\x05", b"\x06", b"\x15", b"\x04"
+STX, ETX, ETB, CR, LF = b"\x02", b"\x03", b"\x17", b"\r", b"\n"
+MLLP_START, MLLP_END = b"\x0b", b"\x1c\x0d"
+
+ASTM_FRAME_SIZE = 240
+
+
+def astm_checksum(data):
+    """Checksum ASTM E1381 : somme des octets (numéro de trame inclus, jusqu'à ETX/ETB) modulo 256."""
+    return f"{sum(data) % 256:02X}".encode("ascii")
+
+
+class AstmParser:
+    """
+    Décodeur incrémental des enregistrements ASTM E1394 (H, P, O, R, L) d'un message.
+    L'identifiant d'échantillon est le champ 3 du dernier enregistrement O ; chaque R
+    donne un résultat (code test, valeur, date YYYYMMDDHHMMSS).
+    """
+
+    def __init__(self):
+        self.sample_id = None
+
+    def feed(self, record, received_at):
+        fields = record.split("|")
+        record_type = fields[0][-1:]
+        if record_type == "H":
+            self.sample_id = None
+        elif record_type == "O" and len(fields) > 2:
+            self.sample_id = fields[2].split("^")[0].strip()
+        elif record_type == "R" and len(fields) > 3 and self.sample_id:
+            test_code = fields[2].split("^")[3] if fields[2].count("^") >= 3 else fields[2]
+            result_date = fields[12] if len(fields) > 12 else ""
+            return {
+                "sample": self.sample_id,
+                "parameter": test_code,
+                "value": fields[3].split("^")[0],
+                "date": result_date[:14],
+                "reference": f"{self.sample_id}-{test_code}-{result_date or fields[1]}",
+                "received_at": received_at,
+            }
+        return None
+
+
+def parse_astm_records(records, received_at):
+    """Décode les enregistrements d'un message ASTM complet en résultats."""
+    parser = AstmParser()
+    return [result for result in (parser.feed(record, received_at) for record in records) if result]
+
+
+def parse_hl7_message(message, received_at):
+    """
+    Décode un message HL7 v2 ORU^R01 : l'échantillon vient de OBR-3 (ou OBR-2),
+    chaque OBX donne un résultat (OBX-3 code, OBX-5 valeur, OBX-14 date).
+    Retourne (résultats, identifiant de contrôle MSH-10).
+    """
+    results = []
+    control_id = ""
+    sample_id = None
+    for segment in message.replace("\n", "\r").split("\r"):
+        fields = segment.split("|")
+        if fields[0] == "MSH" and len(fields) > 9:
+            control_id = fields[9]
+        elif fields[0] == "OBR":
+            filler = fields[3].split("^")[0] if len(fields) > 3 else ""
+            placer = fields[2].split("^")[0] if len(fields) > 2 else ""
+            sample_id = filler or placer
+        elif fields[0] == "OBX" and len(fields) > 5 and sample_id:
+            test_code = fields[3].split("^")[0]
+            result_date = fields[14] if len(fields) > 14 else ""
+            results.append({
+                "sample": sample_id,
+                "parameter": test_code,
+                "value": fields[5].split("^")[0],
+                "date": result_date[:14],
+                "reference": f"{control_id}-{fields[1]}",
+                "received_at": received_at,
+            })
+    return results, control_id
+
+
+def hl7_ack(control_id, code="AA"):
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    message = (f"MSH|^~\\&|LAM||||{timestamp}||ACK|{control_id}|P|2.5\r"
+               f"MSA|{code}|{control_id}\r")
+    return MLLP_START + message.encode("utf-8") + MLLP_END
+
+
+class ListenerMetrics:
+    """Métriques d'ingestion : volumes, profondeur de file, taille des lots et retard d'ingestion."""
+
+    BATCH_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500)
+    LAG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.messages = 0
+        self.received = 0
+        self.written = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.flush_errors = 0
+        self.dead_letters = 0
+        self.queue_depth = 0
+        self.last_batch_size = 0
+        self.last_lag = 0.0
+        self.batch_counts = [0] * (len(self.BATCH_BUCKETS) + 1)
+        self.lag_counts = [0] * (len(self.LAG_BUCKETS) + 1)
+
+    @staticmethod
+    def _observe(buckets, counts, value):
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                counts[i] += 1
+                return
+        counts[-1] += 1
+
+    def observe_batch(self, size, lag):
+        self.last_batch_size = size
+        self.last_lag = lag
+        self._observe(self.BATCH_BUCKETS, self.batch_counts, size)
+        self._observe(self.LAG_BUCKETS, self.lag_counts, lag)
+
+    def render_prometheus(self):
+        lines = []
+        for name, kind, value in (
+                ("listener_messages_total", "counter", self.messages),
+                ("listener_results_received_total", "counter", self.received),
+                ("listener_results_written_total", "counter", self.written),
+                ("listener_results_duplicates_total", "counter", self.duplicates),
+                ("listener_results_rejected_total", "counter", self.rejected),
+                ("listener_flush_errors_total", "counter", self.flush_errors),
+                ("listener_dead_letters_total", "counter", self.dead_letters),
+                ("listener_queue_depth", "gauge", self.queue_depth),
+                ("listener_last_batch_size", "gauge", self.last_batch_size),
+                ("listener_ingest_lag_seconds", "gauge", self.last_lag)):
+            lines += [f"# TYPE {name} {kind}", f"{name} {value}"]
+        for name, buckets, counts in (("listener_batch_size", self.BATCH_BUCKETS, self.batch_counts),
+                                      ("listener_batch_lag_seconds", self.LAG_BUCKETS, self.lag_counts)):
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound}"
+                lines.append(f'{name}_bucket{{le="{le}"}} {cumulative}')
+            lines.append(f"{name}_count {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+class ResultListener:
+    """
+    Serveur asyncio ASTM / HL7 : file bornée entre la réception et l'écriture,
+    écriture en micro-lots (batch_size résultats ou flush_interval secondes).
+    """
+
+    def __init__(self, importer, batch_size=500, flush_interval=0.5, queue_size=10000, retry_delay=1.0,
+                 max_retries=5, pool_metrics=None):
+        self.importer = importer
+        self.pool_metrics = pool_metrics
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.metrics = ListenerMetrics()
+        self.queue = None
+        self._servers = []
+        self._flusher = None
+
+    async def enqueue(self, results):
+        """Met les résultats en file ; attend (backpressure) si la file est pleine."""
+        if not results:
+            return
+        self.metrics.messages += 1
+        for result in results:
+            await self.queue.put(result)
+            self.metrics.received += 1
+        self.metrics.queue_depth = self.queue.qsize()
+
+    # --- Écriture en micro-lots ---
+
+    def _write_batch(self, batch):
+        stats = {"nb_importes": 0, "nb_doublons": 0, "nb_rejets": 0, "erreurs": []}
+        records = {number: result for number, result in enumerate(batch, start=1)}
+        with self.importer.engine.begin() as connection:
+            self.importer.import_records(connection, records, stats)
+        return stats
+
+    @staticmethod
+    def _is_transient(error):
+        return isinstance(error, OperationalError) or (isinstance(error, DBAPIError) and error.connection_invalidated)
+
+    def _dead_letter(self, result, error):
+        """Consigne un résultat impossible à écrire dans import_logs (à défaut, dans les logs)."""
+        self.metrics.dead_letters += 1
+        message = f"{result!r} : {str(error)}"
+        logger.error(f"Résultat écarté : {message}")
+        try:
+            with self.importer.engine.begin() as connection:
+                connection.execute(insert(ImportLog.__table__).values(
+                    source=self.importer.source, file_name="listener", import_date=datetime.now(),
+                    status="ERROR", error_message=message, nb_lignes=1, nb_importes=0, nb_doublons=0,
+                    nb_rejets=1, duree_secondes=0.0))
+        except Exception as e:
+            logger.error(f"Journalisation du résultat écarté impossible : {str(e)}")
+
+    def _write_isolating(self, batch, stats):
+        """Écrit le lot ; en cas d'échec, le coupe en deux jusqu'à isoler les résultats fautifs."""
+        try:
+            written = self._write_batch(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self._dead_letter(batch[0], e)
+                return
+            middle = len(batch) // 2
+            self._write_isolating(batch[:middle], stats)
+            self._write_isolating(batch[middle:], stats)
+            return
+        for key in ("nb_importes", "nb_doublons", "nb_rejets"):
+            stats[key] += written[key]
+        stats["erreurs"] += written["erreurs"]
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            # Erreur transitoire : on garde le lot et on réessaie (la backpressure ralentit
+            # les automates) ; au-delà de max_retries ou pour une autre erreur, on isole les fautifs.
+            attempt = 0
+            while True:
+                try:
+                    stats = await loop.run_in_executor(None, self._write_batch, batch)
+                    break
+                except Exception as e:
+                    self.metrics.flush_errors += 1
+                    attempt += 1
+                    logger.error(f"Écriture du lot de {len(batch)} résultats impossible "
+                                 f"(tentative {attempt}) : {str(e)}")
+                    if not self._is_transient(e) or attempt > self.max_retries:
+                        stats = {"nb_importes": 0, "nb_doublons": 0, "nb_rejets": 0, "erreurs": []}
+                        await loop.run_in_executor(None, self._write_isolating, batch, stats)
+                        break
+                    await asyncio.sleep(self.retry_delay)
+            self.metrics.written += stats["nb_importes"]
+            self.metrics.duplicates += stats["nb_doublons"]
+            self.metrics.rejected += stats["nb_rejets"]
+            for erreur in stats["erreurs"]:
+                logger.warning(f"Résultat rejeté : {erreur}")
+            self.metrics.observe_batch(len(batch), time.time() - min(r["received_at"] for r in batch))
+            self.metrics.queue_depth = self.queue.qsize()
+            for _ in batch:
+                self.queue.task_done()
+
+    # --- Métriques ---
+
+    def render_metrics(self):
+        """Métriques d'ingestion et, si elles sont collectées, celles du pool de l'importeur."""
+        text = self.metrics.render_prometheus()
+        if self.pool_metrics is not None:
+            text += render_pool_metrics([("listener", self.importer.engine, self.pool_metrics)])
+        return text
+
+    async def handle_metrics(self, reader, writer):
+        """Point HTTP minimal : GET /metrics renvoie render_metrics(), tout le reste 404."""
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            path = request.split(b" ")[1] if request.count(b" ") >= 2 else b""
+            if path == b"/metrics":
+                status, body = "200 OK", self.render_metrics().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b""
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode("ascii") + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as e:
+            logger.warning(f"Requête de métriques invalide : {str(e)}")
+        finally:
+            writer.close()
+
+    # --- Protocoles ---
+
+    async def handle_astm(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        parser, pending = AstmParser(), b""
+        try:
+            while True:
+                byte = await reader.read(1)
+                if not byte:
+                    break
+                if byte == ENQ:
+                    parser, pending = AstmParser(), b""
+                    writer.write(ACK)
+                elif byte == STX:
+                    # Trame : numéro + texte + ETX/ETB + checksum (2 car.) + CR LF
+                    frame = await reader.readuntil(LF)
+                    body, end, checksum = frame[:-5], frame[-5:-4], frame[-4:-2]
+                    if end not in (ETX, ETB) or astm_checksum(body + end) != checksum.upper():
+                        writer.write(NAK)
+                        await writer.drain()
+                        continue
+                    pending += body[1:]
+                    if end == ETX:
+                        received_at = time.time()
+                        results = [parser.feed(record, received_at)
+                                   for record in pending.decode("latin-1").split("\r") if record]
+                        pending = b""
+                        # Mise en file avant l'ACK : si la file est pleine, l'automate attend
+                        await self.enqueue([result for result in results if result])
+                    writer.write(ACK)
+                elif byte == EOT:
+                    parser, pending = AstmParser(), b""
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.warning(f"Connexion ASTM {peer} interrompue : {str(e)}")
+        finally:
+            writer.close()
+
+    async def handle_hl7(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        try:
+            while True:
+                try:
+                    data = await reader.readuntil(MLLP_END)
+                except asyncio.IncompleteReadError:
+                    break
+                message = data[data.find(MLLP_START) + 1:-len(MLLP_END)].decode("utf-8", errors="replace")
+                results, control_id = parse_hl7_message(message, time.time())
+                await self.enqueue(results)
+                writer.write(hl7_ack(control_id))
+                await writer.drain()
+        except ConnectionError as e:
+            logger.warning(f"Connexion HL7 {peer} interrompue : {str(e)}")
+        finally:
+            writer.close()
+
+    async def start(self, host="0.0.0.0", astm_port=None, hl7_port=None, metrics_port=None):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._flusher = asyncio.create_task(self._flush_loop())
+        if astm_port:
+            self._servers.append(await asyncio.start_server(self.handle_astm, host, astm_port))
+            logger.info(f"Écoute ASTM sur {host}:{astm_port}")
+        if hl7_port:
+            self._servers.append(await asyncio.start_server(self.handle_hl7, host, hl7_port))
+            logger.info(f"Écoute HL7 sur {host}:{hl7_port}")
+        if metrics_port:
+            self._servers.append(await asyncio.start_server(self.handle_metrics, host, metrics_port))
+            logger.info(f"Métriques sur http://{host}:{metrics_port}/metrics")
+
+    async def stop(self):
+        """Ferme les serveurs puis attend l'écriture des résultats encore en file."""
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        await self.queue.join()
+        self._flusher.cancel()
+
+
+# --- Automate simulé ---
+
+def _read_messages(path):
+    """Fichier de capture : un enregistrement/segment par ligne, messages séparés par une ligne vide."""
+    with open(path, encoding="utf-8") as handle:
+        blocks = handle.read().replace("\r\n", "\n").split("\n\n")
+    return [[line for line in block.split("\n") if line.strip()] for block in blocks if block.strip()]
+
+
+async def replay_astm(host, port, path, delay=0.0):
+    """Rejoue une capture ASTM comme un automate : ENQ, trames numérotées avec checksum, EOT."""
+    reader, writer = await asyncio.open_connection(host, port)
+    for records in _read_messages(path):
+        writer.write(ENQ)
+        await writer.drain()
+        await reader.readexactly(1)
+        frame_number = 1
+        for record in records:
+            text = (record + "\r").encode("latin-1")
+            chunks = [text[i:i + ASTM_FRAME_SIZE] for i in range(0, len(text), ASTM_FRAME_SIZE)]
+            for i, chunk in enumerate(chunks):
+                end = ETX if i == len(chunks) - 1 else ETB
+                body = str(frame_number % 8).encode("ascii") + chunk
+                writer.write(STX + body + end + astm_checksum(body + end) + CR + LF)
+                await writer.drain()
+                if await reader.readexactly(1) != ACK:
+                    raise RuntimeError("Trame refusée par le serveur")
+                frame_number += 1
+        writer.write(EOT)
+        await writer.drain()
+        if delay:
+            await asyncio.sleep(delay)
+    writer.close()
+
+
+async def replay_hl7(host, port, path, delay=0.0):
+    """Rejoue une capture HL7 sur MLLP et attend l'ACK de chaque message."""
+    reader, writer = await asyncio.open_connection(host, port)
+    for segments in _read_messages(path):
+        writer.write(MLLP_START + "\r".join(segments).encode("utf-8") + b"\r" + MLLP_END)
+        await writer.drain()
+        await reader.readuntil(MLLP_END)
+        if delay:
+            await asyncio.sleep(delay)
+    writer.close()
+
+
+async def _serve(args):
+    from dotenv import load_dotenv
+    from database import create_engine_from_env, PoolMetrics
+
+    load_dotenv()
+    engine = create_engine_from_env(os.getenv("DATABASE_URL"))
+    pool_metrics = PoolMetrics().attach(engine)
+    importer = ResultImporter(engine, args.source, date_format="%Y%m%d%H%M%S", decimal_comma=False)
+    listener = ResultListener(importer, batch_size=args.batch_size, flush_interval=args.flush_interval,
+                              queue_size=args.queue_size, pool_metrics=pool_metrics)
+    await listener.start(args.host, args.astm_port, args.hl7_port, args.metrics_port)
+    while True:
+        await asyncio.sleep(60)
+        metrics, pool = listener.metrics, pool_metrics.snapshot(engine)
+        logger.info(f"Reçus {metrics.received}, écrits {metrics.written}, file {metrics.queue_depth}, "
+                    f"dernier lot {metrics.last_batch_size}, retard {metrics.last_lag:.2f}s, "
+                    f"connexions empruntées {pool['checked_out']}, attente pool {pool['wait_sum']:.2f}s "
+                    f"sur {pool['wait_count']} emprunts")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Réception des résultats d'automates (ASTM / HL7)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve")
+    serve.add_argument("--source", default="Automate")
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--astm-port", type=int, default=5001)
+    serve.add_argument("--hl7-port", type=int, default=5002)
+    serve.add_argument("--batch-size", type=int, default=500)
+    serve.add_argument("--flush-interval", type=float, default=0.5)
+    serve.add_argument("--queue-size", type=int, default=10000)
+    serve.add_argument("--metrics-port", type=int, default=9101, help="port HTTP de /metrics (0 : désactivé)")
+    replay = commands.add_parser("replay", help="automate simulé rejouant une capture")
+    replay.add_argument("protocol", choices=("astm", "hl7"))
+    replay.add_argument("capture")
+    replay.add_argument("--host", default="127.0.0.1")
+    replay.add_argument("--port", type=int, required=True)
+    replay.add_argument("--delay", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        asyncio.run(_serve(args))
+    else:
+        replay_function = replay_astm if args.protocol == "astm" else replay_hl7
+        asyncio.run(replay_function(args.host, args.port, args.capture, args.delay))
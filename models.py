@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Table, func, Boolean, TEXT, Enum, Index
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, Table, func, Boolean, TEXT, Enum, Index
 from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy import select, update, case
+from sqlalchemy.orm import relationship, Session, attributes
 from datetime import datetime
 import enum
 from passlib.context import CryptContext
@@ -29,6 +30,7 @@ class Patient(Base):
     is_active = Column(Boolean, nullable=True, default=True)  # Statut du patient (actif/archivé)
     date_derniere_consultation = Column(DateTime, nullable=True)  # Dernière consultation
     historique_maladies = Column(TEXT, nullable=True)  # Antécédents médicaux
+    updated_at = Column(DateTime, nullable=True, default=datetime.now, onupdate=datetime.now)  # Dernière mise à jour
 
     
     analyses = relationship("Analyse", back_populates="patient")
@@ -156,6 +158,7 @@ class Analyse(Base):
     stamped_at = Column(DateTime, nullable=True)  # Date de la griffe
     id_convention = Column(Integer, ForeignKey('conventions.id'), nullable=True)  # Clé étrangère vers la table Convention
     is_convention = Column(Boolean, default=False)  # Indique si l'analyse est liée à une convention
+    updated_at = Column(DateTime, nullable=True, default=datetime.now, onupdate=datetime.now)  # Dernière mise à jour
     #codeqr_path = Column(String, nullable=True)  # Chemin vers le 
 
     patient = relationship("Patient", back_populates="analyses")
@@ -221,6 +224,7 @@ class AnalyseDetail(Base):
     product_id = Column(Integer, ForeignKey('products.id'), nullable=True)  # ID du produit (réactif, contrôle, calibrant) utilisé
     tube_id = Column(Integer, ForeignKey('tubes.tube_id'), nullable=True)  # Nouveau champ pour le type de tube
     notes = Column(TEXT, nullable=True)  # Notes supplémentaires sur cet élément d'analyse
+    consumed_at = Column(DateTime, nullable=True)  # Date de décompte du réactif dans le stock (voir consumption.py)
     
     analyse = relationship("Analyse", back_populates="analyse_details")
     parameter = relationship("Parameter", back_populates="analyse_details")
@@ -243,11 +247,13 @@ class Resultat(Base):
     valeur = Column(Float, nullable=True)  # Valeur du résultat
     result_date = Column(DateTime, nullable=True, default=datetime.now)
     validateur_id = Column(Integer, ForeignKey('personals.id'), nullable=True)  # ID du validateur
+    validation_date = Column(DateTime, nullable=True)  # Date de validation
     comments = Column(TEXT, nullable=True)  # Commentaires sur le résultat
     validation_status= Column(String, nullable=True)
     import_source = Column(String, nullable=True)  # Exemple : "Cobas", "Manuel"
     import_reference = Column(String, nullable=True)  # Référence unique de l'automate
     import_date = Column(DateTime, nullable=True)  # Date de réception du résultat
+    updated_at = Column(DateTime, nullable=True, default=datetime.now, onupdate=datetime.now)  # Dernière mise à jour
     # Relation avec la table 'patients'
     patient = relationship("Patient", backref="resultats")
     parameter = relationship("Parameter", back_populates="resultats")
@@ -452,6 +458,7 @@ class ControlResult(Base):
     valeur_obtenue = Column(Float, nullable=False)  # Valeur mesurée lors du contrôle
     is_within_range = Column(Boolean, nullable=False)  # Indique si la valeur est dans la plage acceptable
     comments = Column(TEXT, nullable=True)  # Commentaires sur le résultat du contrôle
+    level = Column(String, nullable=True)  # Niveau du contrôle (ControlValue.type : "normal" ou "pathologique")
 
     product = relationship("Product", backref="control_results")
     parameter = relationship("Parameter", backref="control_results")
@@ -463,7 +470,10 @@ class ControlResult(Base):
     
     def validate_value(self, session):
         """Valide automatiquement si la valeur obtenue est dans la plage acceptable."""
-        control_values = session.query(ControlValue).filter_by(control_id=self.product.id).first()
+        query = session.query(ControlValue).filter_by(product_id=self.product_id)
+        if self.level:
+            query = query.filter_by(type=self.level)
+        control_values = query.first()
         if control_values:
             self.is_within_range = (control_values.valeur_min <= self.valeur_obtenue <= control_values.valeur_max)
         else:
@@ -658,6 +668,7 @@ class BacterioResult(Base):
     stamped_by = Column(Integer, ForeignKey('personals.id'), nullable=True)  # ID du personnel qui a apposé la griffe
     stamped_at = Column(DateTime, nullable=True)  # Date de la griffe
     type_prelevement = Column(String, nullable=True)
+    updated_at = Column(DateTime, nullable=True, default=datetime.now, onupdate=datetime.now)  # Dernière mise à jour
     antibio_results = relationship("AntibioResult", back_populates="bacterio_results")
     analyse = relationship("Analyse", back_populates="bacterio_results")    
 # Table d'association entre Germes et Milieux de culture
@@ -667,6 +678,13 @@ germes_milieux = Table(
     Column('milieu_id', Integer, ForeignKey('milieux_culture.id'), primary_key=True)
 )
 
+# Table d'association entre Germes et groupes d'antibiotiques (panel recommandé pour le germe)
+germes_antibio_groups = Table(
+    'germes_antibio_groups', Base.metadata,
+    Column('germe_id', Integer, ForeignKey('germes.id'), primary_key=True),
+    Column('group_id', Integer, ForeignKey('antibio_groups.group_id'), primary_key=True)
+)
+
 class Germe(Base):
     __tablename__ = 'germes'
     
@@ -686,6 +704,7 @@ class Germe(Base):
     # Relations
     resistances = relationship("Resistance", back_populates="germe")
     milieux_culture = relationship("MilieuCulture", secondary=germes_milieux, back_populates="germes")
+    antibio_groups = relationship("AntibioGroup", secondary=germes_antibio_groups, backref="germes")
 
 class MilieuCulture(Base):
     __tablename__ = 'milieux_culture'
@@ -726,6 +745,7 @@ class AntibioResult(Base):
     resultat = Column(String, nullable=True)  # Exemple : "Sensible", "Résistant", "Intermédiaire"
     diametre = Column(Float, nullable=True)
     cmi = Column(Float, nullable=True)
+    updated_at = Column(DateTime, nullable=True, default=datetime.now, onupdate=datetime.now)  # Dernière mise à jour
     
     bacterio_results = relationship("BacterioResult", back_populates="antibio_results")
     antibiotique = relationship("Antibiotique", back_populates="antibio_results")
@@ -767,6 +787,11 @@ class ImportLog(Base):
     import_date = Column(DateTime, nullable=False, default=datetime.now)
     status = Column(String, nullable=False)  # Exemple : "SUCCESS", "ERROR"
     error_message = Column(TEXT, nullable=True)  # Détails en cas d'erreur
+    nb_lignes = Column(Integer, nullable=True)  # Nombre de lignes lues dans le fichier
+    nb_importes = Column(Integer, nullable=True)  # Nombre de résultats insérés
+    nb_doublons = Column(Integer, nullable=True)  # Lignes ignorées (import_reference déjà connue)
+    nb_rejets = Column(Integer, nullable=True)  # Lignes rejetées (échantillon/paramètre inconnu, valeur invalide)
+    duree_secondes = Column(Float, nullable=True)  # Durée de l'import
 
 
 class Barcode(Base):
@@ -799,6 +824,11 @@ class Frottis(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     analyse_id = Column(Integer, ForeignKey("analyses.id"), nullable=False)  # Lien avec la table patients
     type_frottis = Column(String, nullable=True)
+    validateur_id = Column(Integer, ForeignKey('personals.id'), nullable=True)  # ID du personnel ayant validé le résultat
+    validation_date = Column(DateTime, nullable=True)
+    is_stamped = Column(Boolean, nullable=False, default=False)  # Indique si le résultat a reçu une griffe
+    stamped_by = Column(Integer, ForeignKey('personals.id'), nullable=True)  # ID du personnel qui a apposé la griffe
+    stamped_at = Column(DateTime, nullable=True)  # Date de la griffe
     #frottis du sang peripherique
     comment_hematies1 = Column(String, nullable=True)  # Nombre d'hématies observées
     comment_hematies2 = Column(String, nullable=True)  # Nombre d'hématies observées
@@ -1010,15 +1040,71 @@ class SuiviPaiementConvention(Base):
         return (f"<SuiviPaiementConvention(id={self.id}, facture_id={self.facture_id}, "
                 f"montant_paye={self.montant_paye}, mode_paiement='{self.mode_paiement}', "
                 f"date_paiement='{self.date_paiement}')>")
-# Ajoutez ici le décorateur et la fonction d'événement
-@event.listens_for(SuiviPaiementConvention, 'after_insert')
-def update_solde_restant(mapper, connection, target):
-    Session = sessionmaker(bind=connection)
-    session = Session()
-    facture = session.query(FactureConvention).get(target.facture_id)
-    if facture:
-        facture.solde_restant = max(0, facture.montant_total - facture.montant_paye)
-        session.commit()
+def recompute_factures_conventions(connection, facture_ids):
+    """
+    Recalcule montant_paye, solde_restant, statut_paiement et date_paiement_complet
+    des factures données à partir de la somme de leurs SuiviPaiementConvention,
+    en une seule requête UPDATE ensembliste (dans la transaction de la connexion).
+    Les factures sont d'abord verrouillées (SELECT ... FOR UPDATE, par id croissant) :
+    l'UPDATE voit ainsi les paiements validés entre-temps par d'autres transactions.
+    """
+    facture_ids = sorted({facture_id for facture_id in facture_ids if facture_id is not None})
+    if not facture_ids:
+        return
+    factures = FactureConvention.__table__
+    paiements = SuiviPaiementConvention.__table__
+    connection.execute(
+        select(factures.c.id).where(factures.c.id.in_(facture_ids)).order_by(factures.c.id).with_for_update()
+    ).all()
+
+    total_paye = (
+        select(func.coalesce(func.sum(paiements.c.montant_paye), 0.0))
+        .where(paiements.c.facture_id == factures.c.id)
+        .scalar_subquery()
+    )
+    dernier_paiement = (
+        select(func.max(paiements.c.date_paiement))
+        .where(paiements.c.facture_id == factures.c.id)
+        .scalar_subquery()
+    )
+    connection.execute(
+        update(factures)
+        .where(factures.c.id.in_(facture_ids))
+        .values(
+            montant_paye=total_paye,
+            solde_restant=case((factures.c.montant_total - total_paye > 0, factures.c.montant_total - total_paye),
+                               else_=0.0),
+            statut_paiement=case((total_paye >= factures.c.montant_total, "paye"),
+                                 (total_paye > 0, "paye_partiel"),
+                                 else_="en_attente"),
+            date_paiement_complet=case((total_paye >= factures.c.montant_total,
+                                        func.coalesce(factures.c.date_paiement_complet, dernier_paiement)),
+                                       else_=None),
+            updated_at=datetime.now(),
+        )
+    )
+
+
+@event.listens_for(Session, 'after_flush')
+def update_solde_restant(session, flush_context):
+    """Un seul UPDATE par flush pour toutes les factures touchées par des paiements."""
+    facture_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, SuiviPaiementConvention):
+            facture_ids.add(obj.facture_id)
+            facture_ids.update(attributes.get_history(obj, 'facture_id').deleted or ())
+        elif isinstance(obj, FactureConvention) and obj not in session.deleted:
+            if attributes.get_history(obj, 'montant_total').has_changes():
+                facture_ids.add(obj.id)
+    facture_ids.discard(None)
+    if not facture_ids:
+        return
+    recompute_factures_conventions(session.connection(), facture_ids)
+    # Les factures déjà chargées dans la session doivent relire les montants recalculés
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, FactureConvention) and obj.id in facture_ids:
+            session.expire(obj, ['montant_paye', 'solde_restant', 'statut_paiement',
+                                 'date_paiement_complet', 'updated_at'])
         
 class Transaction(Base):
     __tablename__ = 'transactions'
@@ -1177,14 +1263,76 @@ class FactureSousTraitance(Base):
     def __repr__(self):
         return f"<FactureSousTraitance(id={self.id}, analyse_id={self.analyse_id}, total={self.cout_sous_traitance_total}, statut='{self.statut}')>"
 
+class RevenuJournalier(Base):
+    """Agrégats journaliers du chiffre d'affaires et des encaissements, tenus à jour par rollups.py"""
+    __tablename__ = 'revenus_journaliers'
+    jour = Column(Date, primary_key=True)
+    mode_paiement = Column(String, primary_key=True, default="")  # "" si non renseigné
+    convention_id = Column(Integer, primary_key=True, default=0)  # 0 : hors convention
+    medecin = Column(String, primary_key=True, default="")  # Prescripteur, "" si non renseigné
+    nb_analyses = Column(Integer, nullable=False, default=0)
+    facture = Column(Float, nullable=False, default=0.0)  # Somme de Analyse.facture
+    fac_remise = Column(Float, nullable=False, default=0.0)  # Somme de Analyse.fac_remise
+    montant_p = Column(Float, nullable=False, default=0.0)  # Somme de Analyse.montant_p
+    montant_r = Column(Float, nullable=False, default=0.0)  # Somme de Analyse.montant_r
+    encaissements = Column(Float, nullable=False, default=0.0)  # Somme de Paiement.montant
+    encaissements_convention = Column(Float, nullable=False, default=0.0)  # Somme de SuiviPaiementConvention.montant_paye
+    achats = Column(Float, nullable=False, default=0.0)  # Somme de FactureAchat.montant_total
+
+    def __repr__(self):
+        return (f"<RevenuJournalier(jour={self.jour}, mode_paiement='{self.mode_paiement}', "
+                f"convention_id={self.convention_id}, medecin='{self.medecin}', facture={self.facture})>")
+
+
+class QCSerieState(Base):
+    """État Westgard persistant d'une série de contrôle, tenu à jour par qc.py (une ligne par série)"""
+    __tablename__ = 'qc_series_states'
+    product_id = Column(Integer, ForeignKey('products.id'), primary_key=True)
+    parameter_id = Column(Integer, ForeignKey('parameters.parameter_id'), primary_key=True)
+    level = Column(String, primary_key=True, default="")  # "" si le niveau n'est pas renseigné
+    n = Column(Integer, nullable=False, default=0)  # Nombre de points de la série
+    mean = Column(Float, nullable=False, default=0.0)  # Moyenne courante (Welford)
+    m2 = Column(Float, nullable=False, default=0.0)  # Somme des carrés des écarts à la moyenne (Welford)
+    last_z = Column(Float, nullable=True)  # Écart réduit du dernier point évalué
+    side = Column(Integer, nullable=False, default=0)  # Côté de la moyenne de la série en cours
+    side_run = Column(Integer, nullable=False, default=0)
+    side_1s = Column(Integer, nullable=False, default=0)  # Côté de la série en cours au-delà de 1 écart-type
+    run_1s = Column(Integer, nullable=False, default=0)
+    side_2s = Column(Integer, nullable=False, default=0)  # Côté de la série en cours au-delà de 2 écarts-types
+    run_2s = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=True, default=datetime.now, onupdate=datetime.now)  # Dernière mise à jour
+
+    def __repr__(self):
+        return (f"<QCSerieState(product_id={self.product_id}, parameter_id={self.parameter_id}, "
+                f"level='{self.level}', n={self.n}, mean={self.mean})>")
+
+
 # Ajout des index pour optimiser les performances
 Index('idx_patient_barcode', Patient.patient_barcode)
 Index('idx_analyse_dossier_barcode', Analyse.dossier_barcode)
 Index('idx_resultat_analyse_id', Resultat.analyse_id)
 Index('idx_resultat_parameter_id', Resultat.parameter_id)
+Index('idx_resultat_patient_id', Resultat.patient_id)
+Index('idx_resultat_patient_parameter_date', Resultat.patient_id, Resultat.parameter_id, Resultat.result_date,
+      Resultat.id)
+Index('idx_resultat_import_reference', Resultat.import_reference)
 Index('idx_analyse_detail_analyse_id', AnalyseDetail.analyse_id)
 Index('idx_analyse_detail_parameter_id', AnalyseDetail.parameter_id)
 Index('idx_analyse_patient_id', Analyse.patient_id)
+Index('idx_analyse_date', Analyse.analyse_date)
+Index('idx_nfs_analyse_id', NumerationFormuleSanguine.analyse_id)
+Index('idx_groupage_analyse_id', GroupageSanguin.analyse_id)
+Index('idx_bacterio_analyse_id', BacterioResult.analyse_id)
+# Une ligne par (isolat, antibiotique) : garantit l'idempotence de panels.create_panels
+Index('idx_antibio_result_bacterio_antibiotique', AntibioResult.bacterio_result_id, AntibioResult.antibiotique_id,
+      unique=True)
+Index('idx_spermogramme_analyse_id', SpermogrammeResult.analyse_id)
+Index('idx_analyse_convention_date', Analyse.id_convention, Analyse.analyse_date)
+Index('idx_analyse_facture_analyse_id', AnalyseFacture.analyse_id)
 Index('idx_parameter_categorie_id', Parameter.categorie_id)
 Index('idx_product_supplier_id', Product.supplier_id)
+Index('idx_product_expiration', Product.expiration)
+# Index partiel : seuls les détails non encore décomptés (file de consumption.py) y figurent
+Index('idx_analyse_detail_consumed_at', AnalyseDetail.id,
+      postgresql_where=AnalyseDetail.consumed_at.is_(None), sqlite_where=AnalyseDetail.consumed_at.is_(None))
 Index('idx_facture_achat_fournisseur_id', FactureAchat.fournisseur_id)
@@ -0,0 +1,199 @@
+"""
+Panels d'antibiogramme par germe.
+
+PanelIndex garde en mémoire, pour chaque Germe, le panel recommandé : les
+antibiotiques des AntibioGroup associés au germe (germes_antibio_groups), plus ceux
+de ses résistances naturelles (Resistance), marquées intrinsèques. L'index est
+chargé en trois requêtes, reconstruit au prochain usage après toute écriture ORM sur
+les tables concernées (register_refresh, après commit), et au plus tard après max_age
+secondes.
+
+create_panels prépare en un seul INSERT les lignes AntibioResult d'un lot
+d'isolats : une ligne par antibiotique du panel, les résistances naturelles déjà
+renseignées « Résistant ». Les lignes déjà présentes ne sont pas recréées : l'index
+unique idx_antibio_result_bacterio_antibiotique et un INSERT ... ON CONFLICT DO
+NOTHING (PostgreSQL, SQLite ; ailleurs INSERT ... WHERE NOT EXISTS) évitent les
+doublons même quand deux postes préparent le même isolat en même temps. Sur une
+base existante, supprimer les doublons (isolat, antibiotique) avant de créer l'index.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import event, exists, insert, literal, select
+from sqlalchemy.orm import Session, object_session
+from models import (AntibioGroup, AntibioResult, Antibiotique, BacterioResult, Germe, Resistance,
+                    germes_antibio_groups, group_antibiotiques_table)
+
+logger = logging.getLogger(__name__)
+
+PanelEntry = namedtuple("PanelEntry", ["antibiotique_id", "code", "nom", "intrinseque"])
+PanelResult = namedtuple("PanelResult", ["nb_isolats", "nb_lignes", "sans_germe"])
+
+RESULTAT_INTRINSEQUE = "Résistant"
+
+_PENDING_KEY = "panels_modifies"
+
+
+class PanelIndex:
+    """Index germe -> panel d'antibiotiques (tuples de PanelEntry triés par nom)."""
+
+    def __init__(self, engine, max_age=300):
+        self.engine = engine
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._built_at = None
+        self._stale = True
+        self._antibiotiques = {}
+        self._groups = {}
+        self._germe_groups = {}
+        self._intrinsic = {}
+        self._panels = {}
+
+    def invalidate(self):
+        self._stale = True
+
+    def needs_refresh(self):
+        return self._stale or self._built_at is None or time.monotonic() - self._built_at > self.max_age
+
+    def refresh(self):
+        """Recharge antibiotiques, groupes et résistances naturelles en trois requêtes."""
+        antibiotiques = Antibiotique.__table__
+        resistances = Resistance.__table__
+        with self.engine.connect() as connection:
+            antibiotique_rows = connection.execute(
+                select(antibiotiques.c.id, antibiotiques.c.code, antibiotiques.c.nom)).all()
+            group_rows = connection.execute(
+                select(group_antibiotiques_table.c.group_id, group_antibiotiques_table.c.antibiotique_id)).all()
+            germe_group_rows = connection.execute(
+                select(germes_antibio_groups.c.germe_id, germes_antibio_groups.c.group_id)).all()
+            resistance_rows = connection.execute(
+                select(resistances.c.germe_id, resistances.c.antibiotique_id)).all()
+        return self.build(antibiotique_rows, group_rows, germe_group_rows, resistance_rows)
+
+    def build(self, antibiotique_rows, group_rows, germe_group_rows, resistance_rows):
+        antibiotiques = {row[0]: row for row in antibiotique_rows}
+        groups, germe_groups, intrinsic = {}, {}, {}
+        for group_id, antibiotique_id in group_rows:
+            groups.setdefault(group_id, set()).add(antibiotique_id)
+        for germe_id, group_id in germe_group_rows:
+            germe_groups.setdefault(germe_id, set()).add(group_id)
+        for germe_id, antibiotique_id in resistance_rows:
+            intrinsic.setdefault(germe_id, set()).add(antibiotique_id)
+        with self._lock:
+            self._antibiotiques = antibiotiques
+            self._groups = {group_id: frozenset(ids) for group_id, ids in groups.items()}
+            self._germe_groups = {germe_id: tuple(sorted(ids)) for germe_id, ids in germe_groups.items()}
+            self._intrinsic = {germe_id: frozenset(ids) for germe_id, ids in intrinsic.items()}
+            self._panels = {}
+            self._built_at = time.monotonic()
+            self._stale = False
+        logger.info(f"Index des panels chargé : {len(antibiotiques)} antibiotiques, {len(groups)} groupes")
+        return self
+
+    def ensure_fresh(self):
+        if self.needs_refresh():
+            self.refresh()
+        return self
+
+    def panel(self, germe_id, group_ids=None):
+        """
+        Panel du germe : antibiotiques des groupes donnés (à défaut, ceux associés au
+        germe) et résistances naturelles du germe, marquées intrinsèques.
+        """
+        self.ensure_fresh()
+        with self._lock:
+            antibiotiques, groups, panels = self._antibiotiques, self._groups, self._panels
+            intrinsic = self._intrinsic.get(germe_id, frozenset())
+            if group_ids is None:
+                group_ids = self._germe_groups.get(germe_id, ())
+        key = (germe_id, tuple(sorted(set(group_ids))))
+        panel = panels.get(key)
+        if panel is None:
+            ids = intrinsic.union(*(groups.get(group_id, ()) for group_id in key[1]))
+            panel = panels[key] = tuple(sorted(
+                (PanelEntry(antibiotique_id, *antibiotiques[antibiotique_id][1:], antibiotique_id in intrinsic)
+                 for antibiotique_id in ids if antibiotique_id in antibiotiques),
+                key=lambda entry: entry.nom))
+        return panel
+
+
+def create_panels(connection, panel_index, bacterio_ids, group_ids=None):
+    """
+    Prépare les AntibioResult des isolats (BacterioResult.id) selon le panel de leur
+    germe identifié, en un INSERT. Les isolats sans germe sont ignorés, les lignes
+    (isolat, antibiotique) déjà présentes, y compris insérées entre-temps par une
+    autre transaction, ne sont pas dupliquées. Retourne un PanelResult (nb_lignes :
+    lignes réellement insérées).
+    """
+    bacterio = BacterioResult.__table__
+    antibio = AntibioResult.__table__
+    bacterio_ids = list(set(bacterio_ids))
+    germes = dict(connection.execute(
+        select(bacterio.c.id, bacterio.c.germe_identifie).where(bacterio.c.id.in_(bacterio_ids))).all())
+    existing = set(connection.execute(
+        select(antibio.c.bacterio_result_id, antibio.c.antibiotique_id)
+        .where(antibio.c.bacterio_result_id.in_(bacterio_ids))).all())
+
+    rows = []
+    sans_germe = sorted(bacterio_id for bacterio_id in bacterio_ids if germes.get(bacterio_id) is None)
+    for bacterio_id in sorted(bacterio_ids):
+        if germes.get(bacterio_id) is None:
+            continue
+        for entry in panel_index.panel(germes[bacterio_id], group_ids):
+            if (bacterio_id, entry.antibiotique_id) not in existing:
+                rows.append({"bacterio_result_id": bacterio_id, "antibiotique_id": entry.antibiotique_id,
+                             "resultat": RESULTAT_INTRINSEQUE if entry.intrinseque else None})
+    return PanelResult(len(bacterio_ids) - len(sans_germe), _insert_missing(connection, rows), sans_germe)
+
+
+def _insert_missing(connection, rows):
+    """Insère les lignes AntibioResult absentes, sans erreur sur celles déjà présentes. Retourne le nombre inséré."""
+    if not rows:
+        return 0
+    antibio = AntibioResult.__table__
+    dialect = connection.dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        statement = upsert(antibio).values(rows).on_conflict_do_nothing(
+            index_elements=[antibio.c.bacterio_result_id, antibio.c.antibiotique_id])
+        return connection.execute(statement).rowcount
+    inserted = 0
+    for row in rows:
+        present = (exists().where(antibio.c.bacterio_result_id == row["bacterio_result_id"])
+                   .where(antibio.c.antibiotique_id == row["antibiotique_id"]))
+        inserted += connection.execute(insert(antibio).from_select(
+            ["bacterio_result_id", "antibiotique_id", "resultat"],
+            select(literal(row["bacterio_result_id"]), literal(row["antibiotique_id"]),
+                   literal(row["resultat"], AntibioResult.resultat.type)).where(~present))).rowcount
+    return inserted
+
+
+def register_refresh(panel_index):
+    """
+    Reconstruit l'index au prochain usage après le commit de toute écriture ORM sur
+    les antibiotiques, groupes, germes ou résistances.
+    """
+
+    def _track(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info[_PENDING_KEY] = True
+
+    def _after_commit(session):
+        if session.info.pop(_PENDING_KEY, None):
+            panel_index.invalidate()
+
+    def _after_rollback(session):
+        session.info.pop(_PENDING_KEY, None)
+
+    # Les collections (AntibioGroup.antibiotiques, Germe.antibio_groups) marquent leur parent modifié
+    for model in (Antibiotique, AntibioGroup, Germe, Resistance):
+        for event_name in ("after_insert", "after_update", "after_delete"):
+            event.listen(model, event_name, _track)
+    event.listen(Session, "after_commit", _after_commit)
+    event.listen(Session, "after_rollback", _after_rollback)
+    return panel_index
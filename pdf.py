@@ -0,0 +1,129 @@
+"""
+Écriture de documents PDF en flux : chaque page est écrite dans le fichier dès
+qu'elle est ajoutée, seule la table des objets (xref) reste en mémoire. Le nombre
+de pages n'a donc pas d'effet sur la mémoire utilisée.
+"""
+import zlib
+
+A4 = (595.28, 841.89)  # en points (1/72 de pouce)
+
+
+def encode_image(image):
+    """
+    Encode une image PIL (modes '1', 'L' ou 'RGB', les autres sont convertis en RGB)
+    en objet image PDF compressé (FlateDecode) : (dictionnaire, flux). Le résultat peut
+    être gardé en cache et écrit tel quel dans plusieurs documents.
+    """
+    if image.mode not in ("1", "L", "RGB"):
+        image = image.convert("RGB")
+    colorspace = b"/DeviceRGB" if image.mode == "RGB" else b"/DeviceGray"
+    bits = 1 if image.mode == "1" else 8
+    return (
+        b"<</Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent %d"
+        b" /Filter /FlateDecode>>" % (image.width, image.height, colorspace, bits),
+        zlib.compress(image.tobytes(), 6),
+    )
+
+
+def text_string(text):
+    """Chaîne PDF littérale en WinAnsiEncoding (cp1252), caractères spéciaux échappés."""
+    data = str(text).encode("cp1252", errors="replace")
+    return b"(" + data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+class PdfStreamWriter:
+    """Écrit un PDF page par page dans un flux binaire (fichier, réponse HTTP, ...)."""
+
+    def __init__(self, out, page_size=A4):
+        self.out = out
+        self.page_size = page_size
+        self._offsets = {}
+        self._position = 0
+        self._next_id = 3  # 1 : catalogue, 2 : arbre des pages (écrits à la fin)
+        self._pages = []
+        self._resources = {}
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write(self, data):
+        self.out.write(data)
+        self._position += len(data)
+
+    def reserve(self):
+        object_id = self._next_id
+        self._next_id += 1
+        return object_id
+
+    def write_object(self, body, stream=None, object_id=None):
+        """
+        Écrit un objet : body est un dictionnaire PDF (b"<<...>>") ; avec un flux, sa
+        longueur (/Length) y est ajoutée. Retourne le numéro de l'objet.
+        """
+        object_id = object_id or self.reserve()
+        self._offsets[object_id] = self._position
+        if stream is not None:
+            body = body[:-2] + b" /Length %d>>" % len(stream)
+            self._write(b"%d 0 obj\n%s\nstream\n" % (object_id, body) + stream + b"\nendstream\nendobj\n")
+        else:
+            self._write(b"%d 0 obj\n%s\nendobj\n" % (object_id, body))
+        return object_id
+
+    def shared_resource(self, key, factory):
+        """Objet écrit une seule fois et référencé par toutes les pages (police, logo, ...)."""
+        if key not in self._resources:
+            self._resources[key] = factory(self)
+        return self._resources[key]
+
+    def image_object(self, image):
+        """Écrit une image PIL (voir encode_image). Retourne son numéro."""
+        return self.write_object(*encode_image(image))
+
+    def font_object(self, base_font="Helvetica"):
+        """Police standard PDF (Helvetica, Helvetica-Bold, ...), écrite une fois par document."""
+        return self.shared_resource(("font", base_font), lambda writer: writer.write_object(
+            b"<</Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding>>" % base_font.encode("ascii")))
+
+    def add_page(self, content, xobjects=None, fonts=None):
+        """
+        Ajoute une page : content est le flux de dessin PDF (bytes), xobjects et fonts
+        associent un nom de ressource (ex. b"Im1", b"F1") à un numéro d'objet.
+        """
+        resources = b""
+        if xobjects:
+            resources += b"/XObject <<" + b" ".join(b"/%s %d 0 R" % (name, object_id)
+                                                    for name, object_id in xobjects.items()) + b">>"
+        if fonts:
+            resources += b"/Font <<" + b" ".join(b"/%s %d 0 R" % (name, object_id)
+                                                 for name, object_id in fonts.items()) + b">>"
+        content_id = self.write_object(b"<</Filter /FlateDecode>>", zlib.compress(content, 6))
+        page_id = self.write_object(
+            b"<</Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] /Resources <<%s>> /Contents %d 0 R>>"
+            % (self.page_size[0], self.page_size[1], resources, content_id)
+        )
+        self._pages.append(page_id)
+        return page_id
+
+    def add_image_page(self, image):
+        """Ajoute une page entièrement occupée par une image PIL."""
+        image_id = self.image_object(image)
+        width, height = self.page_size
+        return self.add_page(b"q %.2f 0 0 %.2f 0 0 cm /Im1 Do Q" % (width, height), xobjects={b"Im1": image_id})
+
+    @property
+    def page_count(self):
+        return len(self._pages)
+
+    def close(self):
+        """Écrit l'arbre des pages, le catalogue et la table xref. Ne ferme pas le flux."""
+        self.write_object(
+            b"<</Type /Pages /Kids [%s] /Count %d>>" % (b" ".join(b"%d 0 R" % page_id for page_id in self._pages),
+                                                       len(self._pages)),
+            object_id=2,
+        )
+        self.write_object(b"<</Type /Catalog /Pages 2 0 R>>", object_id=1)
+        xref_position = self._position
+        size = self._next_id
+        lines = [b"xref\n0 %d\n" % size, b"0000000000 65535 f \n"]
+        for object_id in range(1, size):
+            lines.append(b"%010d 00000 n \n" % self._offsets.get(object_id, 0))
+        self._write(b"".join(lines))
+        self._write(b"trailer\n<</Size %d /Root 1 0 R>>\nstartxref\n%d\n%%%%EOF\n" % (size, xref_position))
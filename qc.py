@@ -0,0 +1,341 @@
+"""
+Contrôle qualité interne : cartes de Levey-Jennings et règles de Westgard.
+
+L'état de chaque série (produit, paramètre, niveau) est tenu incrémentalement :
+moyenne / écart-type courants (algorithme de Welford) et compteurs de séries
+consécutives, si bien qu'un nouveau point est évalué en O(1), sans relire
+control_results. Cet état est persistant (table qc_series_states) : chaque lot
+validé relit puis réécrit l'état de ses séries dans sa transaction (verrouillé sur
+PostgreSQL), si bien que les règles 2-2s, 4-1s et 10x portent sur toute la série
+quels que soient le processus et les redémarrages.
+
+register_validation(qc_engine), à appeler au démarrage des processus qui écrivent,
+valide chaque ControlResult inséré par l'ORM juste avant le flush. Les cibles
+(ControlValue) sont relues après max_age secondes et après toute écriture ORM sur
+ControlValue dans le processus.
+
+Le mode backfill reconstruit l'état de toutes les séries pour l'historique en un
+seul parcours ordonné par control_date (index ix_control_results_control_date) ;
+à lancer une fois à la création de qc_series_states.
+
+Usage : python qc.py backfill [--update]
+"""
+import argparse
+import logging
+import math
+import os
+import time
+from collections import namedtuple
+from sqlalchemy import and_, event, insert, select, bindparam, update
+from sqlalchemy.orm import Session
+from models import ControlResult, ControlValue, QCSerieState
+
+logger = logging.getLogger(__name__)
+
+# Règles de Westgard : 1-2s n'est qu'un avertissement, les autres rejettent la série
+REGLE_1_2S, REGLE_1_3S, REGLE_2_2S, REGLE_R_4S, REGLE_4_1S, REGLE_10X = "1-2s", "1-3s", "2-2s", "R-4s", "4-1s", "10x"
+REGLES_REJET = (REGLE_1_3S, REGLE_2_2S, REGLE_R_4S, REGLE_4_1S, REGLE_10X)
+
+# Nombre minimal de points avant d'utiliser la moyenne / l'écart-type observés comme cible
+MIN_POINTS_STATISTIQUES = 20
+
+QCEvaluation = namedtuple("QCEvaluation", ["z", "mean", "sd", "regles", "accepte"])
+
+SERIE_KEY = ("product_id", "parameter_id", "level")
+
+_engine = None
+
+
+def _sign(value):
+    return (value > 0) - (value < 0)
+
+
+class SerieState:
+    """État incrémental d'une série de contrôle (produit, paramètre, niveau)."""
+
+    __slots__ = ("n", "mean", "m2", "last_z", "side", "side_run", "side_1s", "run_1s", "side_2s", "run_2s")
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.last_z = None
+        self.side = self.side_run = 0
+        self.side_1s = self.run_1s = 0
+        self.side_2s = self.run_2s = 0
+
+    @classmethod
+    def from_row(cls, row):
+        """État lu dans qc_series_states."""
+        state = cls()
+        for name in cls.__slots__:
+            setattr(state, name, row[name])
+        return state
+
+    def values(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @property
+    def sd(self):
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+    def add(self, value):
+        """Mise à jour de Welford de la moyenne et de la somme des carrés des écarts."""
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    @staticmethod
+    def _run(current_side, current_len, side):
+        if side and side == current_side:
+            return side, current_len + 1
+        return side, 1 if side else 0
+
+    def evaluate(self, z):
+        """Applique les règles de Westgard au point z (écart réduit) et met à jour les compteurs."""
+        side = _sign(z)
+        self.side, self.side_run = self._run(self.side, self.side_run, side)
+        self.side_1s, self.run_1s = self._run(self.side_1s, self.run_1s, side if abs(z) > 1 else 0)
+        self.side_2s, self.run_2s = self._run(self.side_2s, self.run_2s, side if abs(z) > 2 else 0)
+
+        regles = []
+        if abs(z) > 3:
+            regles.append(REGLE_1_3S)
+        elif abs(z) > 2:
+            regles.append(REGLE_1_2S)
+        if self.run_2s >= 2:
+            regles.append(REGLE_2_2S)
+        if self.last_z is not None and abs(z) > 2 and abs(self.last_z) > 2 and _sign(self.last_z) != side \
+                and abs(z - self.last_z) > 4:
+            regles.append(REGLE_R_4S)
+        if self.run_1s >= 4:
+            regles.append(REGLE_4_1S)
+        if self.side_run >= 10:
+            regles.append(REGLE_10X)
+        self.last_z = z
+        return regles
+
+
+class QCEngine:
+    """
+    Évalue les résultats de contrôle par rapport aux cibles de ControlValue
+    (moyenne = milieu de [valeur_min, valeur_max], écart-type = ecart_type) ou, à
+    défaut, aux statistiques observées de la série.
+    """
+
+    def __init__(self, max_age=300):
+        self.series = {}
+        self.targets = {}
+        self.max_age = max_age
+        self._targets_at = None
+
+    def invalidate_targets(self):
+        self.targets = {}
+        self._targets_at = None
+
+    @staticmethod
+    def key(product_id, parameter_id, level):
+        return product_id, parameter_id, level or ""
+
+    def load_targets(self, connection, product_ids=None):
+        """Charge en une requête les valeurs cibles (ControlValue) des produits donnés, ou de tous."""
+        if self._targets_at is None or time.monotonic() - self._targets_at > self.max_age:
+            self.targets = {}
+            self._targets_at = time.monotonic()
+        control_values = ControlValue.__table__
+        query = select(control_values.c.product_id, control_values.c.type, control_values.c.valeur_min,
+                       control_values.c.valeur_max, control_values.c.ecart_type)
+        if product_ids is not None:
+            product_ids = [product_id for product_id in set(product_ids) if (product_id, "") not in self.targets]
+            if not product_ids:
+                return
+            query = query.where(control_values.c.product_id.in_(product_ids))
+        for product_id, level, valeur_min, valeur_max, ecart_type in connection.execute(query):
+            target = ((valeur_min + valeur_max) / 2, ecart_type, valeur_min, valeur_max)
+            self.targets[(product_id, level or "")] = target
+            # Cible par défaut du produit quand le résultat n'indique pas de niveau
+            self.targets.setdefault((product_id, ""), target)
+
+    def evaluate(self, product_id, parameter_id, level, value):
+        """Évalue un nouveau point en O(1) et l'ajoute à la série. Retourne un QCEvaluation."""
+        key = self.key(product_id, parameter_id, level)
+        state = self.series.get(key)
+        if state is None:
+            state = self.series[key] = SerieState()
+
+        target = self.targets.get((product_id, level or "")) or self.targets.get((product_id, ""))
+        if target and target[1] > 0:
+            mean, sd = target[0], target[1]
+        elif state.n >= MIN_POINTS_STATISTIQUES and state.sd > 0:
+            mean, sd = state.mean, state.sd
+        else:
+            mean, sd = None, None
+
+        if sd:
+            z = (value - mean) / sd
+            regles = state.evaluate(z)
+        else:
+            z, regles = None, []
+        accepte = not any(regle in REGLES_REJET for regle in regles)
+        if target and not (target[2] <= value <= target[3]):
+            accepte = False
+        state.add(value)
+        return QCEvaluation(z, mean, sd, regles, accepte)
+
+    def load_series(self, connection, keys):
+        """
+        Relit en une requête l'état persistant des séries données (verrouillé jusqu'à la
+        fin de la transaction sur PostgreSQL) ; une série absente repart de zéro.
+        """
+        states = QCSerieState.__table__
+        keys = set(keys)
+        for key in keys:
+            self.series[key] = SerieState()
+        if not keys:
+            return
+        rows = connection.execute(
+            select(states)
+            .where(states.c.product_id.in_({key[0] for key in keys}))
+            .where(states.c.parameter_id.in_({key[1] for key in keys}))
+            .order_by(*(states.c[name] for name in SERIE_KEY))
+            .with_for_update()
+        ).mappings()
+        for row in rows:
+            key = tuple(row[name] for name in SERIE_KEY)
+            if key in keys:
+                self.series[key] = SerieState.from_row(row)
+
+    def save_series(self, connection, keys):
+        """Écrit l'état des séries données (upsert sur PostgreSQL et SQLite)."""
+        rows = [dict(zip(SERIE_KEY, key), **self.series[key].values()) for key in sorted(set(keys))]
+        if not rows:
+            return
+        table = QCSerieState.__table__
+        dialect = connection.dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            if dialect == "postgresql":
+                from sqlalchemy.dialects.postgresql import insert as upsert
+            else:
+                from sqlalchemy.dialects.sqlite import insert as upsert
+            statement = upsert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=list(SERIE_KEY),
+                set_={name: statement.excluded[name] for name in SerieState.__slots__ + ("updated_at",)},
+            )
+            connection.execute(statement, rows)
+            return
+        for row in rows:
+            key = and_(*(table.c[name] == row[name] for name in SERIE_KEY))
+            if not connection.execute(update(table).where(key).values(row)).rowcount:
+                connection.execute(insert(table).values(row))
+
+    def validate_batch(self, session, control_results):
+        """
+        Valide un lot de ControlResult (objets ORM) : une requête pour les cibles de tous
+        les produits du lot et une pour l'état de ses séries, évaluation O(1) par point
+        dans l'ordre des dates, puis écriture de l'état des séries dans la transaction.
+        Met à jour is_within_range et signale les règles violées dans comments.
+        """
+        control_results = sorted(control_results, key=lambda result: (result.control_date, result.id or 0))
+        connection = session.connection()
+        keys = {self.key(result.product_id, result.parameter_id, result.level) for result in control_results}
+        self.load_targets(connection, [result.product_id for result in control_results])
+        self.load_series(connection, keys)
+        evaluations = []
+        for result in control_results:
+            evaluation = self.evaluate(result.product_id, result.parameter_id, result.level, result.valeur_obtenue)
+            result.is_within_range = evaluation.accepte
+            if evaluation.regles:
+                note = "Westgard : " + ", ".join(evaluation.regles)
+                result.comments = f"{result.comments}\n{note}" if result.comments else note
+            evaluations.append(evaluation)
+        self.save_series(connection, keys)
+        return evaluations
+
+    def backfill(self, connection, update=False, batch_size=5000):
+        """
+        Reconstruit l'état de toutes les séries en un seul parcours de control_results
+        ordonné par control_date (lecture en flux) et remplace qc_series_states. Avec
+        update=True, réécrit is_within_range par lots de batch_size (executemany).
+        Retourne le nombre de points parcourus.
+        """
+        self.series = {}
+        self.invalidate_targets()
+        self.load_targets(connection)
+        control_results = ControlResult.__table__
+        rows = connection.execution_options(stream_results=True, yield_per=batch_size).execute(
+            select(control_results.c.id, control_results.c.product_id, control_results.c.parameter_id,
+                   control_results.c.level, control_results.c.valeur_obtenue)
+            .order_by(control_results.c.control_date, control_results.c.id)
+        )
+        updates = []
+        count = 0
+        for row_id, product_id, parameter_id, level, valeur in rows:
+            evaluation = self.evaluate(product_id, parameter_id, level, valeur)
+            count += 1
+            if update:
+                updates.append({"b_id": row_id, "b_within": evaluation.accepte})
+                if len(updates) >= batch_size:
+                    self._write_within_range(connection, updates)
+                    updates = []
+        if updates:
+            self._write_within_range(connection, updates)
+        connection.execute(QCSerieState.__table__.delete())
+        self.save_series(connection, self.series)
+        logger.info(f"Backfill QC : {count} points, {len(self.series)} séries")
+        return count
+
+    @staticmethod
+    def _write_within_range(connection, updates):
+        control_results = ControlResult.__table__
+        connection.execute(
+            control_results.update()
+            .where(control_results.c.id == bindparam("b_id"))
+            .values(is_within_range=bindparam("b_within")),
+            updates,
+        )
+
+
+def _validate_new_results(session, flush_context, instances):
+    control_results = [obj for obj in session.new if isinstance(obj, ControlResult)]
+    if control_results and _engine is not None:
+        _engine.validate_batch(session, control_results)
+
+
+def _invalidate_targets(mapper, connection, target):
+    if _engine is not None:
+        _engine.invalidate_targets()
+
+
+def register_validation(qc_engine):
+    """
+    Valide avec qc_engine chaque ControlResult inséré par l'ORM, avant le flush (toutes
+    les sessions du processus), et relit ses cibles après toute écriture sur ControlValue.
+    """
+    global _engine
+    if _engine is None:
+        event.listen(Session, "before_flush", _validate_new_results)
+        for event_name in ("after_insert", "after_update", "after_delete"):
+            event.listen(ControlValue, event_name, _invalidate_targets)
+    _engine = qc_engine
+    return qc_engine
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from database import create_engine_from_env
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Contrôle qualité interne (Westgard)")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--update", action="store_true", help="réécrire is_within_range de l'historique")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    engine = create_engine_from_env(os.getenv("DATABASE_URL"))
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        count = QCEngine().backfill(connection, args.update, args.batch_size)
+    print(f"{count} points de contrôle rejoués en {time.perf_counter() - start:.1f}s")
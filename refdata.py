@@ -0,0 +1,256 @@
+"""
+Cache des données de référence du laboratoire, partagé par tout le processus.
+
+Parameter, Categorie, Tube, PrelevementType, ParameterGroup et Antibiotique ne
+changent que quelques fois par an : ils sont chargés ensemble (une requête par table
+et par table d'association) dans un instantané immuable, ReferenceData, fait de
+namedtuples et de dictionnaires en lecture seule. Les appelants lisent
+l'instantané courant (get) au lieu d'interroger ou de joindre ces tables.
+
+Chaque instantané porte un numéro de version (incrémenté à chaque rechargement) et
+une empreinte de son contenu (stamp), à inclure dans les clés de cache qui en
+dépendent. Le cache est rechargé au prochain get après le commit d'une écriture ORM
+sur ces tables (register_invalidation), sur demande (reload), au plus tard après
+max_age secondes, et dès qu'un identifiant demandé est absent (covering : un
+paramètre ou un tube créé par un autre processus), au plus une fois toutes les
+min_reload_interval secondes. Un identifiant encore absent ne doit jamais faire
+disparaître une ligne clinique : les appelants gardent la ligne, avec l'identifiant
+brut (missing_label) ou une lecture en base.
+"""
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+from models import (Antibiotique, Categorie, Parameter, ParameterGroup, PrelevementType, Tube,
+                    group_parameters_table, parameter_prelevements_table, parameter_tube_table)
+
+ParameterRecord = namedtuple("ParameterRecord", ["parameter_id", "param", "nom_param", "prix_u", "unite",
+                                                 "description", "categorie_id", "tube_ids",
+                                                 "prelevement_type_ids", "group_ids"])
+CategorieRecord = namedtuple("CategorieRecord", ["categorie_id", "nom", "description", "parameter_ids"])
+TubeRecord = namedtuple("TubeRecord", ["tube_id", "name", "description"])
+PrelevementTypeRecord = namedtuple("PrelevementTypeRecord", ["id", "numero", "name", "description", "prix"])
+ParameterGroupRecord = namedtuple("ParameterGroupRecord", ["group_id", "group_name", "parameter_ids"])
+AntibiotiqueRecord = namedtuple("AntibiotiqueRecord", ["id", "nom", "code", "categorie", "description"])
+
+REFERENCE_MODELS = (Parameter, Categorie, Tube, PrelevementType, ParameterGroup, Antibiotique)
+
+_PENDING_KEY = "donnees_reference_modifiees"
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def reference_data_queries():
+    """Requêtes de chargement d'un instantané, par nom (voir ReferenceDataCache.build)."""
+    parameters = Parameter.__table__
+    categories = Categorie.__table__
+    tubes = Tube.__table__
+    prelevement_types = PrelevementType.__table__
+    groups = ParameterGroup.__table__
+    antibiotiques = Antibiotique.__table__
+    return {
+        "parameters": select(parameters.c.parameter_id, parameters.c.param, parameters.c.nom_param,
+                             parameters.c.prix_u, parameters.c.unite, parameters.c.description,
+                             parameters.c.categorie_id).order_by(parameters.c.parameter_id),
+        "categories": select(categories.c.categorie_id, categories.c.nom, categories.c.description)
+        .order_by(categories.c.categorie_id),
+        "tubes": select(tubes.c.tube_id, tubes.c.name, tubes.c.description).order_by(tubes.c.tube_id),
+        "prelevement_types": select(prelevement_types.c.id, prelevement_types.c.numero, prelevement_types.c.name,
+                                    prelevement_types.c.description, prelevement_types.c.prix)
+        .order_by(prelevement_types.c.id),
+        "parameter_groups": select(groups.c.group_id, groups.c.group_name).order_by(groups.c.group_id),
+        "antibiotiques": select(antibiotiques.c.id, antibiotiques.c.nom, antibiotiques.c.code,
+                                antibiotiques.c.categorie, antibiotiques.c.description)
+        .order_by(antibiotiques.c.id),
+        "parameter_tubes": select(parameter_tube_table.c.parameter_id, parameter_tube_table.c.tube_id)
+        .order_by(parameter_tube_table.c.parameter_id, parameter_tube_table.c.tube_id),
+        "parameter_prelevements": select(parameter_prelevements_table.c.parameter_id,
+                                         parameter_prelevements_table.c.prelevement_type_id)
+        .order_by(parameter_prelevements_table.c.parameter_id, parameter_prelevements_table.c.prelevement_type_id),
+        "group_parameters": select(group_parameters_table.c.group_id, group_parameters_table.c.parameter_id)
+        .order_by(group_parameters_table.c.group_id, group_parameters_table.c.parameter_id),
+    }
+
+
+def _grouped(pairs):
+    grouped = {}
+    for key, value in pairs:
+        grouped.setdefault(key, []).append(value)
+    return {key: tuple(values) for key, values in grouped.items()}
+
+
+def missing_label(kind, record_id):
+    """Libellé affiché pour un identifiant absent de l'instantané."""
+    return f"{kind} {record_id}"
+
+
+class ReferenceData:
+    """Instantané immuable des données de référence."""
+
+    __slots__ = ("parameters", "categories", "tubes", "prelevement_types", "parameter_groups", "antibiotiques",
+                 "version", "stamp")
+
+    def __init__(self, rows, version):
+        tubes_by_parameter = _grouped(rows["parameter_tubes"])
+        prelevements_by_parameter = _grouped(rows["parameter_prelevements"])
+        parameters_by_group = _grouped(rows["group_parameters"])
+        groups_by_parameter = _grouped((parameter_id, group_id)
+                                       for group_id, parameter_id in rows["group_parameters"])
+        parameters_by_categorie = _grouped((row[6], row[0]) for row in rows["parameters"])
+
+        self.parameters = MappingProxyType({
+            row[0]: ParameterRecord(*row, tubes_by_parameter.get(row[0], ()),
+                                    prelevements_by_parameter.get(row[0], ()), groups_by_parameter.get(row[0], ()))
+            for row in rows["parameters"]})
+        self.categories = MappingProxyType({
+            row[0]: CategorieRecord(*row, parameters_by_categorie.get(row[0], ())) for row in rows["categories"]})
+        self.tubes = MappingProxyType({row[0]: TubeRecord(*row) for row in rows["tubes"]})
+        self.prelevement_types = MappingProxyType({row[0]: PrelevementTypeRecord(*row)
+                                                   for row in rows["prelevement_types"]})
+        self.parameter_groups = MappingProxyType({
+            row[0]: ParameterGroupRecord(*row, parameters_by_group.get(row[0], ()))
+            for row in rows["parameter_groups"]})
+        self.antibiotiques = MappingProxyType({row[0]: AntibiotiqueRecord(*row) for row in rows["antibiotiques"]})
+        self.version = version
+        content = repr(sorted((name, [tuple(row) for row in table_rows]) for name, table_rows in rows.items()))
+        self.stamp = hashlib.sha1(content.encode("utf-8")).hexdigest()[:12]
+
+    def __setattr__(self, name, value):
+        if hasattr(self, "stamp"):
+            raise AttributeError("ReferenceData est immuable")
+        object.__setattr__(self, name, value)
+
+    def param_label(self, parameter_id):
+        parameter = self.parameters.get(parameter_id)
+        return parameter.param if parameter else None
+
+    def unite(self, parameter_id):
+        parameter = self.parameters.get(parameter_id)
+        return parameter.unite if parameter else None
+
+    def missing(self, **ids_by_table):
+        """True si l'un des identifiants (ex. parameters=[1, 2], tubes=[3]) est absent de l'instantané."""
+        return any(record_id is not None and record_id not in getattr(self, table)
+                   for table, ids in ids_by_table.items() for record_id in ids)
+
+
+class ReferenceDataCache:
+    """Cache à lecture traversante de l'instantané ReferenceData courant."""
+
+    def __init__(self, engine, max_age=3600, min_reload_interval=5):
+        self.engine = engine
+        self.max_age = max_age
+        self.min_reload_interval = min_reload_interval
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._data = None
+        self._loaded_at = None
+        self._stale = True
+        self._version = 0
+        self._miss_reload_at = None
+
+    def invalidate(self):
+        self._stale = True
+
+    def needs_refresh(self):
+        return self._stale or self._data is None or time.monotonic() - self._loaded_at > self.max_age
+
+    def build(self, rows):
+        """Installe un nouvel instantané à partir des lignes de reference_data_queries() (par nom)."""
+        with self._lock:
+            self._version += 1
+            self._stale = False
+            self._loaded_at = time.monotonic()
+            self._data = ReferenceData({name: list(table_rows) for name, table_rows in rows.items()}, self._version)
+            return self._data
+
+    def reload(self):
+        """Recharge l'instantané depuis la base (une requête par table)."""
+        with self.engine.connect() as connection:
+            return self.build({name: connection.execute(query).all()
+                               for name, query in reference_data_queries().items()})
+
+    def get(self):
+        """Instantané courant, rechargé d'abord s'il est invalidé ou trop ancien."""
+        if self.needs_refresh():
+            # Un seul rechargement à la fois : les autres threads attendent son résultat
+            with self._reload_lock:
+                if self.needs_refresh():
+                    return self.reload()
+        return self._data
+
+    def wants_reload(self, data, **ids_by_table):
+        """
+        True si des identifiants manquent dans l'instantané data et qu'aucun rechargement
+        pour absence n'a eu lieu depuis min_reload_interval secondes (l'appelant recharge).
+        """
+        if not data.missing(**ids_by_table):
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if self._miss_reload_at is not None and now - self._miss_reload_at < self.min_reload_interval:
+                return False
+            self._miss_reload_at = now
+        return True
+
+    def covering(self, **ids_by_table):
+        """
+        Instantané courant, rechargé une fois si l'un des identifiants demandés est
+        absent (voir wants_reload). Des identifiants peuvent encore manquer au retour.
+        """
+        data = self.get()
+        if self.wants_reload(data, **ids_by_table):
+            with self._reload_lock:
+                if self._data is data:
+                    return self.reload()
+            return self._data
+        return data
+
+    @property
+    def stamp(self):
+        return self.get().stamp
+
+
+def register_invalidation(reference_data_cache):
+    """Recharge le cache au prochain get après le commit d'une écriture ORM sur les tables de référence."""
+
+    def _track(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info[_PENDING_KEY] = True
+
+    def _after_commit(session):
+        if session.info.pop(_PENDING_KEY, None):
+            reference_data_cache.invalidate()
+
+    def _after_rollback(session):
+        session.info.pop(_PENDING_KEY, None)
+
+    # Les collections (tubes, groupes, ...) marquent leur objet parent modifié
+    for model in REFERENCE_MODELS:
+        for event_name in ("after_insert", "after_update", "after_delete"):
+            event.listen(model, event_name, _track)
+    event.listen(Session, "after_commit", _after_commit)
+    event.listen(Session, "after_rollback", _after_rollback)
+    return reference_data_cache
+
+
+def shared_cache(engine=None):
+    """
+    Cache du processus, créé (avec son invalidation) au premier appel, qui doit fournir
+    l'engine. Lève ValueError si un engine d'une autre base est passé ensuite.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = register_invalidation(ReferenceDataCache(engine))
+        elif engine is not None:
+            if _shared.engine is None:
+                _shared.engine = engine
+            elif _shared.engine is not engine and str(_shared.engine.url) != str(engine.url):
+                raise ValueError(f"cache des données de référence déjà lié à {_shared.engine.url!r}, "
+                                 f"pas à {engine.url!r}")
+    return _shared
@@ -0,0 +1,211 @@
+"""
+Index en mémoire des valeurs de référence (table 'reference') et marquage vectorisé
+des résultats anormaux (bas / normal / haut).
+
+L'index est construit une fois, sous forme de tables NumPy indexées par
+(paramètre, catégorie d'âge, sexe) ; il est reconstruit après toute écriture sur
+Reference dans ce processus, et au plus tard après max_age secondes.
+"""
+import hashlib
+import threading
+import time
+import numpy as np
+from sqlalchemy import event, select
+from models import Analyse, Patient, Reference, Resultat
+
+FLAG_INCONNU, FLAG_BAS, FLAG_NORMAL, FLAG_HAUT = 0, 1, 2, 3
+FLAG_LABELS = {FLAG_INCONNU: None, FLAG_BAS: "bas", FLAG_NORMAL: "normal", FLAG_HAUT: "haut"}
+
+CATEGORIES_AGE = ("nouveau_ne", "enfant", "adulte")
+AGE_NOUVEAU_NE = 28 / 365.25  # 28 jours, en années
+AGE_ADULTE = 18.0
+
+SEXES = {
+    "homme": "homme", "h": "homme", "m": "homme", "masculin": "homme",
+    "femme": "femme", "f": "femme", "féminin": "femme", "feminin": "femme",
+}
+
+AGE_UNITS = {
+    "ans": 1.0, "an": 1.0, "annees": 1.0, "années": 1.0, "a": 1.0,
+    "mois": 1 / 12, "m": 1 / 12,
+    "semaines": 7 / 365.25, "semaine": 7 / 365.25, "sem": 7 / 365.25,
+    "jours": 1 / 365.25, "jour": 1 / 365.25, "j": 1 / 365.25,
+}
+
+
+def normalize_sexe(sexe):
+    return SEXES.get((sexe or "").strip().lower(), (sexe or "").strip().lower())
+
+
+def age_in_years(age, age_unit=None):
+    """Convertit Patient.age (texte) et Patient.age_unit en années (NaN si illisible)."""
+    try:
+        value = float(str(age).replace(",", ".").strip())
+    except (TypeError, ValueError):
+        return float("nan")
+    return value * AGE_UNITS.get((age_unit or "ans").strip().lower(), 1.0)
+
+
+def categories_age(ages):
+    """Catégorie d'âge de chaque âge (en années), vectorisé : indices dans CATEGORIES_AGE, -1 si inconnu."""
+    ages = np.asarray(ages, dtype=np.float64)
+    return np.select(
+        [np.isnan(ages), ages < AGE_NOUVEAU_NE, ages < AGE_ADULTE],
+        [-1, 0, 1],
+        default=2,
+    ).astype(np.int64)
+
+
+def reference_query():
+    references = Reference.__table__
+    return (
+        select(references.c.parametre_id, references.c.categorie_age, references.c.sexe,
+               references.c.valeur_min, references.c.valeur_max)
+        .order_by(references.c.id)
+    )
+
+
+class ReferenceIndex:
+    """Tables min/max denses indexées par (paramètre, catégorie d'âge, sexe)."""
+
+    SEXE_CODES = ("homme", "femme")
+
+    def __init__(self, engine, max_age=300):
+        self.engine = engine
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._built_at = None
+        self._stale = True
+        self.stamp = None
+        self.parameter_ids = np.empty(0, dtype=np.int64)
+        self.minimums = np.empty((0, len(CATEGORIES_AGE), len(self.SEXE_CODES)))
+        self.maximums = np.empty((0, len(CATEGORIES_AGE), len(self.SEXE_CODES)))
+
+    def invalidate(self):
+        self._stale = True
+
+    def needs_refresh(self):
+        return self._stale or self._built_at is None or time.monotonic() - self._built_at > self.max_age
+
+    def refresh(self):
+        """Recharge toutes les valeurs de référence en une requête."""
+        with self.engine.connect() as connection:
+            return self.build(connection.execute(reference_query()).all())
+
+    def build(self, rows):
+        """Construit les tables à partir des lignes de reference_query()."""
+        parameter_ids = np.array(sorted({row[0] for row in rows}), dtype=np.int64)
+        shape = (len(parameter_ids), len(CATEGORIES_AGE), len(self.SEXE_CODES))
+        minimums = np.full(shape, np.nan)
+        maximums = np.full(shape, np.nan)
+        for parametre_id, categorie_age, sexe, valeur_min, valeur_max in rows:
+            if categorie_age not in CATEGORIES_AGE:
+                continue
+            p = int(np.searchsorted(parameter_ids, parametre_id))
+            c = CATEGORIES_AGE.index(categorie_age)
+            sexe = normalize_sexe(sexe)
+            # Une référence sans sexe reconnu (ex. 'tous') s'applique aux deux sexes
+            for s in ([self.SEXE_CODES.index(sexe)] if sexe in self.SEXE_CODES else range(len(self.SEXE_CODES))):
+                minimums[p, c, s] = valeur_min
+                maximums[p, c, s] = valeur_max
+
+        with self._lock:
+            self.parameter_ids, self.minimums, self.maximums = parameter_ids, minimums, maximums
+            self.stamp = hashlib.sha1(repr(rows).encode("utf-8")).hexdigest()[:12]
+            self._built_at = time.monotonic()
+            self._stale = False
+        return self
+
+    def ensure_fresh(self):
+        if self.needs_refresh():
+            self.refresh()
+        return self
+
+    def flag(self, parameter_ids, valeurs, categories, sexes):
+        """
+        Marque un lot de résultats. Entrées : tableaux de même longueur (identifiants
+        de paramètre, valeurs, indices de catégorie d'âge, codes sexe 0=homme / 1=femme,
+        -1 si inconnu). Retourne un tableau int8 de FLAG_* sans boucle Python.
+        L'index doit être à jour (voir ensure_fresh).
+        """
+        with self._lock:
+            known_ids, minimums, maximums = self.parameter_ids, self.minimums, self.maximums
+        parameter_ids = np.asarray(parameter_ids, dtype=np.int64)
+        valeurs = np.asarray(valeurs, dtype=np.float64)
+        categories = np.asarray(categories, dtype=np.int64)
+        sexes = np.asarray(sexes, dtype=np.int64)
+
+        flags = np.full(len(valeurs), FLAG_INCONNU, dtype=np.int8)
+        if not len(known_ids) or not len(valeurs):
+            return flags
+
+        p = np.minimum(np.searchsorted(known_ids, parameter_ids), len(known_ids) - 1)
+        known = (known_ids[p] == parameter_ids) & (categories >= 0) & (sexes >= 0)
+        c = np.clip(categories, 0, None)
+        s = np.clip(sexes, 0, None)
+        low = np.where(known, minimums[p, c, s], np.nan)
+        high = np.where(known, maximums[p, c, s], np.nan)
+
+        valid = ~(np.isnan(low) | np.isnan(high) | np.isnan(valeurs))
+        flags[valid] = FLAG_NORMAL
+        flags[valid & (valeurs < low)] = FLAG_BAS
+        flags[valid & (valeurs > high)] = FLAG_HAUT
+        return flags
+
+    def sexe_code(self, sexe):
+        sexe = normalize_sexe(sexe)
+        return self.SEXE_CODES.index(sexe) if sexe in self.SEXE_CODES else -1
+
+    def flag_report(self, report):
+        """Ajoute la clé 'flag' (bas / normal / haut / None) aux résultats d'un modèle de vue resultat.html."""
+        resultats = [r for analyse in report["resultats"] for r in analyse["resultats"]]
+        if not resultats:
+            return report
+        categorie = categories_age([age_in_years(report.get("age"), report.get("age_unit"))])[0]
+        flags = self.flag(
+            [r["parameter_id"] for r in resultats],
+            [np.nan if r["valeur"] is None else r["valeur"] for r in resultats],
+            np.full(len(resultats), categorie),
+            np.full(len(resultats), self.sexe_code(report.get("sexe"))),
+        )
+        for resultat, flag in zip(resultats, flags.tolist()):
+            resultat["flag"] = FLAG_LABELS[flag]
+        return report
+
+    def flag_analyses(self, connection, analyse_ids):
+        """
+        Marque tous les résultats des analyses données (écrans de validation) :
+        une requête pour les valeurs et la démographie, puis un marquage vectorisé.
+        Retourne {resultat_id: 'bas' | 'normal' | 'haut' | None}.
+        """
+        resultats = Resultat.__table__
+        analyses = Analyse.__table__
+        patients = Patient.__table__
+        rows = connection.execute(
+            select(resultats.c.id, resultats.c.parameter_id, resultats.c.valeur,
+                   patients.c.age, patients.c.age_unit, patients.c.sexe)
+            .join(analyses, analyses.c.id == resultats.c.analyse_id)
+            .join(patients, patients.c.id == analyses.c.patient_id)
+            .where(resultats.c.analyse_id.in_(list(analyse_ids)))
+        ).all()
+        if not rows:
+            return {}
+        self.ensure_fresh()
+        flags = self.flag(
+            [row.parameter_id for row in rows],
+            [np.nan if row.valeur is None else row.valeur for row in rows],
+            categories_age([age_in_years(row.age, row.age_unit) for row in rows]),
+            [self.sexe_code(row.sexe) for row in rows],
+        )
+        return {row.id: FLAG_LABELS[flag] for row, flag in zip(rows, flags.tolist())}
+
+
+def register_refresh(reference_index):
+    """Reconstruit l'index au prochain usage après toute écriture sur Reference."""
+
+    def _invalidate(mapper, connection, target):
+        reference_index.invalidate()
+
+    for event_name in ("after_insert", "after_update", "after_delete"):
+        event.listen(Reference, event_name, _invalidate)
+    return reference_index
@@ -0,0 +1,461 @@
+"""
+Comptes rendus PDF des analyses : en-tête du laboratoire (logo), résultats (Resultat,
+NFS, groupage, frottis, spermogramme, bactériologie) et griffes (laboratoire et
+validateur).
+
+Les PDF sont écrits en flux (pdf.PdfStreamWriter) : chaque page part dans le fichier
+dès qu'elle est remplie. Les logos et griffes sont décodés, redimensionnés et
+compressés une seule fois par processus (asset), puis recopiés tels quels dans chaque
+document. Les données d'un lot d'analyses sont lues en une requête par table.
+
+La génération de fin de journée répartit les analyses validées du jour entre
+plusieurs processus.
+
+Usage : python reports.py 2024-05-31 --sortie comptes_rendus [--workers 4]
+"""
+import argparse
+import functools
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from sqlalchemy import select
+from models import (Analyse, BacterioResult, Frottis, Germe, GroupageSanguin, Laboratoire, NumerationFormuleSanguine,
+                    Patient, Personnel, Resultat, SpermogrammeResult)
+from pdf import PdfStreamWriter, encode_image, text_string
+from refdata import missing_label, shared_cache
+from validation import STATUT_VALIDE
+
+logger = logging.getLogger(__name__)
+
+MARGIN = 40
+LINE_HEIGHT = 12
+LOGO_SIZE = (70, 70)
+GRIFFE_SIZE = (140, 80)
+
+NFS_FIELDS = (
+    ("hemoglobine", "Hémoglobine", "g/dL"), ("hematocrite", "Hématocrite", "%"),
+    ("globules_rouges", "Globules rouges", "millions/mm³"), ("globules_blancs", "Globules blancs", "G/L"),
+    ("plaquettes", "Plaquettes", "G/L"), ("vgm", "VGM", "fL"), ("tcmh", "TCMH", "pg"), ("ccmh", "CCMH", "g/dL"),
+    ("rdw", "RDW", "%"), ("reticulocytes", "Réticulocytes", "‰"), ("ipr", "IPR", ""),
+    ("neutrophiles", "Neutrophiles", "%"), ("eosinophiles", "Éosinophiles", "%"), ("basophiles", "Basophiles", "%"),
+    ("lymphocytes", "Lymphocytes", "%"), ("monocytes", "Monocytes", "%"), ("vpm", "VPM", "fL"),
+    ("pdw", "PDW", "%"), ("ipf", "IPF", "%"), ("ret_he", "Ret-He", ""), ("indice_hypochrome", "Indice hypochrome", "%"),
+    ("irf", "IRF", ""), ("nlr", "NLR", ""), ("plr", "PLR", ""), ("mlr", "MLR", ""),
+)
+
+# Colonnes techniques exclues des sections génériques (frottis, spermogramme)
+TECHNICAL_COLUMNS = {"id", "analyse_id", "date_resultat", "validateur_id", "validation_date", "is_stamped",
+                     "stamped_by", "stamped_at", "comments", "conclusion"}
+
+
+# --- Images partagées (logo, griffes) ---
+
+_unreadable_assets = set()
+
+
+@functools.lru_cache(maxsize=64)
+def _encoded_asset(path, mtime, max_size):
+    with Image.open(path) as image:
+        image.thumbnail((max_size[0] * 3, max_size[1] * 3))  # ~200 dpi à la taille d'impression
+        if image.mode in ("RGBA", "LA", "P"):
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image.convert("RGBA"), mask=image.convert("RGBA").split()[-1])
+            image = background
+        ratio = min(max_size[0] / image.width, max_size[1] / image.height)
+        return encode_image(image), (image.width * ratio, image.height * ratio)
+
+
+def asset(path, max_size):
+    """
+    Image décodée et compressée une fois par processus (clé : chemin, date de
+    modification, taille). Retourne ((dictionnaire, flux), (largeur, hauteur)) ou None.
+    """
+    if not path:
+        return None
+    try:
+        return _encoded_asset(path, os.stat(path).st_mtime, max_size)
+    except (OSError, ValueError) as e:
+        if path not in _unreadable_assets:
+            _unreadable_assets.add(path)
+            logger.warning(f"Image illisible {path} : {str(e)}")
+        return None
+
+
+# --- Lecture des données ---
+
+def load_laboratoire(connection):
+    laboratoires = Laboratoire.__table__
+    return connection.execute(select(laboratoires).order_by(laboratoires.c.id).limit(1)).mappings().first()
+
+
+def _rows_by_analyse(connection, query, analyse_column, analyse_ids):
+    grouped = defaultdict(list)
+    for row in connection.execute(query.where(analyse_column.in_(analyse_ids))).mappings():
+        grouped[row["analyse_id"]].append(row)
+    return grouped
+
+
+def load_reports(connection, analyse_ids):
+    """
+    Données des comptes rendus d'un lot d'analyses, en une requête par table (libellés
+    et unités des paramètres pris dans le cache refdata, sans jointure ; un paramètre
+    absent du cache garde sa ligne, avec son identifiant). Seuls les résultats validés
+    sont imprimés : ceux en attente ou rejetés n'apparaissent pas.
+    Retourne une liste de dictionnaires dans l'ordre de analyse_ids.
+    """
+    analyse_ids = list(analyse_ids)
+    analyses = Analyse.__table__
+    patients = Patient.__table__
+    personnels = Personnel.__table__
+    resultats = Resultat.__table__
+    bacterio = BacterioResult.__table__
+    germes = Germe.__table__
+
+    headers = {
+        row["id"]: row for row in connection.execute(
+            select(analyses.c.id, analyses.c.dossier_barcode, analyses.c.analyse_date, analyses.c.medecin,
+                   analyses.c.validation_date, analyses.c.is_stamped, patients.c.name.label("nom"), patients.c.prenom,
+                   patients.c.age, patients.c.age_unit, patients.c.sexe, personnels.c.nom.label("validateur_nom"),
+                   personnels.c.prenom.label("validateur_prenom"), personnels.c.personal_griffe)
+            .join(patients, patients.c.id == analyses.c.patient_id)
+            .outerjoin(personnels, personnels.c.id == analyses.c.validated_by)
+            .where(analyses.c.id.in_(analyse_ids))
+        ).mappings()
+    }
+    sections = {
+        "resultats": _rows_by_analyse(connection, select(
+            resultats.c.analyse_id, resultats.c.parameter_id, resultats.c.valeur)
+            .where(resultats.c.validation_status == STATUT_VALIDE)
+            .order_by(resultats.c.analyse_id, resultats.c.result_date, resultats.c.id),
+            resultats.c.analyse_id, analyse_ids),
+        "bacterio": _rows_by_analyse(connection, select(
+            bacterio, germes.c.nom.label("germe"))
+            .outerjoin(germes, germes.c.id == bacterio.c.germe_identifie),
+            bacterio.c.analyse_id, analyse_ids),
+    }
+    for key, model in (("nfs", NumerationFormuleSanguine), ("groupage", GroupageSanguin),
+                       ("frottis", Frottis), ("spermogramme", SpermogrammeResult)):
+        table = model.__table__
+        sections[key] = _rows_by_analyse(connection, select(table).order_by(table.c.id), table.c.analyse_id,
+                                         analyse_ids)
+    data = shared_cache(connection.engine).covering(
+        parameters={row["parameter_id"] for rows in sections["resultats"].values() for row in rows})
+    sections["resultats"] = {
+        analyse_id: [dict(row, param=data.param_label(row["parameter_id"])
+                          or missing_label("Paramètre", row["parameter_id"]),
+                          unite=data.unite(row["parameter_id"]))
+                     for row in rows]
+        for analyse_id, rows in sections["resultats"].items()
+    }
+
+    reports = []
+    for analyse_id in analyse_ids:
+        header = headers.get(analyse_id)
+        if header is None:
+            continue
+        report = dict(header)
+        for key, grouped in sections.items():
+            report[key] = grouped.get(analyse_id, [])
+        reports.append(report)
+    return reports
+
+
+# --- Mise en page ---
+
+def _format(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:g}"
+    if isinstance(value, bool):
+        return "Oui" if value else "Non"
+    if isinstance(value, datetime):
+        return f"{value:%d/%m/%Y %H:%M}"
+    return " ".join(str(value).split())
+
+
+def _label(column):
+    return column.replace("_", " ").strip().capitalize()
+
+
+def _wrap(text, size, width):
+    """Découpe un texte en lignes d'au plus `width` points (largeur moyenne Helvetica ~0,5 em)."""
+    per_line = max(10, int(width / (size * 0.5)))
+    words, lines, current = text.split(), [], ""
+    for word in words:
+        if current and len(current) + 1 + len(word) > per_line:
+            lines.append(current)
+            current = word
+        else:
+            current = f"{current} {word}" if current else word
+    if current:
+        lines.append(current)
+    return lines or [""]
+
+
+class ReportWriter:
+    """Écrit un ou plusieurs comptes rendus dans un PDF, page par page."""
+
+    def __init__(self, out, laboratoire=None):
+        self.pdf = PdfStreamWriter(out)
+        self.laboratoire = laboratoire or {}
+        self.width, self.height = self.pdf.page_size
+        self._ops = []
+        self._xobjects = {}
+        self._footer = ""
+        self.y = None
+
+    # Primitives
+
+    def _fonts(self):
+        return {b"F1": self.pdf.font_object("Helvetica"), b"F2": self.pdf.font_object("Helvetica-Bold")}
+
+    def text(self, x, y, text, size=9, bold=False):
+        self._ops.append(b"BT /%s %d Tf %.2f %.2f Td %s Tj ET" % (b"F2" if bold else b"F1", size, x, y,
+                                                                  text_string(text)))
+
+    def rule(self, y):
+        self._ops.append(b"0.5 w %.2f %.2f m %.2f %.2f l S" % (MARGIN, y, self.width - MARGIN, y))
+
+    def image(self, path, max_size, x, y_top):
+        """Place une image partagée (logo, griffe), coin supérieur gauche en (x, y_top). Retourne sa hauteur."""
+        encoded = asset(path, max_size)
+        if encoded is None:
+            return 0
+        (body, stream), (width, height) = encoded
+        object_id = self.pdf.shared_resource(("image", path), lambda writer: writer.write_object(body, stream))
+        name = b"Im%d" % object_id
+        self._xobjects[name] = object_id
+        self._ops.append(b"q %.2f 0 0 %.2f %.2f %.2f cm /%s Do Q" % (width, height, x, y_top - height, name))
+        return height
+
+    # Pages
+
+    def _header(self):
+        top = self.height - MARGIN
+        logo_height = self.image(self.laboratoire.get("logo_path"), LOGO_SIZE, MARGIN, top)
+        x = MARGIN + (LOGO_SIZE[0] + 10 if logo_height else 0)
+        self.text(x, top - 12, self.laboratoire.get("nom") or "Laboratoire d'analyses médicales", 13, bold=True)
+        details = [
+            " - ".join(filter(None, (self.laboratoire.get("docteur"), self.laboratoire.get("specialite")))),
+            self.laboratoire.get("adresse"),
+            " / ".join(filter(None, (self.laboratoire.get("telephone1"), self.laboratoire.get("telephone2"),
+                                     self.laboratoire.get("email")))),
+        ]
+        y = top - 26
+        for line in filter(None, details):
+            self.text(x, y, line, 8)
+            y -= 10
+        y = min(y, top - logo_height) - 6
+        self.rule(y)
+        self.y = y - 16
+
+    def _finish_page(self):
+        if not self._ops:
+            return
+        self.text(MARGIN, MARGIN - 20, f"{self._footer} - page {self.pdf.page_count + 1}", 7)
+        self.pdf.add_page(b"\n".join(self._ops), xobjects=self._xobjects, fonts=self._fonts())
+        self._ops = []
+        self._xobjects = {}
+
+    def new_page(self):
+        self._finish_page()
+        self._header()
+
+    def ensure_space(self, height):
+        if self.y is None or self.y - height < MARGIN:
+            self.new_page()
+
+    def line(self, text, size=9, bold=False, indent=0):
+        for part in _wrap(_format(text), size, self.width - 2 * MARGIN - indent):
+            self.ensure_space(LINE_HEIGHT)
+            self.text(MARGIN + indent, self.y, part, size, bold)
+            self.y -= LINE_HEIGHT
+
+    def columns(self, cells, size=9, bold=False):
+        """Une ligne de tableau : cells est une liste de (position x relative, texte)."""
+        self.ensure_space(LINE_HEIGHT)
+        for x, text in cells:
+            if text not in (None, ""):
+                self.text(MARGIN + x, self.y, _format(text)[:60], size, bold)
+        self.y -= LINE_HEIGHT
+
+    def heading(self, text):
+        self.ensure_space(3 * LINE_HEIGHT)
+        self.y -= 4
+        self.line(text, 11, bold=True)
+
+    # Sections
+
+    def _fields(self, row, fields):
+        for column, label, unite in fields:
+            if row.get(column) is not None:
+                self.columns(((10, label), (200, row[column]), (300, unite)))
+
+    def _generic(self, row):
+        for column, value in row.items():
+            if column not in TECHNICAL_COLUMNS and value not in (None, ""):
+                self.columns(((10, _label(column)), (200, value)))
+        for column in ("comments", "conclusion"):
+            if row.get(column):
+                self.line(f"{_label(column)} : {_format(row[column])}", indent=10)
+
+    def write_report(self, report):
+        """Écrit le compte rendu d'une analyse (dictionnaire de load_reports), à partir d'une nouvelle page."""
+        self._footer = f"Dossier {report['dossier_barcode']}"
+        self.new_page()
+        self.line(f"Patient : {report['nom']} {report['prenom']}", 11, bold=True)
+        self.line(f"Âge : {_format(report['age'])} {report.get('age_unit') or 'ans'} - Sexe : {_format(report['sexe'])}")
+        self.line(f"Dossier : {report['dossier_barcode']} - Prélèvement du {_format(report['analyse_date'])}")
+        if report.get("medecin"):
+            self.line(f"Prescripteur : {report['medecin']}")
+
+        if report["resultats"]:
+            self.heading("Résultats")
+            self.columns(((10, "Paramètre"), (200, "Résultat"), (300, "Unité")), bold=True)
+            for row in report["resultats"]:
+                self.columns(((10, row["param"]), (200, row["valeur"]), (300, row["unite"])))
+        for row in report["nfs"]:
+            self.heading("Numération formule sanguine")
+            self._fields(row, NFS_FIELDS)
+            self._generic({key: row[key] for key in ("comments", "conclusion")})
+        for row in report["groupage"]:
+            self.heading("Groupage sanguin")
+            self.columns(((10, "Groupe"), (200, f"{row['groupe_sanguin'] or ''} {row['rhésus'] or ''}")))
+            self.columns(((10, "Anticorps irréguliers"), (200, row["anticorps_irreguliers"])))
+            for column in ("details_anticorps", "methode_utilisee", "commentaires", "conclusion"):
+                if row.get(column):
+                    self.line(f"{_label(column)} : {_format(row[column])}", indent=10)
+        for row in report["frottis"]:
+            self.heading(f"Frottis {row['type_frottis'] or ''}".strip())
+            self._generic({key: value for key, value in row.items() if key != "type_frottis"})
+        for row in report["spermogramme"]:
+            self.heading("Spermogramme")
+            self._generic(row)
+        for row in report["bacterio"]:
+            self.heading("Bactériologie")
+            self.columns(((10, "Germe identifié"), (200, row["germe"] or row["germe_identifie2"])))
+            for column in ("type_prelevement", "comptage_colonies", "presence_leucocytes"):
+                if row.get(column) is not None:
+                    self.columns(((10, _label(column)), (200, row[column])))
+            for column in ("antibiogramme", "conclusion"):
+                if row.get(column):
+                    self.line(f"{_label(column)} : {_format(row[column])}", indent=10)
+
+        self._signature(report)
+
+    def _signature(self, report):
+        self.ensure_space(GRIFFE_SIZE[1] + 3 * LINE_HEIGHT)
+        self.y -= LINE_HEIGHT
+        if report.get("validation_date"):
+            validateur = " ".join(filter(None, (report.get("validateur_prenom"), report.get("validateur_nom"))))
+            self.line(f"Validé le {_format(report['validation_date'])}" + (f" par {validateur}" if validateur else ""))
+        x = MARGIN
+        top = self.y
+        heights = [0]
+        for path in (report.get("personal_griffe"), self.laboratoire.get("griffe_path")):
+            height = self.image(path, GRIFFE_SIZE, x, top)
+            if height:
+                heights.append(height)
+                x += GRIFFE_SIZE[0] + 20
+        self.y = top - max(heights)
+
+    def close(self):
+        self._finish_page()
+        self.pdf.close()
+        return self.pdf.page_count
+
+
+def write_reports(out, reports, laboratoire=None):
+    """Écrit les comptes rendus donnés dans un seul PDF. Retourne le nombre de pages."""
+    writer = ReportWriter(out, laboratoire)
+    for report in reports:
+        writer.write_report(report)
+    return writer.close()
+
+
+# --- Génération de fin de journée ---
+
+def validated_analyses(connection, day):
+    analyses = Analyse.__table__
+    debut = datetime.combine(day, datetime.min.time())
+    return list(connection.execute(
+        select(analyses.c.id)
+        .where(analyses.c.validated_by.isnot(None))
+        .where(analyses.c.validation_date >= debut)
+        .where(analyses.c.validation_date < debut + timedelta(days=1))
+        .order_by(analyses.c.id)
+    ).scalars())
+
+
+_worker_engine = None
+
+
+def _init_worker(database_url):
+    global _worker_engine
+    from database import create_engine_from_env
+    _worker_engine = create_engine_from_env(database_url)
+
+
+def generate_chunk(engine, analyse_ids, output_dir):
+    """Un PDF par analyse dans output_dir (nommé d'après le dossier). Retourne le nombre de pages."""
+    with engine.connect() as connection:
+        laboratoire = load_laboratoire(connection)
+        reports = load_reports(connection, analyse_ids)
+    pages = 0
+    for report in reports:
+        path = os.path.join(output_dir, f"{report['dossier_barcode']}.pdf")
+        with open(path + ".tmp", "wb") as out:
+            pages += write_reports(out, [report], laboratoire)
+        os.replace(path + ".tmp", path)
+    return pages
+
+
+def _generate_in_worker(analyse_ids, output_dir):
+    return generate_chunk(_worker_engine, analyse_ids, output_dir)
+
+
+def generate_day(database_url, day, output_dir, workers=None, chunk_size=100):
+    """
+    Génère les comptes rendus de toutes les analyses validées le jour donné, par lots de
+    chunk_size analyses répartis entre `workers` processus. Retourne (nombre de comptes
+    rendus, nombre de pages).
+    """
+    from database import create_engine_from_env
+
+    os.makedirs(output_dir, exist_ok=True)
+    engine = create_engine_from_env(database_url)
+    with engine.connect() as connection:
+        analyse_ids = validated_analyses(connection, day)
+    engine.dispose()
+    chunks = [analyse_ids[i:i + chunk_size] for i in range(0, len(analyse_ids), chunk_size)]
+
+    pages = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker,
+                             initargs=(database_url,)) as executor:
+        for chunk, future in [(chunk, executor.submit(_generate_in_worker, chunk, output_dir)) for chunk in chunks]:
+            try:
+                pages += future.result()
+            except Exception as e:
+                logger.error(f"Erreur lors de la génération des comptes rendus {chunk[0]}..{chunk[-1]} : {str(e)}")
+    return len(analyse_ids), pages
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Comptes rendus PDF des analyses validées")
+    parser.add_argument("jour", type=date.fromisoformat, nargs="?", default=date.today())
+    parser.add_argument("--sortie", default="comptes_rendus")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    count, pages = generate_day(os.getenv("DATABASE_URL"), args.jour, args.sortie, args.workers)
+    logger.info(f"{count} comptes rendus ({pages} pages) en {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,340 @@
+import base64
+import hashlib
+import json
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import select, func, tuple_
+from sqlalchemy.orm import load_only, selectinload
+from models import Patient, Analyse, Resultat, Parameter
+from refdata import missing_label
+
+# Correspondance entre les champs booléens de l'analyse et les libellés affichés
+ANALYSIS_TYPE_LABELS = (
+    ("is_nfs", "NFS"),
+    ("is_groupage", "Groupage Sanguin"),
+    ("is_frottis", "Frottis"),
+    ("is_spermo", "Spermogramme"),
+    ("is_bacterio", "Bactériologie"),
+    ("is_special", "Analyse Spéciale"),
+    ("is_autre_analyse", "Autre Analyse"),
+    ("is_soustraitance", "Soustraitance"),
+)
+
+
+# Version du contenu de la page résultats d'un patient (cache, ETag, Last-Modified)
+ReportVersion = namedtuple("ReportVersion", ["patient_id", "nb_analyses", "version", "etag", "last_modified"])
+
+# En-tête de l'historique d'un paramètre (patient_id ou param à None si inconnu)
+TimelineHeader = namedtuple("TimelineHeader", ["patient_id", "parameter_id", "param", "unite"])
+
+
+def format_analysis_types(analyse):
+    """Retourne les libellés des types d'analyses actifs pour une analyse."""
+    return [label for attr, label in ANALYSIS_TYPE_LABELS if getattr(analyse, attr)]
+
+
+def format_result_date(result_date):
+    return result_date.strftime("%Y-%m-%d %H:%M:%S") if result_date else None
+
+
+class ResultRepository:
+    """Accès en lecture aux résultats d'un patient pour la page resultat.html."""
+
+    def __init__(self, session):
+        self.session = session
+
+    def load_patient_report(self, patient_barcode):
+        """
+        Charge le patient, ses analyses, leurs résultats et le nom des paramètres
+        en un nombre fixe de requêtes (une par niveau, via selectinload),
+        quel que soit le nombre d'analyses du patient.
+        Retourne None si le patient n'existe pas.
+        """
+        patient = (
+            self.session.query(Patient)
+            .options(
+                load_only(Patient.id, Patient.name, Patient.prenom, Patient.adresse, Patient.email, Patient.tel,
+                          Patient.age, Patient.age_unit, Patient.sexe),
+                selectinload(Patient.analyses)
+                .load_only(Analyse.id, *[attr for attr, _ in ANALYSIS_TYPE_LABELS])
+                .selectinload(Analyse.resultats)
+                .load_only(Resultat.id, Resultat.analyse_id, Resultat.parameter_id, Resultat.valeur, Resultat.result_date)
+                .selectinload(Resultat.parameter)
+                .load_only(Parameter.param),
+            )
+            .filter_by(patient_barcode=patient_barcode)
+            .first()
+        )
+        if not patient:
+            return None
+
+        formatted_results = []
+        for analyse in sorted(patient.analyses, key=lambda a: a.id):
+            formatted_results.append({
+                "analyse_id": analyse.id,
+                "types_analyses": format_analysis_types(analyse),
+                "resultats": [
+                    {
+                        "parameter_id": resultat.parameter_id,
+                        "parameter": resultat.parameter.param,
+                        "valeur": resultat.valeur,
+                        "date": format_result_date(resultat.result_date),
+                    }
+                    for resultat in sorted(analyse.resultats, key=lambda r: r.id)
+                ],
+            })
+
+        return {
+            "nom": patient.name,
+            "prenom": patient.prenom,
+            "adresse": patient.adresse,
+            "email": patient.email,
+            "tel": patient.tel,
+            "age": patient.age,
+            "age_unit": patient.age_unit,
+            "sexe": patient.sexe,
+            "resultats": formatted_results,
+        }
+
+
+def build_report(rows, reference_data=None):
+    """
+    Construit le modèle de vue de resultat.html à partir des lignes plates
+    (patient, analyse, résultat, paramètre) triées par analyse puis résultat.
+    Avec reference_data (refdata.ReferenceData), les libellés des paramètres
+    viennent de l'instantané et les lignes n'ont pas de colonne param ; un paramètre
+    absent de l'instantané garde sa ligne, affichée avec son identifiant.
+    """
+    if not rows:
+        return None
+    first = rows[0]
+
+    formatted_results = []
+    current = None
+    for row in rows:
+        if row.analyse_id is None:
+            continue
+        if current is None or current["analyse_id"] != row.analyse_id:
+            current = {
+                "analyse_id": row.analyse_id,
+                "types_analyses": format_analysis_types(row),
+                "resultats": [],
+            }
+            formatted_results.append(current)
+        if row.resultat_id is not None:
+            current["resultats"].append({
+                "parameter_id": row.parameter_id,
+                "parameter": row.param if reference_data is None else (
+                    reference_data.param_label(row.parameter_id) or missing_label("Paramètre", row.parameter_id)),
+                "valeur": row.valeur,
+                "date": format_result_date(row.result_date),
+            })
+
+    return {
+        "nom": first.name,
+        "prenom": first.prenom,
+        "adresse": first.adresse,
+        "email": first.email,
+        "tel": first.tel,
+        "age": first.age,
+        "age_unit": first.age_unit,
+        "sexe": first.sexe,
+        "resultats": formatted_results,
+    }
+
+
+def report_query(patient_barcode, with_labels=True):
+    """
+    Requête projetée (Core) des lignes patient / analyse / résultat / paramètre de la page.
+    Sans with_labels, la table parameters n'est pas jointe (libellés pris dans refdata).
+    """
+    patients = Patient.__table__
+    analyses = Analyse.__table__
+    resultats = Resultat.__table__
+    parameters = Parameter.__table__
+    source = (
+        patients
+        .outerjoin(analyses, analyses.c.patient_id == patients.c.id)
+        .outerjoin(resultats, resultats.c.analyse_id == analyses.c.id)
+    )
+    if with_labels:
+        source = source.outerjoin(parameters, parameters.c.parameter_id == resultats.c.parameter_id)
+    return (
+        select(
+            patients.c.name, patients.c.prenom, patients.c.adresse, patients.c.email, patients.c.tel,
+            patients.c.age, patients.c.age_unit, patients.c.sexe,
+            analyses.c.id.label("analyse_id"),
+            *[analyses.c[attr] for attr, _ in ANALYSIS_TYPE_LABELS],
+            resultats.c.id.label("resultat_id"), resultats.c.parameter_id, resultats.c.valeur, resultats.c.result_date,
+            *([parameters.c.param] if with_labels else []),
+        )
+        .select_from(source)
+        .where(patients.c.patient_barcode == patient_barcode)
+        .order_by(analyses.c.id, resultats.c.id)
+    )
+
+
+def version_query(patient_barcode):
+    """
+    Requête d'agrégats donnant la version du contenu de la page d'un patient
+    (sans charger les lignes) : nombre et dernier id des analyses, dernière
+    validation, nombre, dernier id et dernière date des résultats, et dernière
+    mise à jour (updated_at) du patient, de ses analyses et de ses résultats, qui
+    change aussi quand une valeur existante est corrigée. Les résultats sont
+    rattachés au patient par leur analyse, comme dans report_query.
+    """
+    patients = Patient.__table__
+    analyses = Analyse.__table__
+    resultats = Resultat.__table__
+    analyses_du_patient = analyses.c.patient_id == patients.c.id
+    resultats_des_analyses = resultats.join(analyses, analyses.c.id == resultats.c.analyse_id)
+
+    def resultats_du_patient(aggregate):
+        return select(aggregate).select_from(resultats_des_analyses).where(analyses_du_patient).scalar_subquery()
+
+    return select(
+        patients.c.id,
+        select(func.count(analyses.c.id)).where(analyses_du_patient).scalar_subquery(),
+        select(func.max(analyses.c.id)).where(analyses_du_patient).scalar_subquery(),
+        select(func.max(analyses.c.validation_date)).where(analyses_du_patient).scalar_subquery(),
+        resultats_du_patient(func.count(resultats.c.id)),
+        resultats_du_patient(func.max(resultats.c.id)),
+        resultats_du_patient(func.max(resultats.c.result_date)),
+        patients.c.updated_at,
+        select(func.max(analyses.c.updated_at)).where(analyses_du_patient).scalar_subquery(),
+        resultats_du_patient(func.max(resultats.c.updated_at)),
+    ).where(patients.c.patient_barcode == patient_barcode)
+
+
+def build_version(row, salt=""):
+    """
+    Construit le ReportVersion à partir de la ligne de version_query (None si pas de patient).
+    salt distingue les contenus qui dépendent d'autres données (ex. valeurs de référence).
+    """
+    if row is None:
+        return None
+    version = "-".join(str(value) for value in row) + salt
+    dates = [date for date in (row[3], row[6], row[7], row[8], row[9]) if date is not None]
+    return ReportVersion(
+        patient_id=row[0],
+        nb_analyses=row[1],
+        version=version,
+        etag=hashlib.sha1(version.encode("utf-8")).hexdigest(),
+        last_modified=max(dates) if dates else None,
+    )
+
+
+def encode_cursor(result_date, resultat_id):
+    """Curseur opaque de pagination par clé : position (result_date, id) du dernier résultat servi."""
+    data = json.dumps([result_date.isoformat(), resultat_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Inverse de encode_cursor. Lève ValueError si le curseur est invalide."""
+    try:
+        result_date, resultat_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(result_date), int(resultat_id)
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"curseur invalide : {cursor}") from e
+
+
+def timeline_header_query(patient_barcode, parameter_id):
+    """Identifiant du patient et libellé du paramètre, en une requête."""
+    patients = Patient.__table__
+    parameters = Parameter.__table__
+    parameter = parameters.c.parameter_id == parameter_id
+    return select(
+        select(patients.c.id).where(patients.c.patient_barcode == patient_barcode).scalar_subquery(),
+        select(parameters.c.param).where(parameter).scalar_subquery(),
+        select(parameters.c.unite).where(parameter).scalar_subquery(),
+    )
+
+
+def timeline_query(patient_id, parameter_id, limit, after=None, descending=False):
+    """
+    Page de l'historique d'un paramètre pour un patient, triée par (result_date, id) :
+    recherche par clé (WHERE (result_date, id) > curseur) sur l'index
+    idx_resultat_patient_parameter_date, sans OFFSET. Une ligne de plus que limit
+    est lue pour savoir s'il reste une page. Les résultats sans date sont exclus.
+    """
+    resultats = Resultat.__table__
+    key = tuple_(resultats.c.result_date, resultats.c.id)
+    query = (
+        select(resultats.c.id, resultats.c.analyse_id, resultats.c.valeur, resultats.c.result_date,
+               resultats.c.validation_status)
+        .where(resultats.c.patient_id == patient_id)
+        .where(resultats.c.parameter_id == parameter_id)
+        .where(resultats.c.result_date.isnot(None))
+    )
+    if after is not None:
+        query = query.where(key < tuple_(*after) if descending else key > tuple_(*after))
+    if descending:
+        query = query.order_by(resultats.c.result_date.desc(), resultats.c.id.desc())
+    else:
+        query = query.order_by(resultats.c.result_date, resultats.c.id)
+    return query.limit(limit + 1)
+
+
+def build_timeline_page(rows, limit):
+    """Résultats de la page (au plus limit) et curseur de la page suivante (None si c'est la dernière)."""
+    page = rows[:limit]
+    next_cursor = encode_cursor(page[-1].result_date, page[-1].id) if len(rows) > limit else None
+    return [
+        {
+            "id": row.id,
+            "analyse_id": row.analyse_id,
+            "valeur": row.valeur,
+            "date": format_result_date(row.result_date),
+            "validation_status": row.validation_status,
+        }
+        for row in page
+    ], next_cursor
+
+
+class CoreResultRepository:
+    """
+    Variante sans ORM de ResultRepository : une seule requête SELECT projetée sur
+    les colonnes utilisées par resultat.html, sans identity map ni instrumentation.
+    """
+
+    def __init__(self, session, reference_cache=None):
+        self.session = session
+        # refdata.ReferenceDataCache : libellés des paramètres sans jointure
+        self.reference_cache = reference_cache
+
+    def report_version(self, patient_barcode, salt=""):
+        """Version du contenu de la page (ReportVersion), ou None si le patient n'existe pas."""
+        return build_version(self.session.execute(version_query(patient_barcode)).first(), salt)
+
+    def load_patient_report(self, patient_barcode):
+        """Même contrat que ResultRepository.load_patient_report, en une requête."""
+        if self.reference_cache is None:
+            return build_report(self.session.execute(report_query(patient_barcode)).all())
+        rows = self.session.execute(report_query(patient_barcode, with_labels=False)).all()
+        data = self.reference_cache.covering(parameters={row.parameter_id for row in rows})
+        return build_report(rows, data)
+
+    def timeline_header(self, patient_barcode, parameter_id):
+        """TimelineHeader du patient et du paramètre (patient_id / param à None s'ils n'existent pas)."""
+        parameter = None
+        if self.reference_cache is not None:
+            parameter = self.reference_cache.covering(parameters=[parameter_id]).parameters.get(parameter_id)
+        if parameter is None:
+            # Sans cache, ou paramètre encore absent de l'instantané : lu en base
+            patient_id, param, unite = self.session.execute(
+                timeline_header_query(patient_barcode, parameter_id)).one()
+            return TimelineHeader(patient_id, parameter_id, param, unite)
+        patients = Patient.__table__
+        patient_id = self.session.execute(
+            select(patients.c.id).where(patients.c.patient_barcode == patient_barcode)).scalar()
+        return TimelineHeader(patient_id, parameter_id, parameter.param, parameter.unite)
+
+    def timeline_page(self, patient_id, parameter_id, limit=100, cursor=None, descending=False):
+        """
+        Une page de l'historique : (résultats, curseur suivant). Le coût ne dépend que de
+        limit, pas du nombre de résultats du patient ni de la position dans l'historique.
+        """
+        after = decode_cursor(cursor) if cursor else None
+        rows = self.session.execute(timeline_query(patient_id, parameter_id, limit, after, descending)).all()
+        return build_timeline_page(rows, limit)
@@ -0,0 +1,289 @@
+"""
+Agrégats journaliers du chiffre d'affaires et des créances (table revenus_journaliers).
+
+Une ligne par jour × mode de paiement × convention × prescripteur (medecin). Elle est
+alimentée par Analyse (facture, fac_remise, montant_p, montant_r), Paiement
+(encaissements), SuiviPaiementConvention (encaissements_convention) et FactureAchat
+(achats, sans mode / convention / prescripteur).
+
+La table est tenue à jour de façon incrémentale à chaque flush ORM (register_rollups, à
+appeler au démarrage des processus qui écrivent) :
+les lignes sources touchées sont relues avant le flush (contribution retirée) et après
+(contribution ajoutée), et les écarts sont appliqués par upsert dans la même transaction.
+Les écritures Core en masse (import, facturation) ne passent pas par le flush : lancer
+rebuild sur la période concernée. Les totaux d'une période se lisent ensuite sur la
+clé primaire (jour en tête), sans parcourir les tables sources.
+
+Usage : python rollups.py rebuild [--debut 2022-01-01 --fin 2025-01-01]
+"""
+import argparse
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, date
+from sqlalchemy import event, select, insert, update, func, literal, union_all, and_
+from sqlalchemy.orm import Session
+from models import Analyse, Paiement, SuiviPaiementConvention, FactureAchat, RevenuJournalier
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = ("jour", "mode_paiement", "convention_id", "medecin")
+MESURES = ("nb_analyses", "facture", "fac_remise", "montant_p", "montant_r",
+           "encaissements", "encaissements_convention", "achats")
+
+_PENDING_KEY = "revenus_journaliers_ecarts"
+_MODIFIED_KEY = "revenus_journaliers_modifies"
+_registered = False
+
+
+def _source_query(model):
+    """
+    Lignes sources d'un modèle : (source_id, date, mode_paiement, convention_id, medecin,
+    mesures...). Utilisée pour les écarts incrémentaux comme pour la reconstruction.
+    """
+    analyses = Analyse.__table__
+    if model is Analyse:
+        return select(
+            analyses.c.id.label("source_id"), analyses.c.analyse_date.label("date"),
+            func.coalesce(analyses.c.mode_paiement, "").label("mode_paiement"),
+            func.coalesce(analyses.c.id_convention, 0).label("convention_id"),
+            func.coalesce(analyses.c.medecin, "").label("medecin"),
+            literal(1).label("nb_analyses"), analyses.c.facture.label("facture"),
+            analyses.c.fac_remise.label("fac_remise"),
+            func.coalesce(analyses.c.montant_p, 0.0).label("montant_p"),
+            func.coalesce(analyses.c.montant_r, 0.0).label("montant_r"),
+        )
+    if model is Paiement:
+        paiements = Paiement.__table__
+        return select(
+            paiements.c.id.label("source_id"), paiements.c.date_paiement.label("date"),
+            func.coalesce(paiements.c.mode_paiement, "").label("mode_paiement"),
+            func.coalesce(analyses.c.id_convention, 0).label("convention_id"),
+            func.coalesce(analyses.c.medecin, "").label("medecin"),
+            paiements.c.montant.label("encaissements"),
+        ).join(analyses, analyses.c.id == paiements.c.analyse_id)
+    if model is SuiviPaiementConvention:
+        suivis = SuiviPaiementConvention.__table__
+        return select(
+            suivis.c.id.label("source_id"), suivis.c.date_paiement.label("date"),
+            func.coalesce(suivis.c.mode_paiement, "").label("mode_paiement"),
+            suivis.c.convention_id.label("convention_id"), literal("").label("medecin"),
+            suivis.c.montant_paye.label("encaissements_convention"),
+        )
+    if model is FactureAchat:
+        achats = FactureAchat.__table__
+        return select(
+            achats.c.id.label("source_id"), achats.c.date_facture.label("date"),
+            literal("").label("mode_paiement"), literal(0).label("convention_id"), literal("").label("medecin"),
+            achats.c.montant_total.label("achats"),
+        )
+    raise ValueError(f"modèle non agrégé : {model}")
+
+
+SOURCE_MODELS = (Analyse, Paiement, SuiviPaiementConvention, FactureAchat)
+
+
+def _jour(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+# --- Maintenance incrémentale ---
+
+def _accumulate(connection, model, ids, sign, deltas):
+    """Ajoute à deltas la contribution (signée) des lignes sources ids du modèle."""
+    if not ids:
+        return
+    query = _source_query(model)
+    source_id = query.selected_columns.source_id
+    for row in connection.execute(query.where(source_id.in_(list(ids)))).mappings():
+        if row["date"] is None:
+            continue
+        key = (_jour(row["date"]), row["mode_paiement"], row["convention_id"], row["medecin"])
+        values = deltas[key]
+        for mesure in MESURES:
+            if mesure in row and row[mesure] is not None:
+                values[mesure] = values.get(mesure, 0) + sign * row[mesure]
+
+
+def _touched(connection, objects):
+    touched = defaultdict(set)
+    for obj in objects:
+        model = type(obj)
+        if model in SOURCE_MODELS and obj.id is not None:
+            touched[model].add(obj.id)
+    if touched.get(Analyse):
+        # Les paiements sont rangés sous la convention et le prescripteur de leur analyse
+        paiements = Paiement.__table__
+        touched[Paiement].update(connection.execute(
+            select(paiements.c.id).where(paiements.c.analyse_id.in_(list(touched[Analyse])))
+        ).scalars())
+    return touched
+
+
+def _before_flush(session, flush_context, instances):
+    # Contribution actuelle (avant écriture) des lignes modifiées ou supprimées : à retirer.
+    # Les lignes modifiées retenues ici sont exactement celles réajoutées après le flush.
+    modified = [obj for obj in session.dirty
+                if type(obj) in SOURCE_MODELS and obj not in session.deleted and session.is_modified(obj)]
+    session.info[_MODIFIED_KEY] = modified
+    objects = modified + [obj for obj in session.deleted if type(obj) in SOURCE_MODELS]
+    if not objects:
+        return
+    connection = session.connection()
+    touched = _touched(connection, objects)
+    deltas = session.info.setdefault(_PENDING_KEY, defaultdict(dict))
+    for model, ids in touched.items():
+        _accumulate(connection, model, ids, -1, deltas)
+
+
+def _after_flush(session, flush_context):
+    # Nouvelle contribution des lignes insérées ou modifiées : à ajouter
+    deltas = session.info.pop(_PENDING_KEY, None) or defaultdict(dict)
+    modified = session.info.pop(_MODIFIED_KEY, None) or []
+    objects = [obj for obj in session.new if type(obj) in SOURCE_MODELS] + modified
+    if not objects and not deltas:
+        return
+    connection = session.connection()
+    touched = _touched(connection, objects)
+    for model, ids in touched.items():
+        _accumulate(connection, model, ids, 1, deltas)
+    apply_deltas(connection, deltas)
+
+
+def apply_deltas(connection, deltas):
+    """
+    Applique des écarts {(jour, mode_paiement, convention_id, medecin): {mesure: écart}}
+    par upsert (INSERT ... ON CONFLICT DO UPDATE sur PostgreSQL et SQLite).
+    """
+    rows = []
+    for key, values in deltas.items():
+        if any(values.values()):
+            row = dict(zip(DIMENSIONS, key))
+            row.update({mesure: values.get(mesure, 0) for mesure in MESURES})
+            rows.append(row)
+    if not rows:
+        return
+    table = RevenuJournalier.__table__
+    dialect = connection.dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        statement = upsert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(DIMENSIONS),
+            set_={mesure: table.c[mesure] + statement.excluded[mesure] for mesure in MESURES},
+        )
+        connection.execute(statement, rows)
+        return
+    for row in rows:
+        key = and_(*(table.c[dimension] == row[dimension] for dimension in DIMENSIONS))
+        updated = connection.execute(
+            update(table).where(key).values({mesure: table.c[mesure] + row[mesure] for mesure in MESURES})
+        ).rowcount
+        if not updated:
+            connection.execute(insert(table).values(row))
+
+
+def register_rollups():
+    """Tient revenus_journaliers à jour à chaque flush de session (toutes les sessions du processus)."""
+    global _registered
+    if _registered:
+        return
+    event.listen(Session, "before_flush", _before_flush)
+    event.listen(Session, "after_flush", _after_flush)
+    _registered = True
+
+
+# --- Reconstruction ---
+
+def _rebuild_query(debut=None, fin=None):
+    parts = []
+    for model in SOURCE_MODELS:
+        query = _source_query(model)
+        columns = query.selected_columns
+        if debut is not None:
+            query = query.where(columns.date >= debut)
+        if fin is not None:
+            query = query.where(columns.date < fin)
+        source = query.subquery()
+        parts.append(
+            select(func.date(source.c.date).label("jour"), source.c.mode_paiement, source.c.convention_id,
+                   source.c.medecin,
+                   *(source.c[mesure].label(mesure) if mesure in source.c else literal(0).label(mesure)
+                     for mesure in MESURES))
+            .where(source.c.date.isnot(None))
+        )
+    lignes = union_all(*parts).subquery()
+    return (
+        select(lignes.c.jour, lignes.c.mode_paiement, lignes.c.convention_id, lignes.c.medecin,
+               *(func.sum(lignes.c[mesure]).label(mesure) for mesure in MESURES))
+        .group_by(lignes.c.jour, lignes.c.mode_paiement, lignes.c.convention_id, lignes.c.medecin)
+    )
+
+
+def rebuild(connection, debut=None, fin=None):
+    """
+    Recalcule revenus_journaliers sur [debut, fin[ (tout l'historique par défaut)
+    en une requête INSERT ... SELECT groupée. Retourne le nombre de lignes écrites.
+    """
+    table = RevenuJournalier.__table__
+    delete = table.delete()
+    if debut is not None:
+        delete = delete.where(table.c.jour >= _jour(debut))
+    if fin is not None:
+        delete = delete.where(table.c.jour < _jour(fin))
+    connection.execute(delete)
+    return connection.execute(
+        insert(table).from_select(list(DIMENSIONS + MESURES), _rebuild_query(debut, fin))
+    ).rowcount
+
+
+# --- Requêtes ---
+
+def revenue_totals(connection, debut, fin, group_by=(), **filters):
+    """
+    Totaux des mesures sur [debut, fin[ lus dans revenus_journaliers, regroupés selon
+    group_by (sous-ensemble de DIMENSIONS) et filtrés par égalité sur les dimensions,
+    ex. revenue_totals(c, date(2024, 1, 1), date(2025, 1, 1), ("mode_paiement",), convention_id=3).
+    Retourne une liste de dictionnaires.
+    """
+    table = RevenuJournalier.__table__
+    for dimension in tuple(group_by) + tuple(filters):
+        if dimension not in DIMENSIONS:
+            raise ValueError(f"dimension inconnue : {dimension}")
+    query = (
+        select(*(table.c[dimension] for dimension in group_by),
+               *(func.coalesce(func.sum(table.c[mesure]), 0).label(mesure) for mesure in MESURES))
+        .where(table.c.jour >= _jour(debut))
+        .where(table.c.jour < _jour(fin))
+    )
+    for dimension, value in filters.items():
+        query = query.where(table.c[dimension] == value)
+    if group_by:
+        query = query.group_by(*(table.c[dimension] for dimension in group_by)) \
+            .order_by(*(table.c[dimension] for dimension in group_by))
+    return [dict(row) for row in connection.execute(query).mappings()]
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from database import create_engine_from_env
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Agrégats journaliers du chiffre d'affaires")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--debut", type=date.fromisoformat, default=None)
+    parser.add_argument("--fin", type=date.fromisoformat, default=None)
+    args = parser.parse_args()
+
+    engine = create_engine_from_env(os.getenv("DATABASE_URL"))
+    start = time.perf_counter()
+    debut = datetime.combine(args.debut, datetime.min.time()) if args.debut else None
+    fin = datetime.combine(args.fin, datetime.min.time()) if args.fin else None
+    with engine.begin() as connection:
+        count = rebuild(connection, debut, fin)
+    logger.info(f"revenus_journaliers reconstruite : {count} lignes en {time.perf_counter() - start:.1f}s")
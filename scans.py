@@ -0,0 +1,238 @@
+"""
+Réception des échantillons : lecture des codes à barres.
+
+BarcodeIndex garde en mémoire barcode_value -> (analyse, tube, type de prélèvement),
+chargé au démarrage en une requête et tenu à jour par les événements ORM sur Barcode
+(appliqués après commit). Un code inconnu de l'index (créé par un autre processus)
+est cherché en base puis mémorisé.
+
+ScanLogBuffer regroupe les écritures ScanLog : un thread écrit le tampon en une
+seule transaction (executemany) toutes les max_delay secondes ou dès max_rows lignes.
+log() rend la main immédiatement et retourne un threading.Event, levé une fois le
+lot qui contient la ligne traité, pour les appelants qui doivent attendre l'écriture.
+Si un lot échoue, ses lignes sont réécrites une par une : celles qui échouent encore
+après max_retries essais sont journalisées puis écartées, pour qu'une ligne invalide
+ne bloque pas les suivantes (ni, par contre-pression, les postes de lecture).
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import event, insert, select
+from sqlalchemy.orm import Session, attributes, object_session
+from models import Barcode, ScanLog
+
+logger = logging.getLogger(__name__)
+
+BarcodeEntry = namedtuple("BarcodeEntry", ["barcode_id", "analyse_id", "tube_id", "prelevement_type_id"])
+
+_PENDING_KEY = "codes_barres_modifies"
+
+
+def _barcode_query():
+    barcodes = Barcode.__table__
+    return select(barcodes.c.barcode_value, barcodes.c.id, barcodes.c.analyse_id, barcodes.c.tube_id,
+                  barcodes.c.prelevement_type_id)
+
+
+class BarcodeIndex:
+    """Index en mémoire des codes à barres d'échantillons."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """Charge tous les codes à barres en une requête."""
+        with self.engine.connect() as connection:
+            entries = {row[0]: BarcodeEntry(*row[1:]) for row in connection.execute(_barcode_query())}
+        with self._lock:
+            self._entries = entries
+        logger.info(f"Index des codes à barres chargé : {len(entries)} codes")
+        return self
+
+    def put(self, barcode_value, entry):
+        with self._lock:
+            self._entries[barcode_value] = entry
+
+    def discard(self, barcode_value):
+        with self._lock:
+            self._entries.pop(barcode_value, None)
+
+    def lookup(self, barcode_value):
+        """Retourne le BarcodeEntry du code, ou None s'il n'existe pas."""
+        entry = self._entries.get(barcode_value)
+        if entry is None and self.engine is not None:
+            barcodes = Barcode.__table__
+            with self.engine.connect() as connection:
+                row = connection.execute(
+                    _barcode_query().where(barcodes.c.barcode_value == barcode_value)).first()
+            if row is not None:
+                entry = BarcodeEntry(*row[1:])
+                self.put(barcode_value, entry)
+        return entry
+
+
+def register_refresh(barcode_index):
+    """
+    Répercute dans l'index les écritures ORM sur Barcode, une fois la transaction validée.
+    Un code renommé perd son ancienne valeur (lue dans l'historique de l'attribut).
+    """
+
+    def _track(change):
+        def _listener(mapper, connection, target):
+            session = object_session(target)
+            if session is None:
+                return
+            pending = session.info.setdefault(_PENDING_KEY, [])
+            for old_value in attributes.get_history(target, "barcode_value").deleted:
+                if old_value is not None and old_value != target.barcode_value:
+                    pending.append(("delete", old_value, None))
+            entry = BarcodeEntry(target.id, target.analyse_id, target.tube_id, target.prelevement_type_id)
+            pending.append((change, target.barcode_value, entry))
+        return _listener
+
+    def _after_commit(session):
+        for change, barcode_value, entry in session.info.pop(_PENDING_KEY, None) or ():
+            if change == "delete":
+                barcode_index.discard(barcode_value)
+            else:
+                barcode_index.put(barcode_value, entry)
+
+    def _after_rollback(session):
+        session.info.pop(_PENDING_KEY, None)
+
+    event.listen(Barcode, "after_insert", _track("put"))
+    event.listen(Barcode, "after_update", _track("put"))
+    event.listen(Barcode, "after_delete", _track("delete"))
+    event.listen(Session, "after_commit", _after_commit)
+    event.listen(Session, "after_rollback", _after_rollback)
+    return barcode_index
+
+
+class ScanLogBuffer:
+    """Tampon d'écriture groupée des ScanLog (group commit)."""
+
+    def __init__(self, engine, max_rows=500, max_delay=0.005, max_pending=100000, max_retries=3,
+                 retry_delay=1.0):
+        self.engine = engine
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._rows = []
+        self._committed = threading.Event()
+        self._condition = threading.Condition()
+        self._closed = False
+        self.nb_ecrits = 0
+        self.nb_ecartes = 0
+        self.nb_lots = 0
+        self._thread = threading.Thread(target=self._run, name="scan-log-buffer", daemon=True)
+        self._thread.start()
+
+    def log(self, barcode_value, operator_id, scanned_at=None, result_id=None):
+        """Ajoute un ScanLog au tampon. Retourne l'Event levé après validation du lot qui le contient."""
+        row = {"barcode_value": barcode_value, "operator_id": operator_id,
+               "scanned_at": scanned_at or datetime.now(), "result_id": result_id}
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("ScanLogBuffer fermé")
+            while len(self._rows) >= self.max_pending:
+                # Contre-pression : la base ne suit plus
+                self._condition.wait()
+            self._rows.append(row)
+            committed = self._committed
+            if len(self._rows) == 1 or len(self._rows) >= self.max_rows:
+                self._condition.notify_all()
+        return committed
+
+    def _take(self):
+        with self._condition:
+            while not self._rows and not self._closed:
+                self._condition.wait()
+            deadline = time.monotonic() + self.max_delay
+            while len(self._rows) < self.max_rows and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            rows, self._rows = self._rows[:self.max_rows], self._rows[self.max_rows:]
+            committed = self._committed
+            if rows and not self._rows:
+                self._committed = threading.Event()
+            self._condition.notify_all()
+            return rows, committed
+
+    def _insert(self, rows):
+        with self.engine.begin() as connection:
+            connection.execute(insert(ScanLog.__table__), rows)
+
+    def _write(self, rows):
+        """
+        Écrit un lot. En cas d'échec, réessaie ligne par ligne jusqu'à max_retries fois
+        (sans attente une fois le tampon fermé) et écarte les lignes qui échouent encore.
+        Retourne le nombre de lignes écrites.
+        """
+        try:
+            self._insert(rows)
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Erreur lors de l'écriture de {len(rows)} ScanLog, reprise ligne par ligne : {str(e)}")
+
+        written = 0
+        failed = [(row, None) for row in rows]
+        for attempt in range(1, self.max_retries + 1):
+            if attempt > 1 and not self._closed:
+                time.sleep(self.retry_delay * (attempt - 1))
+            remaining, failed = failed, []
+            for row, _ in remaining:
+                try:
+                    self._insert([row])
+                    written += 1
+                except Exception as e:
+                    failed.append((row, e))
+            if not failed:
+                break
+        for row, error in failed:
+            logger.error(f"ScanLog écarté après {self.max_retries} essais : {row} ({str(error)})")
+        self.nb_ecartes += len(failed)
+        return written
+
+    def _run(self):
+        while True:
+            rows, committed = self._take()
+            if rows:
+                self.nb_ecrits += self._write(rows)
+                self.nb_lots += 1
+            if committed is not self._committed:
+                committed.set()
+            if self._closed and not self._rows:
+                return
+
+    def close(self):
+        """Écrit les lignes en attente et arrête le thread d'écriture."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+
+class ScanService:
+    """Lecture d'un code à barres à la réception : résolution en mémoire et journalisation groupée."""
+
+    def __init__(self, barcode_index, scan_log_buffer):
+        self.index = barcode_index
+        self.buffer = scan_log_buffer
+
+    def scan(self, barcode_value, operator_id):
+        """Retourne le BarcodeEntry du code (None s'il est inconnu) et journalise la lecture."""
+        barcode_value = barcode_value.strip()
+        entry = self.index.lookup(barcode_value)
+        self.buffer.log(barcode_value, operator_id)
+        return entry
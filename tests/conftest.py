@@ -0,0 +1,58 @@
+"""
+Configuration commune des tests : base SQLite temporaire (DATABASE_URL est fixée
+avant l'import de app, qui crée son engine au chargement) et compteur de requêtes.
+"""
+import os
+import sys
+import tempfile
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+_DB_DIR = tempfile.mkdtemp(prefix="lam-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR, 'lam.db')}"
+os.environ["DATABASE_REPLICA_URLS"] = ""
+
+from sqlalchemy import create_engine, event  # noqa: E402
+from models import Base  # noqa: E402
+
+
+class QueryCounter:
+    """Compte les requêtes SQL envoyées par un engine (after_cursor_execute)."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        event.listen(engine, "after_cursor_execute", self._count)
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def reset(self):
+        self.statements = []
+
+    def close(self):
+        event.remove(self.engine, "after_cursor_execute", self._count)
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine(os.environ["DATABASE_URL"])
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    yield engine
+    Base.metadata.drop_all(engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def query_counter(engine):
+    counter = QueryCounter(engine)
+    yield counter
+    counter.close()
@@ -0,0 +1,80 @@
+"""Antibiogramme cumulé : règle du premier isolat, intégration incrémentale et recalcul."""
+from datetime import datetime
+import pytest
+from sqlalchemy import insert, update
+from antibiogram import AntibiogramCache, year_period
+from models import Analyse, AntibioResult, Antibiotique, BacterioResult, Germe
+from seed import seed
+
+DEBUT, FIN = year_period(2024)
+AMX, CIP = 1, 2
+
+
+@pytest.fixture
+def cache(engine):
+    # Patient 0 : analyses 1 à 3, patient 1 : analyses 4 à 6
+    seed(engine, 2, 3, 1)
+    analyses = Analyse.__table__
+    with engine.begin() as connection:
+        for analyse_id, day in ((1, 10), (2, 5), (3, 20), (4, 15), (5, 25), (6, 28)):
+            connection.execute(update(analyses).where(analyses.c.id == analyse_id)
+                               .values(analyse_date=datetime(2024, 3, day)))
+        connection.execute(insert(Germe.__table__).values(id=1, nom="Escherichia coli", genre="Escherichia",
+                                                           espece="coli", gram="negatif"))
+        connection.execute(insert(Antibiotique.__table__), [
+            {"id": AMX, "code": "AMX", "nom": "Amoxicilline"}, {"id": CIP, "code": "CIP", "nom": "Ciprofloxacine"}])
+    return AntibiogramCache(engine)
+
+
+def _isolate(engine, analyse_id, resultats):
+    with engine.begin() as connection:
+        bacterio_id = connection.execute(insert(BacterioResult.__table__).values(
+            analyse_id=analyse_id, germe_identifie=1)).inserted_primary_key[0]
+        connection.execute(insert(AntibioResult.__table__), [
+            {"bacterio_result_id": bacterio_id, "antibiotique_id": antibiotique_id, "resultat": resultat}
+            for antibiotique_id, resultat in resultats.items()])
+    return bacterio_id
+
+
+def _fresh(engine):
+    return AntibiogramCache(engine).counts(DEBUT, FIN)
+
+
+def test_first_isolate_per_patient_and_germ(engine, cache):
+    # Patient 0 : l'isolat du 5 mars (analyse 2) sans résultat interprétable est ignoré,
+    # celui du 10 mars (analyse 1) est le premier, celui du 20 mars (analyse 3) ne compte pas
+    _isolate(engine, 2, {AMX: None})
+    _isolate(engine, 1, {AMX: "Sensible", CIP: "Résistant"})
+    _isolate(engine, 3, {AMX: "Résistant"})
+    _isolate(engine, 4, {AMX: "résistant"})
+    assert cache.counts(DEBUT, FIN) == {(1, AMX): (1, 0, 1), (1, CIP): (0, 0, 1)}
+
+
+def test_catch_up_then_recompute(engine, cache, query_counter):
+    _isolate(engine, 1, {AMX: "S"})
+    assert cache.counts(DEBUT, FIN) == {(1, AMX): (1, 0, 0)}
+
+    # Nouveau premier isolat (patient 1) et isolat suivant (patient 0) : intégration incrémentale
+    _isolate(engine, 4, {AMX: "R"})
+    _isolate(engine, 3, {AMX: "R"})
+    query_counter.reset()
+    counts = cache.counts(DEBUT, FIN)
+    assert not any("row_number" in statement for statement in query_counter.statements)
+    assert counts == _fresh(engine) == {(1, AMX): (1, 0, 1)}
+
+    # Isolat saisi en retard, antérieur au premier isolat connu du patient 0 : recalcul complet
+    _isolate(engine, 2, {AMX: "R"})
+    query_counter.reset()
+    counts = cache.counts(DEBUT, FIN)
+    assert any("row_number" in statement for statement in query_counter.statements)
+    assert counts == _fresh(engine) == {(1, AMX): (0, 0, 2)}
+
+
+def test_updated_result_triggers_recompute(engine, cache):
+    bacterio_id = _isolate(engine, 1, {AMX: None, CIP: "S"})
+    assert cache.counts(DEBUT, FIN) == {(1, CIP): (1, 0, 0)}
+    antibio = AntibioResult.__table__
+    with engine.begin() as connection:
+        connection.execute(update(antibio).where(antibio.c.bacterio_result_id == bacterio_id)
+                           .where(antibio.c.antibiotique_id == AMX).values(resultat="I"))
+    assert cache.counts(DEBUT, FIN) == _fresh(engine) == {(1, AMX): (0, 1, 0), (1, CIP): (1, 0, 0)}
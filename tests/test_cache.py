@@ -0,0 +1,39 @@
+"""Cache des pages résultats : invalidations bornées et pages calculées avant une invalidation."""
+from sqlalchemy.orm import Session
+from cache import LRUCacheBackend, ResultPageCache, on_results_committed
+from models import NumerationFormuleSanguine
+from seed import seed
+
+
+def test_page_computed_before_invalidation_is_not_stored():
+    cache = ResultPageCache(LRUCacheBackend())
+    generation = cache.generation("P1")
+    cache.invalidate("P1")
+    cache.set("P1", "v1", "ancienne page", generation)
+    assert cache.get("P1", "v1") is None
+
+    cache.set("P1", "v1", "page", cache.generation("P1"))
+    assert cache.get("P1", "v1") == "page"
+
+
+def test_invalidations_are_bounded():
+    cache = ResultPageCache(LRUCacheBackend(), max_invalidations=10)
+    generation = cache.generation("P0")
+    for patient in range(1000):
+        cache.invalidate(f"P{patient}")
+    assert len(cache._invalidations) == 10
+    # P0 a été oublié : sa page calculée avant l'invalidation n'est toujours pas stockée
+    cache.set("P0", "v1", "ancienne page", generation)
+    assert cache.get("P0", "v1") is None
+
+
+def test_flush_resolves_analyses_in_one_query(engine, query_counter):
+    seed(engine, 2, 5, 1)
+    committed = []
+    on_results_committed(committed.append)
+    with Session(engine) as session:
+        session.add_all(NumerationFormuleSanguine(analyse_id=analyse_id) for analyse_id in range(1, 11))
+        query_counter.reset()
+        session.commit()
+    assert sum("FROM analyses" in statement for statement in query_counter.statements) == 1
+    assert committed[-1] == {"P00000", "P00001"}
@@ -0,0 +1,53 @@
+"""Décompte des réactifs : reprise de l'historique à la migration de consumed_at."""
+from datetime import datetime
+from sqlalchemy import insert, select, update
+from models import Analyse, AnalyseDetail, Product, ProductType
+from consumption import ConsumptionEngine, backfill
+from seed import seed
+
+
+def _stock(engine):
+    with engine.connect() as connection:
+        return connection.execute(select(Product.__table__.c.quantity_remaining)).scalar_one()
+
+
+def test_backfill_keeps_history_out_of_stock(engine):
+    seed(engine, 1, 4, 1)
+    analyses = Analyse.__table__
+    with engine.begin() as connection:
+        connection.execute(update(analyses).where(analyses.c.id <= 3).values(analyse_date=datetime(2020, 1, 1)))
+        connection.execute(update(analyses).where(analyses.c.id == 4).values(analyse_date=datetime(2024, 1, 1)))
+        connection.execute(insert(Product.__table__).values(
+            id=1, type=ProductType.REACTIF, parameter_id=1, marque="M", lot="L1", nombre_flacons=1, nb_test=100,
+            expiration=datetime(2030, 1, 1), methode="m", prix_coffret=10.0, quantity_remaining=100))
+        connection.execute(insert(AnalyseDetail.__table__), [
+            {"analyse_id": analyse_id, "parameter_id": 1, "product_id": 1} for analyse_id in range(1, 5)])
+
+    with engine.begin() as connection:
+        assert backfill(connection, before=datetime(2023, 1, 1)) == 3
+    assert ConsumptionEngine(engine).drain() == 1
+    assert _stock(engine) == 99
+
+    with engine.begin() as connection:
+        assert backfill(connection) == 0
+    assert ConsumptionEngine(engine).drain() == 0
+
+
+def test_details_without_product_leave_the_queue(engine):
+    seed(engine, 1, 1, 1)
+    details = AnalyseDetail.__table__
+    with engine.begin() as connection:
+        connection.execute(insert(Product.__table__).values(
+            id=1, type=ProductType.REACTIF, parameter_id=1, marque="M", lot="L1", nombre_flacons=1, nb_test=100,
+            expiration=datetime(2030, 1, 1), methode="m", prix_coffret=10.0, quantity_remaining=100))
+        connection.execute(insert(details), [
+            {"analyse_id": 1, "parameter_id": 1, "product_id": None},
+            {"analyse_id": 1, "parameter_id": 1, "product_id": 1},
+            {"analyse_id": 1, "parameter_id": 1, "product_id": None}])
+
+    assert ConsumptionEngine(engine, batch_size=2).drain() == 3
+    assert _stock(engine) == 99
+    with engine.connect() as connection:
+        assert connection.execute(select(details.c.id).where(details.c.consumed_at.is_(None))).all() == []
+    with engine.begin() as connection:
+        assert ConsumptionEngine(engine).consume_batch(connection) == (0, [])
@@ -0,0 +1,65 @@
+"""Indices dérivés des NFS : à l'écriture ORM et au retraitement par tranches."""
+import pytest
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+from hematology import recompute_chunk, register_derivation
+from models import NumerationFormuleSanguine
+from seed import seed
+
+MESURES = {"hemoglobine": 14.0, "hematocrite": 42.0, "globules_rouges": 4.5, "globules_blancs": 8.0,
+           "neutrophiles": 60.0, "lymphocytes": 30.0, "monocytes": 6.0, "plaquettes": 240.0, "reticulocytes": 15.0}
+ATTENDUS = {"vgm": 93.33, "tcmh": 31.11, "ccmh": 33.33, "nlr": 2.0, "plr": 100.0, "mlr": 0.2}
+
+
+def _nfs(engine, nfs_id):
+    with engine.connect() as connection:
+        table = NumerationFormuleSanguine.__table__
+        return connection.execute(select(table).where(table.c.id == nfs_id)).one()
+
+
+@pytest.fixture
+def analyse_id(engine):
+    seed(engine, 1, 1, 1)
+    return 1
+
+
+def test_indices_derived_on_orm_write(engine, analyse_id):
+    register_derivation()
+    with Session(engine) as session:
+        complete = NumerationFormuleSanguine(analyse_id=analyse_id, **MESURES)
+        # Globules rouges manquants : le vgm et le tcmh saisis à la main sont conservés
+        partielle = NumerationFormuleSanguine(analyse_id=analyse_id, **dict(MESURES, globules_rouges=None),
+                                              vgm=88.0, tcmh=29.0)
+        session.add_all([complete, partielle])
+        session.commit()
+        complete_id, partielle_id = complete.id, partielle.id
+
+        complete.lymphocytes = 20.0
+        session.commit()
+
+    row = _nfs(engine, complete_id)
+    assert {column: getattr(row, column) for column in ("vgm", "tcmh", "ccmh")} == pytest.approx(
+        {column: ATTENDUS[column] for column in ("vgm", "tcmh", "ccmh")})
+    assert row.nlr == pytest.approx(3.0) and row.ipr is not None
+    row = _nfs(engine, partielle_id)
+    assert (row.vgm, row.tcmh, row.ccmh) == (88.0, 29.0, pytest.approx(33.33))
+
+
+def test_recompute_chunk(engine, analyse_id):
+    table = NumerationFormuleSanguine.__table__
+    with engine.begin() as connection:
+        # Indices faux à corriger, puis NFS sans globules rouges dont le vgm et le tcmh saisis sont gardés
+        connection.execute(insert(table).values(dict(MESURES, analyse_id=analyse_id, vgm=1.0)))
+        connection.execute(insert(table).values(dict(MESURES, analyse_id=analyse_id, globules_rouges=None,
+                                                     vgm=88.0, tcmh=29.0)))
+    with engine.begin() as connection:
+        last_id, lues, modifiees = recompute_chunk(connection, chunk_size=10)
+    assert (lues, modifiees) == (2, 2)
+    row = _nfs(engine, 1)
+    assert (row.vgm, row.nlr) == (pytest.approx(93.33), pytest.approx(2.0))
+    row = _nfs(engine, 2)
+    assert (row.vgm, row.tcmh) == (88.0, 29.0)
+
+    with engine.begin() as connection:
+        assert recompute_chunk(connection, chunk_size=10)[1:] == (2, 0)
+        assert recompute_chunk(connection, last_id, chunk_size=10) == (None, 0, 0)
@@ -0,0 +1,42 @@
+"""Facturation des conventions : montants enregistrés et analyses saisies en retard."""
+from datetime import datetime
+import pytest
+from sqlalchemy import insert, update
+from invoicing import InvoiceAlreadyIssued, invoice_convention
+from models import Analyse, Convention, Parameter
+from seed import seed
+
+DEBUT, FIN = datetime(2024, 5, 1), datetime(2024, 6, 1)
+
+
+@pytest.fixture
+def convention_id(engine):
+    seed(engine, 1, 3, 1)
+    analyses = Analyse.__table__
+    with engine.begin() as connection:
+        connection.execute(insert(Convention.__table__).values(
+            id=1, convention_name="Hôpital", etablissement="Hôpital", remise=10.0, numero="C1"))
+        connection.execute(update(analyses).where(analyses.c.id <= 2).values(
+            id_convention=1, is_convention=True, analyse_date=datetime(2024, 5, 10), facture=80.0))
+    return 1
+
+
+def test_invoice_uses_recorded_amount(engine, convention_id):
+    with engine.begin() as connection:
+        # Nouveau tarif après la saisie : sans effet sur la facture de la période
+        connection.execute(update(Parameter.__table__).values(prix_u=500.0))
+        result = invoice_convention(connection, convention_id, DEBUT, FIN)
+    assert result.nb_lignes == 2
+    assert result.montant_total == pytest.approx(144.0)
+
+
+def test_late_analysis_is_reported(engine, convention_id):
+    with engine.begin() as connection:
+        invoice_convention(connection, convention_id, DEBUT, FIN)
+    with engine.begin() as connection:
+        assert invoice_convention(connection, convention_id, DEBUT, FIN) is None
+        connection.execute(update(Analyse.__table__).where(Analyse.__table__.c.id == 3).values(
+            id_convention=1, is_convention=True, analyse_date=datetime(2024, 5, 20), facture=50.0))
+    with pytest.raises(InvoiceAlreadyIssued) as error, engine.begin() as connection:
+        invoice_convention(connection, convention_id, DEBUT, FIN)
+    assert error.value.nb_lignes == 1 and error.value.montant == pytest.approx(45.0)
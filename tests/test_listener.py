@@ -0,0 +1,59 @@
+"""Listener ASTM / HL7 : un résultat impossible à écrire ne bloque pas la file."""
+import asyncio
+import time
+from sqlalchemy import func, insert, select, text
+from importer import ResultImporter
+from listener import ResultListener
+from models import ImportLog, Parameter, Resultat
+from seed import seed
+
+
+def _result(reference, value, parameter="P1"):
+    return {"sample": "DOS00000001", "parameter": parameter, "value": value, "date": "20240501080000",
+            "reference": reference, "received_at": time.time()}
+
+
+def _count(engine, table):
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(table.__table__)).scalar()
+
+
+def test_failing_row_is_dead_lettered_and_queue_keeps_moving(engine):
+    seed(engine, 1, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TRIGGER refuse_666 BEFORE INSERT ON resultat WHEN NEW.valeur = 666 "
+            "BEGIN SELECT RAISE(ABORT, 'valeur refusée'); END"))
+    importer = ResultImporter(engine, "Automate", date_format="%Y%m%d%H%M%S", decimal_comma=False)
+    listener = ResultListener(importer, batch_size=10, flush_interval=0.05, retry_delay=0)
+    nb_resultats = _count(engine, Resultat)
+
+    async def scenario():
+        await listener.start()
+        await listener.enqueue([_result(f"R{i}", "666" if i == 3 else str(i)) for i in range(5)])
+        await asyncio.wait_for(listener.queue.join(), 10)
+        await listener.enqueue([_result("R5", "5")])
+        await asyncio.wait_for(listener.queue.join(), 10)
+        running = not listener._flusher.done()
+        await listener.stop()
+        return running
+
+    assert asyncio.run(scenario())
+    assert _count(engine, Resultat) == nb_resultats + 5
+    assert listener.metrics.dead_letters == 1
+    with engine.connect() as connection:
+        log = connection.execute(select(ImportLog.__table__)).one()
+    assert log.status == "ERROR" and "R3" in log.error_message
+
+
+def test_new_parameter_is_picked_up_before_rejecting(engine):
+    seed(engine, 1, 1, 1)
+    importer = ResultImporter(engine, "Automate", date_format="%Y%m%d%H%M%S", decimal_comma=False,
+                              min_reload_interval=0)
+    stats = {"nb_importes": 0, "nb_doublons": 0, "nb_rejets": 0, "erreurs": []}
+    with engine.begin() as connection:
+        importer.import_records(connection, {1: _result("R1", "1")}, stats)
+        connection.execute(insert(Parameter.__table__).values(
+            parameter_id=2, param="Paramètre 2", nom_param="P2", prix_u=10.0))
+        importer.import_records(connection, {2: _result("R2", "2", parameter="P2")}, stats)
+    assert stats["nb_importes"] == 2 and stats["nb_rejets"] == 0
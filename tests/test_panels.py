@@ -0,0 +1,48 @@
+"""Préparation des panels d'antibiogramme : pas de doublon (isolat, antibiotique)."""
+import pytest
+from sqlalchemy import func, insert, select
+from models import (AntibioGroup, AntibioResult, Antibiotique, BacterioResult, Germe, germes_antibio_groups,
+                    group_antibiotiques_table)
+from panels import PanelIndex, _insert_missing, create_panels
+from seed import seed
+
+
+@pytest.fixture
+def bacterio_id(engine):
+    seed(engine, 1, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(insert(Antibiotique.__table__), [
+            {"id": 1, "code": "AMX", "nom": "Amoxicilline"}, {"id": 2, "code": "CIP", "nom": "Ciprofloxacine"}])
+        connection.execute(insert(AntibioGroup.__table__).values(group_id=1, group_name="Entérobactéries"))
+        connection.execute(insert(group_antibiotiques_table), [
+            {"group_id": 1, "antibiotique_id": 1}, {"group_id": 1, "antibiotique_id": 2}])
+        connection.execute(insert(Germe.__table__).values(id=1, nom="Escherichia coli", genre="Escherichia",
+                                                           espece="coli", gram="negatif"))
+        connection.execute(insert(germes_antibio_groups).values(germe_id=1, group_id=1))
+        return connection.execute(insert(BacterioResult.__table__).values(
+            analyse_id=1, germe_identifie=1)).inserted_primary_key[0]
+
+
+def _nb_lignes(engine):
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(AntibioResult.__table__)).scalar()
+
+
+def test_create_panels_is_idempotent(engine, bacterio_id):
+    index = PanelIndex(engine)
+    with engine.begin() as connection:
+        assert create_panels(connection, index, [bacterio_id]).nb_lignes == 2
+    with engine.begin() as connection:
+        assert create_panels(connection, index, [bacterio_id]).nb_lignes == 0
+    assert _nb_lignes(engine) == 2
+
+
+def test_concurrent_insert_skips_existing_rows(engine, bacterio_id):
+    # Lignes calculées par un autre poste avant que celui-ci n'écrive les siennes
+    rows = [{"bacterio_result_id": bacterio_id, "antibiotique_id": antibiotique_id, "resultat": None}
+            for antibiotique_id in (1, 2)]
+    with engine.begin() as connection:
+        connection.execute(insert(AntibioResult.__table__), rows[:1])
+    with engine.begin() as connection:
+        assert _insert_missing(connection, rows) == 1
+    assert _nb_lignes(engine) == 2
@@ -0,0 +1,71 @@
+"""Soldes des factures de convention recalculés après des paiements concurrents."""
+import threading
+from datetime import datetime
+import pytest
+from sqlalchemy.orm import Session
+from models import Convention, FactureConvention, SuiviPaiementConvention
+
+
+@pytest.fixture
+def facture_id(engine):
+    with Session(engine) as session:
+        convention = Convention(convention_name="Hôpital", etablissement="Hôpital", remise=0.0, numero="C1")
+        session.add(convention)
+        session.flush()
+        facture = FactureConvention(convention_id=convention.id, reference_facture="FC-1", montant_total=100.0,
+                                    montant_paye=0.0, solde_restant=100.0)
+        session.add(facture)
+        session.commit()
+        return facture.id
+
+
+def _payment(facture_id, montant):
+    return SuiviPaiementConvention(facture_id=facture_id, convention_id=1, montant_paye=montant,
+                                   date_paiement=datetime(2024, 5, 1))
+
+
+def _facture(engine, facture_id):
+    with Session(engine) as session:
+        return session.get(FactureConvention, facture_id)
+
+
+def test_interleaved_sessions(engine, facture_id):
+    first, second = Session(engine), Session(engine)
+    first.add(_payment(facture_id, 30.0))
+    second.add(_payment(facture_id, 20.0))
+    first.commit()
+    second.commit()
+    first.close()
+    second.close()
+
+    facture = _facture(engine, facture_id)
+    assert facture.montant_paye == 50.0
+    assert facture.solde_restant == 50.0
+    assert facture.statut_paiement == "paye_partiel"
+
+
+def test_concurrent_payments(engine, facture_id):
+    barrier = threading.Barrier(2)
+    errors = []
+
+    def pay(montant):
+        try:
+            with Session(engine) as session:
+                session.add(_payment(facture_id, montant))
+                barrier.wait(timeout=10)
+                session.commit()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=pay, args=(montant,)) for montant in (40.0, 60.0)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    assert not errors
+
+    facture = _facture(engine, facture_id)
+    assert facture.montant_paye == 100.0
+    assert facture.solde_restant == 0.0
+    assert facture.statut_paiement == "paye"
+    assert facture.date_paiement_complet == datetime(2024, 5, 1)
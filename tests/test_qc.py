@@ -0,0 +1,93 @@
+"""Règles de Westgard et état persistant des séries de contrôle."""
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+from models import ControlResult, ControlValue, Product, ProductType, QCSerieState
+from qc import (QCEngine, REGLE_10X, REGLE_1_2S, REGLE_1_3S, REGLE_2_2S, REGLE_4_1S, REGLE_R_4S,
+                register_validation)
+from seed import seed
+
+# Cible : moyenne 100, écart-type 10
+TARGET = (100.0, 10.0, 0.0, 200.0)
+
+
+def _rules(z_values):
+    engine = QCEngine()
+    engine.targets[(1, "")] = TARGET
+    return [engine.evaluate(1, 1, None, 100.0 + 10.0 * z).regles for z in z_values]
+
+
+@pytest.mark.parametrize("z_values, regle", [
+    ([2.5], REGLE_1_2S),
+    ([3.5], REGLE_1_3S),
+    ([2.5, 2.5], REGLE_2_2S),
+    ([2.5, -2.5], REGLE_R_4S),
+    ([1.5, 1.5, 1.5, 1.5], REGLE_4_1S),
+    ([0.5] * 10, REGLE_10X),
+])
+def test_rule_fires_on_last_point(z_values, regle):
+    regles = _rules(z_values)
+    assert regle in regles[-1]
+    assert all(regle not in previous for previous in regles[:-1])
+
+
+def test_rules_do_not_fire_across_sides():
+    regles = _rules([2.5, 0.5, -2.5, 1.5, 1.5, 1.5, -1.5] + [0.5] * 9 + [-0.5])
+    assert not any(set(point) - {REGLE_1_2S} for point in regles)
+
+
+def test_accepte_only_without_rejection_rule():
+    engine = QCEngine()
+    engine.targets[(1, "")] = TARGET
+    assert engine.evaluate(1, 1, None, 125.0).accepte
+    assert not engine.evaluate(1, 1, None, 125.0).accepte
+
+
+@pytest.fixture
+def product_id(engine):
+    seed(engine, 1, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(insert(Product.__table__).values(
+            id=1, type=ProductType.CONTROL, parameter_id=1, marque="M", lot="L1", nombre_flacons=1, nb_test=100,
+            expiration=datetime(2030, 1, 1), methode="m", prix_coffret=10.0, quantity_remaining=100))
+        connection.execute(insert(ControlValue.__table__).values(
+            product_id=1, type="normal", valeur_min=0.0, valeur_max=200.0, ecart_type=10.0))
+    return 1
+
+
+def _add_control(engine, valeur, day):
+    with Session(engine) as session:
+        result = ControlResult(product_id=1, parameter_id=1, level="normal", valeur_obtenue=valeur,
+                               control_date=datetime(2024, 5, 1) + timedelta(days=day))
+        session.add(result)
+        session.commit()
+        return result.is_within_range, result.comments
+
+
+def test_series_state_survives_restart(engine, product_id):
+    register_validation(QCEngine())
+    assert _add_control(engine, 125.0, 0) == (True, "Westgard : 1-2s")
+    # Nouveau processus : l'état de la série est relu dans qc_series_states
+    register_validation(QCEngine())
+    within_range, comments = _add_control(engine, 125.0, 1)
+    assert not within_range and REGLE_2_2S in comments
+
+    with engine.connect() as connection:
+        state = connection.execute(select(QCSerieState.__table__)).one()
+    assert state.n == 2 and state.run_2s == 2
+
+
+def test_backfill_rebuilds_persisted_state(engine, product_id):
+    register_validation(QCEngine())
+    for day, valeur in enumerate((115.0, 115.0, 115.0)):
+        _add_control(engine, valeur, day)
+    with engine.connect() as connection:
+        persisted = connection.execute(select(QCSerieState.__table__)).one()
+    with engine.begin() as connection:
+        assert QCEngine().backfill(connection) == 3
+        rebuilt = connection.execute(select(QCSerieState.__table__)).one()
+    assert (rebuilt.n, rebuilt.run_1s, rebuilt.mean) == (persisted.n, persisted.run_1s, persisted.mean)
+    register_validation(QCEngine())
+    within_range, comments = _add_control(engine, 115.0, 3)
+    assert not within_range and REGLE_4_1S in comments
@@ -0,0 +1,67 @@
+"""Cache des données de référence : paramètres créés par un autre processus."""
+import pytest
+from sqlalchemy import create_engine, insert, update
+from sqlalchemy.orm import Session
+from models import Parameter, Resultat
+from refdata import ReferenceDataCache, shared_cache
+from reports import load_reports
+from repository import CoreResultRepository
+from seed import seed
+from validation import STATUT_VALIDE
+
+
+def _add_parameter_and_result(engine, parameter_id):
+    # Écriture Core d'un autre processus : aucune invalidation dans ce processus
+    with engine.begin() as connection:
+        connection.execute(insert(Parameter.__table__).values(
+            parameter_id=parameter_id, param=f"Nouveau {parameter_id}", nom_param="N", prix_u=1.0, unite="g/L"))
+        connection.execute(insert(Resultat.__table__).values(
+            patient_id="P00000", analyse_id=1, parameter_id=parameter_id, valeur=4.2))
+
+
+@pytest.fixture
+def cache(engine):
+    seed(engine, nb_patients=1, nb_analyses=2, nb_resultats=3)
+    cache = ReferenceDataCache(engine, min_reload_interval=60)
+    cache.get()
+    return cache
+
+
+def test_missing_parameter_reloads_once(cache, engine):
+    _add_parameter_and_result(engine, 100)
+    with Session(engine) as session:
+        report = CoreResultRepository(session, cache).load_patient_report("PAT00000")
+    labels = [r["parameter"] for analyse in report["resultats"] for r in analyse["resultats"]]
+    assert "Nouveau 100" in labels
+    assert cache.get().version == 2
+
+
+def test_missing_parameter_keeps_clinical_rows(cache, engine):
+    _add_parameter_and_result(engine, 100)
+    cache.covering(parameters=[100])
+    # Rechargement limité : le paramètre suivant reste absent de l'instantané
+    _add_parameter_and_result(engine, 101)
+    with Session(engine) as session:
+        repository = CoreResultRepository(session, cache)
+        report = repository.load_patient_report("PAT00000")
+        header = repository.timeline_header("PAT00000", 101)
+    labels = [r["parameter"] for analyse in report["resultats"] for r in analyse["resultats"]]
+    assert "Paramètre 101" in labels
+    assert header.param == "Nouveau 101" and header.unite == "g/L"
+    assert cache.get().version == 2
+
+
+def test_report_keeps_results_of_unknown_parameters(cache, engine):
+    _add_parameter_and_result(engine, 102)
+    with engine.connect() as connection:
+        # Les comptes rendus n'impriment que les résultats validés
+        connection.execute(update(Resultat.__table__).values(validation_status=STATUT_VALIDE))
+        report, = load_reports(connection, [1])
+    assert [row["parameter_id"] for row in report["resultats"]] == [1, 2, 3, 102]
+    assert report["resultats"][-1]["param"] in ("Nouveau 102", "Paramètre 102")
+
+
+def test_shared_cache_rejects_another_database(engine):
+    assert shared_cache(engine) is shared_cache(create_engine(str(engine.url)))
+    with pytest.raises(ValueError):
+        shared_cache(create_engine("sqlite://"))
@@ -0,0 +1,23 @@
+"""Comptes rendus : seuls les résultats validés sont imprimés."""
+from sqlalchemy import update
+from models import Resultat
+from reports import load_reports
+from seed import seed
+from validation import STATUT_VALIDE
+
+
+def test_only_validated_results_are_printed(engine):
+    seed(engine, nb_patients=1, nb_analyses=1, nb_resultats=3)
+    resultats = Resultat.__table__
+    with engine.begin() as connection:
+        rows = connection.execute(resultats.select().order_by(resultats.c.id)).all()
+        analyse_id = rows[0].analyse_id
+        connection.execute(update(resultats).where(resultats.c.id == rows[0].id)
+                           .values(validation_status=STATUT_VALIDE, valeur=11.0))
+        connection.execute(update(resultats).where(resultats.c.id == rows[1].id)
+                           .values(validation_status="REJETE", valeur=22.0))
+        connection.execute(update(resultats).where(resultats.c.id == rows[2].id).values(valeur=33.0))
+
+    with engine.connect() as connection:
+        report, = load_reports(connection, [analyse_id])
+    assert [row["valeur"] for row in report["resultats"]] == [11.0]
@@ -0,0 +1,41 @@
+"""Chargement de la page résultats : nombre de requêtes indépendant de l'historique du patient."""
+import pytest
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from repository import CoreResultRepository, ResultRepository, version_query
+from models import Resultat
+from seed import seed
+
+
+def _count_queries(engine, query_counter, repository_class, nb_analyses):
+    seed(engine, nb_patients=2, nb_analyses=nb_analyses, nb_resultats=5)
+    with Session(engine) as session:
+        query_counter.reset()
+        report = repository_class(session).load_patient_report("PAT00001")
+    assert len(report["resultats"]) == nb_analyses
+    assert all(len(analyse["resultats"]) == 5 for analyse in report["resultats"])
+    return query_counter.count
+
+
+@pytest.mark.parametrize("repository_class", [ResultRepository, CoreResultRepository])
+def test_query_count_is_constant(engine, query_counter, repository_class):
+    counts = [_count_queries(engine, query_counter, repository_class, nb_analyses) for nb_analyses in (1, 10, 50)]
+    assert counts[0] == counts[1] == counts[2]
+    assert counts[0] <= 4
+
+
+
+def test_version_counts_results_through_their_analysis(engine):
+    seed(engine, nb_patients=2, nb_analyses=1, nb_resultats=2)
+    with Session(engine) as session:
+        before = CoreResultRepository(session).report_version("PAT00000")
+    # Résultat de l'analyse 1 (patient P00000) dont le patient_id, dénormalisé, est faux
+    with engine.begin() as connection:
+        connection.execute(insert(Resultat.__table__).values(
+            patient_id="P00001", analyse_id=1, parameter_id=1, valeur=7.0))
+    with Session(engine) as session:
+        repository = CoreResultRepository(session)
+        after = repository.report_version("PAT00000")
+        nb_resultats = session.execute(version_query("PAT00001")).first()[4]
+    assert after.etag != before.etag
+    assert nb_resultats == 2
@@ -0,0 +1,70 @@
+"""Page résultats : requêtes conditionnelles (ETag / 304) et version du contenu."""
+import pytest
+from sqlalchemy import insert, update
+from conftest import QueryCounter
+from models import Parameter, Resultat
+from seed import seed
+
+
+@pytest.fixture
+def client(engine):
+    import app
+    seed(engine, nb_patients=1, nb_analyses=3, nb_resultats=4)
+    app.reference_index.invalidate()
+    app.reference_data.invalidate()
+    app.results_cache.backend.clear()
+    return app.app.test_client()
+
+
+@pytest.fixture
+def app_queries(client):
+    import app
+    counter = QueryCounter(app.engine)
+    yield counter
+    counter.close()
+
+
+def test_304_runs_only_the_version_query(client, app_queries):
+    first = client.get("/PAT00000")
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+
+    app_queries.reset()
+    response = client.get("/PAT00000", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert app_queries.count == 1
+    assert "max(" in app_queries.statements[0].lower()
+
+
+def test_edited_value_changes_etag(client, engine):
+    first = client.get("/PAT00000")
+    etag = first.headers["ETag"]
+
+    # Correction faite par un autre processus (UPDATE Core, sans événement ORM dans l'application)
+    resultats = Resultat.__table__
+    with engine.begin() as connection:
+        connection.execute(update(resultats).where(resultats.c.id == 1).values(valeur=123456.0))
+
+    response = client.get("/PAT00000", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert b"123456" in response.data
+
+
+def test_page_not_cached_when_reference_data_reloads(client, engine):
+    import app
+    assert client.get("/PAT00000").status_code == 200
+    # Paramètre et résultat créés par un autre processus : l'instantané est rechargé pendant la requête
+    with engine.begin() as connection:
+        connection.execute(insert(Parameter.__table__).values(
+            parameter_id=99, param="Nouveau paramètre", nom_param="N99", prix_u=1.0))
+        connection.execute(insert(Resultat.__table__).values(
+            patient_id="P00000", analyse_id=1, parameter_id=99, valeur=4.2))
+    app.results_cache.backend.clear()
+
+    response = client.get("/PAT00000")
+    assert "Nouveau paramètre" in response.get_data(as_text=True)
+    assert len(app.results_cache.backend) == 0
+
+    assert client.get("/PAT00000").get_data(as_text=True) == response.get_data(as_text=True)
+    assert len(app.results_cache.backend) == 1
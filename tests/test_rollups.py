@@ -0,0 +1,59 @@
+"""Agrégats journaliers tenus au flush : identiques à une reconstruction complète."""
+from datetime import datetime
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from models import Analyse, RevenuJournalier
+from rollups import register_rollups, rebuild
+from seed import seed
+
+
+def _rows(connection):
+    table = RevenuJournalier.__table__
+    return [tuple(round(value, 6) if isinstance(value, float) else value for value in row)
+            for row in connection.execute(select(table).order_by(*table.primary_key.columns))
+            if any(row[name] for name in ("nb_analyses", "facture", "encaissements", "achats"))]
+
+
+def _assert_matches_rebuild(engine):
+    with engine.begin() as connection:
+        incremental = _rows(connection)
+        rebuild(connection)
+        assert incremental == _rows(connection)
+
+
+@pytest.fixture
+def session(engine):
+    seed(engine, 1, 3, 1)
+    with engine.begin() as connection:
+        rebuild(connection)
+    register_rollups()
+    with Session(engine) as session:
+        yield session
+
+
+def test_insert_update_noop_delete(engine, session):
+    analyse = Analyse(patient_id="P00000", dossier_barcode="DOS-NOUVEAU", analyse_date=datetime(2024, 5, 2, 9),
+                      facture=120.0, remise=0.0, fac_remise=120.0, prelevement="Lab", mode_paiement="espèces")
+    session.add(analyse)
+    session.commit()
+    _assert_matches_rebuild(engine)
+
+    analyse.facture = 150.0
+    analyse.analyse_date = datetime(2024, 5, 3, 9)
+    session.commit()
+    _assert_matches_rebuild(engine)
+
+    # Objet marqué modifié sans changement net : rien ne doit être compté deux fois
+    assert analyse.facture == 150.0
+    analyse.facture = 200.0
+    analyse.facture = 150.0
+    assert analyse in session.dirty and not session.is_modified(analyse)
+    session.flush()
+    session.flush()
+    session.commit()
+    _assert_matches_rebuild(engine)
+
+    session.delete(analyse)
+    session.commit()
+    _assert_matches_rebuild(engine)
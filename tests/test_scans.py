@@ -0,0 +1,36 @@
+"""Index des codes à barres : mise à jour après commit des écritures ORM."""
+import pytest
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from models import Barcode, PrelevementType, Tube
+from scans import BarcodeIndex, register_refresh
+from seed import seed
+
+
+@pytest.fixture
+def index(engine):
+    seed(engine, 1, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(insert(Tube.__table__).values(tube_id=1, name="EDTA"))
+        connection.execute(insert(PrelevementType.__table__).values(id=1, numero=1, name="1_Sang"))
+        connection.execute(insert(Barcode.__table__).values(
+            id=1, barcode_value="ECH001", analyse_id=1, prelevement_type_id=1, tube_id=1))
+    index = BarcodeIndex(engine).load()
+    register_refresh(index)
+    return index
+
+
+def test_renamed_or_deleted_barcode_leaves_index(engine, index):
+    assert index.lookup("ECH001").barcode_id == 1
+    with Session(engine) as session:
+        session.get(Barcode, 1).barcode_value = "ECH002"
+        session.commit()
+    assert index.lookup("ECH001") is None
+    assert index.lookup("ECH002").barcode_id == 1
+    assert len(index) == 1
+
+    with Session(engine) as session:
+        session.delete(session.get(Barcode, 1))
+        session.commit()
+    assert index.lookup("ECH002") is None
+    assert len(index) == 0
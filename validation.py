@@ -0,0 +1,160 @@
+"""
+Validation et griffe en masse des dossiers par le biologiste.
+
+Pour un lot d'analyses, la validation (validateur, date) et la griffe (is_stamped,
+stamped_by, stamped_at) sont appliquées par un UPDATE ensembliste par table
+(analyses, resultat, nfs, groupage, frottis, spermogramme, bactériologie) dans la
+transaction de la session, au lieu d'une écriture ORM par objet. Les validations
+ou griffes déjà présentes sur une ligne sont conservées (coalesce), et les résultats
+ayant déjà un statut (validé, rejeté...) ne sont pas modifiés. Un seul AuditLog
+résume le lot. Seuls les objets du lot déjà chargés dans la session sont expirés :
+les autres modifications en attente de l'appelant sont conservées.
+
+Usage : python validation.py <validateur_id> <analyse_id> [<analyse_id> ...] [--sans-griffe]
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import select, update, insert, func, or_, true
+from sqlalchemy.orm import attributes
+from cache import mark_results_changed
+from models import (Analyse, AnalyseState, AuditLog, BacterioResult, Frottis, GroupageSanguin,
+                    NumerationFormuleSanguine, Resultat, SpermogrammeResult)
+
+logger = logging.getLogger(__name__)
+
+ValidationResult = namedtuple("ValidationResult", ["analyse_ids", "ignorees", "lignes", "audit_log_id", "duree"])
+
+ACTION_VALIDATION = "validation_lot"
+STATUT_VALIDE = "VALIDE"
+
+# Tables de résultats portant validation et griffe
+STAMPED_MODELS = (NumerationFormuleSanguine, GroupageSanguin, Frottis, SpermogrammeResult, BacterioResult)
+
+# Colonnes que les UPDATE du lot peuvent écrire
+VALIDATION_COLUMNS = ("validated_by", "validateur_id", "validation_date", "validation_status", "is_stamped",
+                      "stamped_by", "stamped_at", "updated_at")
+
+
+def _pending_analyses(connection, analyse_ids, stamp):
+    """Analyses du lot restant à valider (ou à griffer), verrouillées dans l'ordre des identifiants."""
+    analyses = Analyse.__table__
+    a_traiter = analyses.c.validated_by.is_(None)
+    if stamp:
+        a_traiter = or_(a_traiter, analyses.c.is_stamped.isnot(True))
+    return connection.execute(
+        select(analyses.c.id, analyses.c.patient_id)
+        .where(analyses.c.id.in_(analyse_ids))
+        .where(or_(analyses.c.state.is_(None), analyses.c.state != AnalyseState.ANNULEE))
+        .where(a_traiter)
+        .order_by(analyses.c.id)
+        .with_for_update()
+    ).all()
+
+
+def _values(table, validateur_column, validateur_id, now, stamp):
+    values = {validateur_column: func.coalesce(table.c[validateur_column], validateur_id),
+              "validation_date": func.coalesce(table.c.validation_date, now)}
+    if stamp:
+        values.update(is_stamped=true(),
+                      stamped_by=func.coalesce(table.c.stamped_by, validateur_id),
+                      stamped_at=func.coalesce(table.c.stamped_at, now))
+    return values
+
+
+def _expire_updated(session, ids, lignes):
+    """
+    Expire, dans les objets du lot déjà chargés, les colonnes écrites par les UPDATE
+    (sauf celles que l'appelant a modifiées sans les avoir encore écrites).
+    """
+    tables = {model.__table__.name: model for model in (Analyse, Resultat) + STAMPED_MODELS}
+    for obj in list(session.identity_map.values()):
+        model = type(obj)
+        if model.__table__.name not in tables or not lignes.get(model.__table__.name):
+            continue
+        analyse_id = obj.id if model is Analyse else obj.analyse_id
+        if analyse_id not in ids:
+            continue
+        names = [column.key for column in model.__table__.columns
+                 if column.key in VALIDATION_COLUMNS and not attributes.get_history(obj, column.key).has_changes()]
+        if names:
+            session.expire(obj, names)
+
+
+def validate_analyses(session, analyse_ids, validateur_id, stamp=True, now=None):
+    """
+    Valide (et griffe si stamp) les analyses du lot et tous leurs résultats, dans la
+    transaction de la session : le commit reste à l'appelant. Les analyses annulées,
+    inconnues ou déjà traitées sont ignorées. Retourne un ValidationResult.
+    """
+    start = time.perf_counter()
+    now = now or datetime.now()
+    connection = session.connection()
+    analyse_ids = sorted(set(analyse_ids))
+    rows = _pending_analyses(connection, analyse_ids, stamp)
+    ids = [row.id for row in rows]
+    ignorees = sorted(set(analyse_ids) - set(ids))
+    if not ids:
+        return ValidationResult([], ignorees, {}, None, time.perf_counter() - start)
+
+    analyses = Analyse.__table__
+    lignes = {analyses.name: connection.execute(
+        update(analyses).where(analyses.c.id.in_(ids))
+        .values(_values(analyses, "validated_by", validateur_id, now, stamp))
+    ).rowcount}
+    resultats = Resultat.__table__
+    # Les résultats déjà validés ou rejetés gardent leur statut, validateur et date
+    lignes[resultats.name] = connection.execute(
+        update(resultats).where(resultats.c.analyse_id.in_(ids))
+        .where(resultats.c.validation_status.is_(None))
+        .values(_values(resultats, "validateur_id", validateur_id, now, False))
+        .values(validation_status=STATUT_VALIDE)
+    ).rowcount
+    for model in STAMPED_MODELS:
+        table = model.__table__
+        lignes[table.name] = connection.execute(
+            update(table).where(table.c.analyse_id.in_(ids))
+            .values(_values(table, "validateur_id", validateur_id, now, stamp))
+        ).rowcount
+
+    details = {"analyses": ids, "griffe": stamp, "lignes": lignes}
+    if ignorees:
+        details["ignorees"] = ignorees
+    audit_log_id = connection.execute(
+        insert(AuditLog.__table__).values(user_id=validateur_id, action=ACTION_VALIDATION,
+                                          details=json.dumps(details, separators=(",", ":")), timestamp=now)
+    ).inserted_primary_key[0]
+
+    # Les UPDATE en masse ne passent pas par les événements ORM : signaler les patients
+    # touchés au cache des pages résultats, et expirer les objets du lot déjà chargés
+    mark_results_changed(session, {row.patient_id for row in rows})
+    _expire_updated(session, set(ids), lignes)
+    duree = time.perf_counter() - start
+    logger.info(f"{len(ids)} analyses validées par {validateur_id} en {duree:.3f}s "
+                f"({sum(lignes.values())} lignes, {len(ignorees)} ignorées)")
+    return ValidationResult(ids, ignorees, lignes, audit_log_id, duree)
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from sqlalchemy.orm import sessionmaker
+    from database import create_engine_from_env
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Validation et griffe en masse des analyses")
+    parser.add_argument("validateur_id", type=int)
+    parser.add_argument("analyse_ids", type=int, nargs="+")
+    parser.add_argument("--sans-griffe", action="store_true")
+    args = parser.parse_args()
+
+    engine = create_engine_from_env(os.getenv("DATABASE_URL"))
+    Session = sessionmaker(bind=engine)
+    with Session.begin() as session:
+        result = validate_analyses(session, args.analyse_ids, args.validateur_id, stamp=not args.sans_griffe)
+    print(f"{len(result.analyse_ids)} analyses validées, {len(result.ignorees)} ignorées "
+          f"(journal {result.audit_log_id}) : {result.lignes}")